@@ -35,13 +35,37 @@ class Cache (object):
             return True
         elif not blocking:
             return False
+        attempt = 0
         while result is not True:
-            if time.time() - start_time > self.timeout:
+            remaining = self.timeout - (time.time() - start_time)
+            if remaining < 0:
                 raise Exception("You appear to have a stuck lock. You may wish to remove the lock named:\n%s" % self.getLockName(tile)) 
-            time.sleep(0.25)
+            self.waitForUnlock(tile, remaining, attempt)
+            attempt += 1
             result = self.attemptLock(tile)
         return True
 
+    ###########################################################################
+    ##
+    ## @brief wait for a lock held by someone else to be released
+    ##
+    ## @param tile     the tile whose lock is held
+    ## @param timeout  maximum number of seconds to wait
+    ## @param attempt  number of times this caller has already waited
+    ##
+    ## @details
+    ##  Returning early is always safe: lock() simply tries attemptLock
+    ##  again. The default strategy is exponential backoff with jitter,
+    ##  starting at a few milliseconds and capped at 250ms. Caches with a
+    ##  way to be notified of an unlock override this to wake immediately.
+    ##
+    ###########################################################################
+
+    def waitForUnlock (self, tile, timeout, attempt):
+        import random
+        backoff = min(0.25, 0.005 * 2 ** min(attempt, 6))
+        time.sleep(min(timeout, random.uniform(backoff / 2, backoff)))
+
     def getLockName (self, tile):
         return self.getKey(tile) + ".lck"
 
@@ -51,6 +75,17 @@ class Cache (object):
     def attemptLock (self, tile):
         raise NotImplementedError()
 
+    ###########################################################################
+    ##
+    ## @brief release the lock of a tile
+    ##
+    ## @details
+    ##  Locks belong to their name, not to a thread: the lock of a metatile
+    ##  is released by the thread which stores its tiles, which may not be
+    ##  the one which took it (see MetaLayer::render).
+    ##
+    ###########################################################################
+
     def unlock (self, tile):
         raise NotImplementedError()
 
@@ -74,3 +109,43 @@ class Cache (object):
     
     def delete(self, tile):
         raise NotImplementedError()
+
+    ###########################################################################
+    ##
+    ## @brief get several cached tiles at once
+    ##
+    ## @param tiles  list of TileCache::Layer::Tile
+    ##
+    ## @return list of tile data, None for the tiles which aren't cached, in
+    ##         the order of tiles
+    ##
+    ## @details
+    ##  Caches with a network round trip per request override this (and
+    ##  set_multi) to fetch everything in one go.
+    ##
+    ###########################################################################
+
+    def get_multi (self, tiles):
+        return [self.get(tile) for tile in tiles]
+
+    ###########################################################################
+    ##
+    ## @brief cache several tiles at once
+    ##
+    ## @param tile_data_pairs  list of (TileCache::Layer::Tile, data) tuples
+    ##
+    ## @return list of the data cached, in the order of tile_data_pairs
+    ##
+    ###########################################################################
+
+    def set_multi (self, tile_data_pairs):
+        return [self.set(tile, data) for tile, data in tile_data_pairs]
+
+    ###########################################################################
+    ##
+    ## @brief wait for any writes the cache has deferred to finish
+    ##
+    ###########################################################################
+
+    def flush (self):
+        pass
@@ -1,10 +1,10 @@
 # BSD Licensed, Copyright (c) 2006-2010 TileCache Contributors
 from TileCache.Cache import Cache
-import time
+import time, threading
 
 class AWSS3(Cache):
     import_error = "Problem importing S3 support library. You must have either boto or the Amazon S3 library.\nErrors:\n * %s"
-    def __init__ (self, access_key, secret_access_key, use_tms_paths = "False", **kwargs):
+    def __init__ (self, access_key, secret_access_key, use_tms_paths = "False", threads = 8, **kwargs):
         self.module = None
         try:
             import boto.s3
@@ -26,6 +26,12 @@ class AWSS3(Cache):
         elif use_tms_paths.lower() == "flipped":
             use_tms_paths = "google"
         self.use_tms_paths = use_tms_paths
+        self.access_key = access_key
+        self.secret_access_key = secret_access_key
+        self.threads = int(threads)
+        self.pool = None
+        self.pool_lock = threading.Lock()
+        self.local = threading.local()
         if self.module == "amazon":
             self.cache = self.s3.AWSAuthConnection(access_key, secret_access_key)
             self.cache.create_bucket(self.bucket_name)
@@ -33,8 +39,8 @@ class AWSS3(Cache):
             self.cache = self.s3.connection.S3Connection(access_key, secret_access_key)
             self.bucket = self.cache.create_bucket(self.bucket_name)
     
-    def getBotoKey(self, key):
-        boto_key = self.s3.key.Key(self.bucket)
+    def getBotoKey(self, key, bucket = None):
+        boto_key = self.s3.key.Key(bucket or self.bucket)
         boto_key.key = key
         return boto_key
     
@@ -83,6 +89,85 @@ class AWSS3(Cache):
             self.getBotoKey(key).set_contents_from_string(data)
             self.bucket.connection.connection.close()    
     
+    ###########################################################################
+    ##
+    ## @brief get several tiles, with parallel GETs
+    ##
+    ###########################################################################
+
+    def get_multi(self, tiles):
+        datas = self.parallel(self.getObjectThreaded,
+                              [self.getKey(tile) for tile in tiles])
+        for tile, data in zip(tiles, datas):
+            tile.data = data
+        return datas
+
+    ###########################################################################
+    ##
+    ## @brief cache several tiles, with parallel PUTs
+    ##
+    ###########################################################################
+
+    def set_multi(self, tile_data_pairs):
+        if self.readonly: return [data for tile, data in tile_data_pairs]
+        self.parallel(self.setObjectThreaded,
+                      [(self.getKey(tile), data) for tile, data in tile_data_pairs])
+        return [data for tile, data in tile_data_pairs]
+
+    ###########################################################################
+    ##
+    ## @brief run func over items on a pool of up to 'threads' threads
+    ##
+    ## @details
+    ##  Each pool thread keeps its own connection (neither S3 library can
+    ##  share one between threads) and keeps it open between requests.
+    ##
+    ###########################################################################
+
+    def parallel(self, func, items):
+        if len(items) < 2 or self.threads < 2:
+            return map(func, items)
+        if self.pool is None:
+            self.pool_lock.acquire()
+            try:
+                if self.pool is None:
+                    from multiprocessing.pool import ThreadPool
+                    self.pool = ThreadPool(self.threads)
+            finally:
+                self.pool_lock.release()
+        return self.pool.map(func, items)
+
+    def getThreadConnection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            if self.module == "amazon":
+                connection = self.s3.AWSAuthConnection(self.access_key, self.secret_access_key)
+            else:
+                connection = self.s3.bucket.Bucket(
+                    self.s3.connection.S3Connection(self.access_key, self.secret_access_key),
+                    self.bucket_name)
+            self.local.connection = connection
+        return connection
+
+    def getObjectThreaded(self, key):
+        connection = self.getThreadConnection()
+        if self.module == "amazon":
+            response = connection.get(self.bucket_name, key)
+            if not response.object.data.startswith("<?xml"):
+                return response.object.data
+            return None
+        try:
+            return self.getBotoKey(key, connection).get_contents_as_string()
+        except:
+            return None
+
+    def setObjectThreaded(self, (key, data)):
+        connection = self.getThreadConnection()
+        if self.module == "amazon":
+            connection.put(self.bucket_name, key, self.s3.S3Object(data))
+        else:
+            self.getBotoKey(key, connection).set_contents_from_string(data)
+
     def delete(self, tile):
         key = self.getKey(tile)
         self.deleteObject(key) 
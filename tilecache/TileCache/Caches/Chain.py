@@ -0,0 +1,206 @@
+# BSD Licensed, Copyright (c) 2006-2010 TileCache Contributors
+
+"""
+A cache made of an ordered list of other caches ('tiers'), fastest first.
+Reads fall through the tiers until one has the tile, which is then copied
+into the faster tiers in front of it. Writes and deletes go to every tier;
+tiers listed in write_behind are written from a background thread instead.
+Locks are taken on a single, authoritative tier (the last one by default).
+
+>>> from TileCache.Layer import Layer, Tile
+>>> from TileCache.Caches.Memory import Memory
+>>> l = Layer("test")
+>>> fast, slow = Memory(), Memory()
+>>> c = Chain([("fast", fast), ("slow", slow)])
+>>> slow.set(Tile(l, 0, 0, 0), "tile data")
+'tile data'
+>>> fast.get(Tile(l, 0, 0, 0)) is None
+True
+>>> c.get(Tile(l, 0, 0, 0))
+'tile data'
+>>> fast.get(Tile(l, 0, 0, 0))
+'tile data'
+>>> c.set(Tile(l, 1, 0, 0), "more data")
+'more data'
+>>> slow.get(Tile(l, 1, 0, 0))
+'more data'
+>>> c.stats()['slow']['hits']
+1
+>>> fast.delete(Tile(l, 1, 0, 0))
+>>> c.get_multi([Tile(l, 0, 0, 0), Tile(l, 1, 0, 0), Tile(l, 2, 0, 0)])
+['tile data', 'more data', None]
+>>> fast.get(Tile(l, 1, 0, 0))
+'more data'
+"""
+
+from TileCache.Cache import Cache
+import sys, threading, traceback, Queue
+
+class Chain (Cache):
+    def __init__ (self, tiers = (), write_behind = "", authoritative = None,
+                        queue_size = 1000, **kwargs):
+        Cache.__init__(self, **kwargs)
+        self.names = []
+        self.tiers = []
+        for i, tier in enumerate(tiers):
+            if isinstance(tier, tuple):
+                name, tier = tier
+            else:
+                name = str(i)
+            self.names.append(name)
+            self.tiers.append(tier)
+        if not self.tiers:
+            raise Exception("The Chain cache needs at least one tier.")
+
+        if isinstance(write_behind, str):
+            write_behind = [name.strip() for name in write_behind.split(",") if name.strip()]
+        self.write_behind = [name in write_behind for name in self.names]
+
+        if authoritative is None:
+            self.authority = self.tiers[-1]
+        elif authoritative in self.names:
+            self.authority = self.tiers[self.names.index(authoritative)]
+        else:
+            raise Exception("The authoritative tier %s is not one of %s." % (authoritative, ", ".join(self.names)))
+
+        self.hits = [0] * len(self.tiers)
+        self.misses = 0
+        self.queue = Queue.Queue(int(queue_size))
+        self.writer = None
+        self.writer_lock = threading.Lock()
+
+    def getKey (self, tile):
+        return self.authority.getKey(tile)
+
+    def get (self, tile):
+        for i, tier in enumerate(self.tiers):
+            data = tier.get(tile)
+            if data:
+                self.hits[i] += 1
+
+                ##### promote into the faster tiers #####
+
+                for faster in self.tiers[:i]:
+                    faster.set(tile, data)
+                tile.data = data
+                return data
+        self.misses += 1
+        return None
+
+    def get_multi (self, tiles):
+        datas = [None] * len(tiles)
+        missing = range(len(tiles))
+        for i, tier in enumerate(self.tiers):
+            if not missing:
+                break
+            found = tier.get_multi([tiles[j] for j in missing])
+            hits = [(tiles[j], data) for j, data in zip(missing, found) if data]
+            if hits:
+                self.hits[i] += len(hits)
+                for faster in self.tiers[:i]:
+                    faster.set_multi(hits)
+            for j, data in zip(missing, found):
+                if data:
+                    datas[j] = tiles[j].data = data
+            missing = [j for j in missing if not datas[j]]
+        self.misses += len(missing)
+        return datas
+
+    def set (self, tile, data):
+        for i, tier in enumerate(self.tiers):
+            if self.write_behind[i]:
+                self.writeBehind(tier, [(tile, data)])
+            else:
+                tier.set(tile, data)
+        tile.data = data
+        return data
+
+    def set_multi (self, tile_data_pairs):
+        for i, tier in enumerate(self.tiers):
+            if self.write_behind[i]:
+                self.writeBehind(tier, tile_data_pairs)
+            else:
+                tier.set_multi(tile_data_pairs)
+        for tile, data in tile_data_pairs:
+            tile.data = data
+        return [data for tile, data in tile_data_pairs]
+
+    def delete (self, tile):
+        for tier in self.tiers:
+            tier.delete(tile)
+
+    ###########################################################################
+    ##
+    ## @brief queue writes to a slow tier, done by a background thread
+    ##
+    ## @details
+    ##  If the queue is full, the writes are done straight away so that a
+    ##  slow tier pushes back on the writers instead of using up memory.
+    ##
+    ###########################################################################
+
+    def writeBehind (self, tier, tile_data_pairs):
+        if self.writer is None:
+            self.writer_lock.acquire()
+            try:
+                if self.writer is None:
+                    writer = threading.Thread(target=self.writeLoop)
+                    writer.setDaemon(True)
+                    writer.start()
+                    self.writer = writer
+            finally:
+                self.writer_lock.release()
+        try:
+            self.queue.put_nowait((tier, list(tile_data_pairs)))
+        except Queue.Full:
+            tier.set_multi(tile_data_pairs)
+
+    def writeLoop (self):
+        while True:
+            tier, tile_data_pairs = self.queue.get()
+            try:
+                try:
+                    tier.set_multi(tile_data_pairs)
+                except Exception, E:
+                    sys.stderr.write("Write behind of %s tiles in layer %s failed: %s\n%s" % (
+                        len(tile_data_pairs), tile_data_pairs[0][0].layer.name, E, traceback.format_exc()))
+            finally:
+                self.queue.task_done()
+
+    def flush (self):
+        if self.writer is not None:
+            self.queue.join()
+        for tier in self.tiers:
+            tier.flush()
+
+    ###########################################################################
+    ##
+    ## @brief hits per tier, plus the tier's own counters if it has any
+    ##
+    ###########################################################################
+
+    def stats (self):
+        stats = { 'misses': self.misses, 'pending_writes': self.queue.qsize() }
+        for i, name in enumerate(self.names):
+            tier_stats = {}
+            if hasattr(self.tiers[i], "stats"):
+                tier_stats.update(self.tiers[i].stats())
+            tier_stats['hits'] = self.hits[i]
+            stats[name] = tier_stats
+        return stats
+
+    def getLockName (self, tile):
+        return self.authority.getLockName(tile)
+
+    def attemptLock (self, tile):
+        return self.authority.attemptLock(tile)
+
+    def waitForUnlock (self, tile, timeout, attempt):
+        return self.authority.waitForUnlock(tile, timeout, attempt)
+
+    def unlock (self, tile):
+        return self.authority.unlock(tile)
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -163,6 +163,27 @@ class Disk (Cache):
             pass
         return False 
      
+    ###########################################################################
+    ##
+    ## @brief wait for the lock directory of a tile to be removed
+    ##
+    ## @details
+    ##  Uses inotify where available, so waiters wake as soon as the holder
+    ##  calls unlock. Each wait is capped at 250ms, the longest the polling
+    ##  of Cache.waitForUnlock sleeps, so that stale locks and filesystems
+    ##  which don't deliver events (NFS) are still rechecked as often.
+    ##
+    ###########################################################################
+    
+    def waitForUnlock (self, tile, timeout, attempt):
+        from TileCache import Inotify
+        if not Inotify.available or self.platform != "cpython":
+            return Cache.waitForUnlock(self, tile, timeout, attempt)
+        try:
+            Inotify.waitForRemoval(self.getLockName(tile), min(timeout, 0.25))
+        except OSError:
+            Cache.waitForUnlock(self, tile, timeout, attempt)
+     
     def unlock (self, tile):
         name = self.getLockName(tile)
         try:
@@ -1,24 +1,200 @@
-# A minimal implementation of an MBTiles-formatted SQLite database 
-# cache access mechanism. (No writing, only reading.)
+# An implementation of an MBTiles-formatted SQLite database cache.
 # See:
 #  http://mbtiles.org/
 # for more information on the mbtiles format; it is essentially a single 
-# table in a sqlite database with 4 columns:
+# 'tiles' table (or view) in a sqlite database with 4 columns:
 #  * tile_column
 #  * tile_row
 #  * zoom_level
 #  * tile_data
+#
+# Databases created by this cache use the deduplicating layout, where 'tiles'
+# is a view joining a 'map' table of tile coordinates to an 'images' table of
+# tile data keyed by a hash of the data, so identical tiles (blank ocean, for
+# example) are only stored once.
+
+"""
+Databases are only written to with readonly=no:
+
+>>> import tempfile, shutil, threading
+>>> from TileCache.Layer import Layer, Tile
+>>> base = tempfile.mkdtemp()
+>>> layer = Layer("basic")
+>>> MBTiles(base, "mbtiles").set(Tile(layer, 0, 0, 0), "data")
+'data'
+>>> os.path.exists(os.path.join(base, "basic.mbtiles"))
+False
+>>> cache = MBTiles(base, "mbtiles", readonly="no")
+>>> cache.set_multi([(Tile(layer, 0, 0, 0), "blank"), (Tile(layer, 1, 0, 0), "blank")])
+['blank', 'blank']
+
+Every write is committed, so a lock may be released by another thread than
+the one which took it:
+
+>>> metatile = Tile(layer, 0, 0, 1)
+>>> cache.attemptLock(metatile)
+True
+>>> cache.set(Tile(layer, 0, 0, 1), "tile")
+'tile'
+>>> unlocker = threading.Thread(target=cache.unlock, args=(metatile,))
+>>> unlocker.start(); unlocker.join()
+>>> reader = MBTiles(base, "mbtiles")
+>>> reader.get(Tile(layer, 0, 0, 1)), reader.get(Tile(layer, 1, 0, 0))
+('tile', 'blank')
+>>> cache.attemptLock(metatile)
+True
+>>> shutil.rmtree(base)
+"""
 
 from TileCache.Cache import Cache
 import os
 import sqlite3
+import threading
+import urllib
+import hashlib
+import time
+
+schema = """
+CREATE TABLE IF NOT EXISTS map (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT);
+CREATE UNIQUE INDEX IF NOT EXISTS map_index ON map (zoom_level, tile_column, tile_row);
+CREATE TABLE IF NOT EXISTS images (tile_id TEXT, tile_data BLOB);
+CREATE UNIQUE INDEX IF NOT EXISTS images_id ON images (tile_id);
+CREATE VIEW IF NOT EXISTS tiles AS
+    SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column,
+           map.tile_row AS tile_row, images.tile_data AS tile_data
+    FROM map JOIN images ON images.tile_id = map.tile_id;
+CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT);
+CREATE UNIQUE INDEX IF NOT EXISTS name ON metadata (name);
+"""
+
+lock_schema = """
+CREATE TABLE IF NOT EXISTS tilecache_locks (name TEXT PRIMARY KEY, expires REAL);
+"""
 
 class MBTiles (Cache):
-    def __init__ (self, base = None, ext = None, umask = '002', **kwargs):
-        Cache.__init__(self, **kwargs)
+    def __init__ (self, base = None, ext = None, umask = '002',
+                        mmap_size = 268435456, immutable = "no",
+                        batch_size = 256, readonly = "yes", **kwargs):
+        Cache.__init__(self, readonly = readonly, **kwargs)
         self.basedir = base
         self.ext = ext
-        
+        self.umask = int(umask, 0)
+        self.mmap_size = int(mmap_size)
+        self.batch_size = int(batch_size)
+        if isinstance(immutable, str):
+            immutable = immutable.lower() in ("yes", "y", "t", "true")
+        self.immutable = immutable
+        if isinstance(self.readonly, str):
+            self.readonly = self.readonly.lower() in ("yes", "y", "t", "true")
+        self.local = threading.local()
+
+    def getPath (self, layer):
+        return "%s.%s" % (os.path.join(self.basedir, layer.name), self.ext)
+
+    def getKey (self, tile):
+        return "/".join(map(str, [tile.layer.name, tile.z, tile.x, tile.y]))
+
+    ###########################################################################
+    ##
+    ## @brief open a database read-only, memory mapped
+    ##
+    ## @param path  the file name of the database
+    ##
+    ## @return sqlite3 connection
+    ##
+    ## @details
+    ##  Used unless the cache is configured with readonly=no. immutable=yes
+    ##  in the cache config tells SQLite that nobody changes the file while
+    ##  it is open, so it can skip locking entirely. Only set it if the files
+    ##  are replaced rather than written in place.
+    ##
+    ###########################################################################
+
+    def connectReadOnly (self, path):
+        if not os.path.exists(path):
+            raise Exception("MBTiles database %s does not exist." % path)
+        params = "mode=ro"
+        if self.immutable:
+            params += "&immutable=1"
+        try:
+            db = sqlite3.connect("file:%s?%s" % (urllib.pathname2url(os.path.abspath(path)), params), uri=True)
+        except TypeError:
+            # sqlite3 in Python 2 doesn't take URI filenames
+            db = sqlite3.connect(path)
+            db.execute("PRAGMA query_only = 1")
+        db.execute("PRAGMA mmap_size = %d" % self.mmap_size)
+        return db
+
+    ###########################################################################
+    ##
+    ## @brief open a database for writing, creating it if needed
+    ##
+    ## @param path   the file name of the database
+    ## @param layer  the layer stored in the database
+    ##
+    ## @return sqlite3 connection
+    ##
+    ## @details
+    ##  Databases are put in WAL mode, so readers are never blocked by a
+    ##  writer, and new databases get the deduplicating schema.
+    ##
+    ###########################################################################
+
+    def connectWritable (self, path, layer):
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            old_umask = os.umask(self.umask)
+            try:
+                try:
+                    os.makedirs(dirname)
+                except OSError, E:
+                    if E.errno != 17:
+                        raise
+            finally:
+                os.umask(old_umask)
+        db = sqlite3.connect(path, timeout = self.timeout)
+        db.text_factory = str
+        db.execute("PRAGMA journal_mode = WAL")
+        db.execute("PRAGMA synchronous = NORMAL")
+        db.execute("PRAGMA mmap_size = %d" % self.mmap_size)
+        if not db.execute("SELECT name FROM sqlite_master WHERE name = 'tiles'").fetchone():
+            db.executescript(schema)
+            db.executemany("INSERT OR IGNORE INTO metadata (name, value) VALUES (?, ?)",
+                           [("name", layer.name), ("format", layer.extension),
+                            ("type", "baselayer"), ("version", "1.1")])
+        db.executescript(lock_schema)
+        db.commit()
+        return db
+
+    ###########################################################################
+    ##
+    ## @brief get the connection to the database of a layer
+    ##
+    ## @details
+    ##  Connections are kept per thread (sqlite3 connections can't be shared
+    ##  between threads) and per layer, and reused for every lookup. Reusing
+    ##  the connection also reuses its cached prepared statements, so the
+    ##  tile query is only parsed and planned once.
+    ##
+    ###########################################################################
+
+    def getConnection (self, layer):
+        try:
+            connections = self.local.connections
+        except AttributeError:
+            connections = self.local.connections = {}
+            self.local.deduplicated = {}
+        db = connections.get(layer.name)
+        if db is None:
+            if self.readonly:
+                db = self.connectReadOnly(self.getPath(layer))
+            else:
+                db = self.connectWritable(self.getPath(layer), layer)
+                self.local.deduplicated[layer.name] = db.execute(
+                    "SELECT type FROM sqlite_master WHERE name = 'tiles'").fetchone()[0] == "view"
+            connections[layer.name] = db
+        return db
+
     ###########################################################################
     ##
     ## @brief get cached tile from a MBTiles db
@@ -31,11 +207,98 @@ class MBTiles (Cache):
     ###########################################################################
     
     def get (self, tile):
-        db = sqlite3.connect("%s.%s" % (os.path.join(self.basedir, tile.layer.name), self.ext))
-        c = db.cursor()
-        c.execute("select tile_data from tiles where tile_column=? and tile_row=? and zoom_level=?", (tile.x, tile.y, tile.z))
+        db = self.getConnection(tile.layer)
+        c = db.execute("select tile_data from tiles where tile_column=? and tile_row=? and zoom_level=?", (tile.x, tile.y, tile.z))
         res = c.fetchone()
         if res:
             tile.data = str(res[0])
             return tile.data
         return None
+
+    def write (self, db, tile, data):
+        if self.local.deduplicated[tile.layer.name]:
+            tile_id = hashlib.md5(data).hexdigest()
+            db.execute("INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)",
+                       (tile_id, sqlite3.Binary(data)))
+            db.execute("INSERT OR REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)",
+                       (tile.z, tile.x, tile.y, tile_id))
+        else:
+            db.execute("INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)",
+                       (tile.z, tile.x, tile.y, sqlite3.Binary(data)))
+        tile.data = data
+
+    def set (self, tile, data):
+        if self.readonly: return data
+        db = self.getConnection(tile.layer)
+        self.write(db, tile, data)
+        db.commit()
+        return data
+
+    ###########################################################################
+    ##
+    ## @brief cache several tiles, in a single transaction per database
+    ##
+    ## @details
+    ##  This is how the tiles of a metatile land in one commit. batch_size
+    ##  bounds the number of writes in one transaction.
+    ##
+    ###########################################################################
+
+    def set_multi (self, tile_data_pairs):
+        if self.readonly: return [data for tile, data in tile_data_pairs]
+        pending = {}
+        for tile, data in tile_data_pairs:
+            db = self.getConnection(tile.layer)
+            self.write(db, tile, data)
+            pending[db] = pending.get(db, 0) + 1
+            if pending[db] >= self.batch_size:
+                db.commit()
+                pending[db] = 0
+        for db in pending.keys():
+            db.commit()
+        return [data for tile, data in tile_data_pairs]
+
+    ###########################################################################
+    ##
+    ## @brief delete a tile
+    ##
+    ## @details
+    ##  In deduplicated databases only the map entry is removed; image data
+    ##  no longer referenced by any tile is left in the images table.
+    ##
+    ###########################################################################
+
+    def delete (self, tile):
+        if self.readonly: return
+        db = self.getConnection(tile.layer)
+        if self.local.deduplicated[tile.layer.name]:
+            table = "map"
+        else:
+            table = "tiles"
+        db.execute("DELETE FROM %s WHERE zoom_level=? AND tile_column=? AND tile_row=?" % table,
+                   (tile.z, tile.x, tile.y))
+        db.commit()
+
+    ###########################################################################
+    ##
+    ## Locks are rows in a table of the database, which expire after the
+    ## stale_interval of the cache in case their holder died.
+    ##
+    ###########################################################################
+
+    def attemptLock (self, tile):
+        if self.readonly: return True
+        db = self.getConnection(tile.layer)
+        name = self.getLockName(tile)
+        now = time.time()
+        db.execute("DELETE FROM tilecache_locks WHERE name=? AND expires<?", (name, now))
+        c = db.execute("INSERT OR IGNORE INTO tilecache_locks (name, expires) VALUES (?, ?)",
+                       (name, now + self.stale))
+        db.commit()
+        return c.rowcount == 1
+
+    def unlock (self, tile):
+        if self.readonly: return
+        db = self.getConnection(tile.layer)
+        db.execute("DELETE FROM tilecache_locks WHERE name=?", (self.getLockName(tile),))
+        db.commit()
@@ -24,6 +24,19 @@ class Memcached(Cache):
         self.cache.set(key, data)
         return data
     
+    def get_multi(self, tiles):
+        keys = [self.getKey(tile) for tile in tiles]
+        found = self.cache.get_multi(keys)
+        for tile, key in zip(tiles, keys):
+            tile.data = found.get(key)
+        return [tile.data for tile in tiles]
+
+    def set_multi(self, tile_data_pairs):
+        if self.readonly: return [data for tile, data in tile_data_pairs]
+        self.cache.set_multi(dict([(self.getKey(tile), data)
+                                   for tile, data in tile_data_pairs]))
+        return [data for tile, data in tile_data_pairs]
+    
     def delete(self, tile):
         key = self.getKey(tile)
         self.cache.delete(key)
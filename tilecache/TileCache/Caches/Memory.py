@@ -0,0 +1,246 @@
+# BSD Licensed, Copyright (c) 2006-2010 TileCache Contributors
+
+"""
+A byte-bounded, least-recently-used in-memory tile cache. It can be used on
+its own, or as a tier in front of any other cache type, named by 'backend':
+hits are served from memory, misses fall through to the backend and are kept
+in memory on the way back. Locking is delegated to the backend, so several
+processes can share it.
+
+>>> from TileCache.Layer import Layer, Tile
+>>> l = Layer("test")
+>>> c = Memory(max_bytes=10)
+>>> c.set(Tile(l, 0, 0, 0), "12345")
+'12345'
+>>> c.get(Tile(l, 0, 0, 0))
+'12345'
+>>> c.get(Tile(l, 1, 0, 0)) is None
+True
+>>> c.set(Tile(l, 1, 0, 0), "67890")
+'67890'
+>>> c.get(Tile(l, 0, 0, 0))
+'12345'
+>>> c.set(Tile(l, 0, 1, 0), "abcde")
+'abcde'
+>>> c.get(Tile(l, 1, 0, 0)) is None
+True
+>>> c.stats() == {'hits': 2, 'misses': 2, 'evictions': 1,
+...               'entries': 2, 'bytes': 10, 'max_bytes': 10}
+True
+
+Deleting a tile, or expiring its layer, drops it from memory:
+
+>>> c.delete(Tile(l, 0, 0, 0))
+>>> c.get(Tile(l, 0, 0, 0)) is None
+True
+>>> l.expired = time.time() + 1
+>>> c.get(Tile(l, 0, 1, 0)) is None
+True
+"""
+
+from TileCache.Cache import Cache
+import time, threading
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    OrderedDict = None
+
+class Memory (Cache):
+    def __init__ (self, backend = None, max_bytes = 64 * 1024 * 1024,
+                        max_zoom = None, **kwargs):
+        Cache.__init__(self, **kwargs)
+        if OrderedDict is None:
+            raise Exception("The Memory cache requires Python 2.7 or later.")
+        if isinstance(backend, str):
+            backend = backend.replace("Cache", "")
+            module = __import__("TileCache.Caches.%s" % backend, {}, {}, [backend])
+            backend = getattr(module, backend)(**kwargs)
+        self.backend = backend
+        self.max_bytes = int(max_bytes)
+        if max_zoom is not None and max_zoom != "":
+            max_zoom = int(max_zoom)
+        else:
+            max_zoom = None
+        self.max_zoom = max_zoom
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.mutex = threading.Lock()
+        self.locks = {}
+
+    def getKey (self, tile):
+        return "/".join(map(str, [tile.layer.name, tile.z, tile.x, tile.y]))
+
+    ###########################################################################
+    ##
+    ## @brief put data in memory, evicting least recently used tiles
+    ##
+    ###########################################################################
+
+    def store (self, key, data):
+        if self.sendfile or len(data) > self.max_bytes:
+            return
+        self.mutex.acquire()
+        try:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old[0])
+            self.entries[key] = (data, time.time())
+            self.bytes += len(data)
+            while self.bytes > self.max_bytes:
+                evicted_key, evicted = self.entries.popitem(last=False)
+                self.bytes -= len(evicted[0])
+                self.evictions += 1
+        finally:
+            self.mutex.release()
+
+    def discard (self, key):
+        self.mutex.acquire()
+        try:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old[0])
+        finally:
+            self.mutex.release()
+
+    def keeps (self, tile):
+        return self.max_zoom is None or tile.z <= self.max_zoom
+
+    ###########################################################################
+    ##
+    ## @brief look a tile up in memory only
+    ##
+    ###########################################################################
+
+    def lookup (self, tile):
+        if not self.keeps(tile):
+            return None
+        key = self.getKey(tile)
+        self.mutex.acquire()
+        try:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                if tile.layer.expired is not None and entry[1] < tile.layer.expired:
+                    self.bytes -= len(entry[0])
+                    entry = None
+                else:
+                    self.entries[key] = entry
+            if entry is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        finally:
+            self.mutex.release()
+        if entry is not None:
+            tile.data = entry[0]
+            return tile.data
+        return None
+
+    def get (self, tile):
+        data = self.lookup(tile)
+        if data is None and self.backend:
+            data = self.backend.get(tile)
+            if data and self.keeps(tile):
+                self.store(self.getKey(tile), data)
+        return data
+
+    def get_multi (self, tiles):
+        datas = [self.lookup(tile) for tile in tiles]
+        missing = [i for i, data in enumerate(datas) if data is None]
+        if missing and self.backend:
+            found = self.backend.get_multi([tiles[i] for i in missing])
+            for i, data in zip(missing, found):
+                datas[i] = data
+                if data and self.keeps(tiles[i]):
+                    self.store(self.getKey(tiles[i]), data)
+        return datas
+
+    def set (self, tile, data):
+        if self.backend:
+            data = self.backend.set(tile, data)
+        if self.keeps(tile):
+            self.store(self.getKey(tile), data)
+        tile.data = data
+        return data
+
+    def set_multi (self, tile_data_pairs):
+        if self.backend:
+            datas = self.backend.set_multi(tile_data_pairs)
+        else:
+            datas = [data for tile, data in tile_data_pairs]
+        for (tile, old), data in zip(tile_data_pairs, datas):
+            if self.keeps(tile):
+                self.store(self.getKey(tile), data)
+            tile.data = data
+        return datas
+
+    def delete (self, tile):
+        self.discard(self.getKey(tile))
+        if self.backend:
+            self.backend.delete(tile)
+
+    ###########################################################################
+    ##
+    ## @brief counters for this tier
+    ##
+    ## @return dictionary of hits, misses, evictions, entries, bytes and
+    ##         max_bytes
+    ##
+    ###########################################################################
+
+    def stats (self):
+        self.mutex.acquire()
+        try:
+            return { 'hits': self.hits, 'misses': self.misses,
+                     'evictions': self.evictions,
+                     'entries': len(self.entries), 'bytes': self.bytes,
+                     'max_bytes': self.max_bytes }
+        finally:
+            self.mutex.release()
+
+    ###########################################################################
+    ##
+    ## Locks are taken on the backend so they are shared between processes;
+    ## on its own, the Memory cache only has to coordinate threads.
+    ##
+    ###########################################################################
+
+    def getLockName (self, tile):
+        if self.backend:
+            return self.backend.getLockName(tile)
+        return self.getKey(tile) + ".lck"
+
+    def attemptLock (self, tile):
+        if self.backend:
+            return self.backend.attemptLock(tile)
+        name = self.getLockName(tile)
+        self.mutex.acquire()
+        try:
+            locked = self.locks.get(name)
+            if locked is not None and locked + self.stale > time.time():
+                return False
+            self.locks[name] = time.time()
+            return True
+        finally:
+            self.mutex.release()
+
+    def waitForUnlock (self, tile, timeout, attempt):
+        if self.backend:
+            return self.backend.waitForUnlock(tile, timeout, attempt)
+        return Cache.waitForUnlock(self, tile, timeout, attempt)
+
+    def unlock (self, tile):
+        if self.backend:
+            return self.backend.unlock(tile)
+        self.mutex.acquire()
+        try:
+            self.locks.pop(self.getLockName(tile), None)
+        finally:
+            self.mutex.release()
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -59,6 +59,38 @@ class Redis(Cache):
         pipeline.execute()
         return data
 
+    def get_multi(self, tiles):
+        """Retrieve the cached data for several tiles in one round trip.
+
+        :param tiles: A list of tiles
+        :type tiles: list of TileCache.Layer.Tile
+        :rtype: list of str or unicode, None where a tile isn't cached
+        """
+        pipeline = self.cache.pipeline(transaction=False)
+        for tile in tiles:
+            pipeline.hget(self.getKey(tile), 'data')
+        for tile, data in zip(tiles, pipeline.execute()):
+            tile.data = data
+        return [tile.data for tile in tiles]
+
+    def set_multi(self, tile_data_pairs):
+        """Cache data for several tiles in one round trip.
+
+        :param tile_data_pairs: A list of (tile, data) tuples
+        :type tile_data_pairs: list of (TileCache.Layer.Tile, str)
+        :rtype: list of str or unicode
+        """
+        if self.readonly:
+            return [data for tile, data in tile_data_pairs]
+        pipeline = self.cache.pipeline(transaction=False)
+        now = time.time()
+        for tile, data in tile_data_pairs:
+            key = self.getKey(tile)
+            pipeline.hmset(key, {'data': data, 'last_updated': now})
+            pipeline.expire(key, int(self.expiration))
+        pipeline.execute()
+        return [data for tile, data in tile_data_pairs]
+
     def delete(self, tile):
         """Delete the cached data for the given tile.
 
@@ -107,10 +139,42 @@ class Redis(Cache):
 
         return result
 
+    def waitForUnlock(self, tile, timeout, attempt):
+        """Wait for the lock on the given tile to be released.
+
+        Subscribes to the lock's channel, which unlock() publishes to, so
+        waiters wake as soon as the lock is released. Each wait is capped at
+        a second so locks that simply expire are noticed too.
+
+        :param tile: A tile
+        :type tile: TileCache.Layer.Tile
+        :param timeout: Maximum number of seconds to wait
+        :type timeout: float
+        :param attempt: Number of times the caller has already waited
+        :type attempt: int
+        """
+        name = self.getLockName(tile)
+        pubsub = self.cache.pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(name)
+            # The lock may have been released before we subscribed.
+            if not self.cache.exists(name):
+                return
+            deadline = time.time() + min(timeout, 1.0)
+            while time.time() < deadline:
+                if pubsub.get_message(timeout=deadline - time.time()):
+                    return
+        finally:
+            pubsub.close()
+
     def unlock(self, tile):
         """Unlock the given tile
 
         :param tile: A tile
         :type tile: TileCache.Layer.Tile
         """
-        self.cache.delete(self.getLockName(tile))
+        name = self.getLockName(tile)
+        pipeline = self.cache.pipeline()
+        pipeline.delete(name)
+        pipeline.publish(name, "unlocked")
+        pipeline.execute()
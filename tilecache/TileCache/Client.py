@@ -2,24 +2,305 @@
 
 # BSD Licensed, Copyright (c) 2006-2010 TileCache Contributors
 
-import sys, urllib, urllib2, time, os, math
-import time
-import httplib
-try:
-    from optparse import OptionParser
-except ImportError:
-    OptionParser = False 
+import sys, time, os, math
+import threading
+
+##### httplib, urllib and the like are imported where they are used: #####
+##### a request answered from the cache never needs them              #####
 
 # setting this to True will exchange more useful error messages
 # for privacy, hiding URLs and error messages.
 HIDE_ALL = False 
 
+###############################################################################
+##
+## @brief keep-alive HTTP connections to one upstream host
+##
+## @details
+##  Connections are kept open between requests and reused by later ones,
+##  instead of a new TCP (and TLS) handshake per tile. At most max_requests
+##  requests are in flight to the host at once; further requests wait.
+##  GET requests failing with a connection error or a 502, 503 or 504 are
+##  retried, up to 'retries' times, after a jittered, exponential backoff;
+##  other requests (POSTs) are never retried, as the server may have acted
+##  on them. A proxy URL, if given, is connected to instead of the host:
+##  http requests are sent to it, https requests tunneled through it.
+##
+###############################################################################
+
+class HTTPPool (object):
+    __slots__ = ("scheme", "host", "port", "proxy", "max_requests",
+                 "timeout", "retries", "idle", "lock", "slots", "requests",
+                 "errors", "retried", "connections", "latency", "max_latency")
+
+    retry_statuses = (502, 503, 504)
+    idempotent_methods = ("GET", "HEAD")
+
+    def __init__ (self, scheme, host, port = None, max_requests = 8,
+                        timeout = 30, retries = 3, proxy = None):
+        import urlparse
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.proxy = None
+        if proxy:
+            if "://" not in proxy:
+                proxy = "http://" + proxy
+            self.proxy = urlparse.urlsplit(proxy)
+        self.max_requests = int(max_requests)
+        self.timeout = float(timeout)
+        self.retries = int(retries)
+        self.idle = []
+        self.lock = threading.Lock()
+        self.slots = threading.Semaphore(self.max_requests)
+        self.requests = 0
+        self.errors = 0
+        self.retried = 0
+        self.connections = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+    def connect (self):
+        import httplib
+        host, port = self.host, self.port
+        if self.proxy:
+            host, port = self.proxy.hostname, self.proxy.port
+        if self.scheme == "https":
+            connection = httplib.HTTPSConnection(host, port, timeout = self.timeout)
+            if self.proxy:
+                connection.set_tunnel(self.host, self.port, self.proxyHeaders())
+        else:
+            connection = httplib.HTTPConnection(host, port, timeout = self.timeout)
+        self.lock.acquire()
+        try:
+            self.connections += 1
+        finally:
+            self.lock.release()
+        return connection
+
+    def proxyHeaders (self):
+        import base64
+        if self.proxy is None or self.proxy.username is None:
+            return {}
+        return { "Proxy-Authorization": "Basic %s" % base64.b64encode(
+                     "%s:%s" % (self.proxy.username, self.proxy.password or "")) }
+
+    ###########################################################################
+    ##
+    ## @brief get a connection to the host
+    ##
+    ## @param reuse  whether an idle connection may be used
+    ##
+    ## @return tuple of (connection, whether it was idle)
+    ##
+    ###########################################################################
+
+    def checkout (self, reuse = True):
+        if reuse:
+            self.lock.acquire()
+            try:
+                if self.idle:
+                    return self.idle.pop(), True
+            finally:
+                self.lock.release()
+        return self.connect(), False
+
+    def checkin (self, connection):
+        self.lock.acquire()
+        try:
+            self.idle.append(connection)
+        finally:
+            self.lock.release()
+
+    def count (self, start, error = False, retry = False):
+        latency = time.time() - start
+        self.lock.acquire()
+        try:
+            self.requests += 1
+            self.latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            if error:
+                self.errors += 1
+            if retry:
+                self.retried += 1
+        finally:
+            self.lock.release()
+
+    ###########################################################################
+    ##
+    ## @brief make a request to the host
+    ##
+    ## @param method   HTTP method
+    ## @param path     path and query string
+    ## @param body     request body, or None
+    ## @param headers  dictionary of extra request headers
+    ##
+    ## @return tuple of (status, httplib.HTTPResponse, data); the response
+    ##         has already been read
+    ##
+    ## @details
+    ##  An idle connection the server has closed in the meantime fails as
+    ##  soon as it is used; the request is then sent again at once, over a
+    ##  new connection, which isn't counted as an error or a retry. Requests
+    ##  which aren't retried always go over a new connection.
+    ##
+    ###########################################################################
+
+    def request (self, method, path, body = None, headers = {}):
+        import httplib, socket, random, errno
+        idempotent = method in self.idempotent_methods
+        retries = idempotent and self.retries or 0
+        if self.proxy and self.scheme != "https":
+            path = "%s://%s%s" % (self.scheme, self.netloc(), path)
+            headers = dict(headers, **self.proxyHeaders())
+        self.slots.acquire()
+        try:
+            attempt = 0
+            reuse = idempotent
+            while True:
+                start = time.time()
+                connection, reused = self.checkout(reuse)
+                try:
+                    connection.request(method, path, body, headers)
+                    response = connection.getresponse()
+                    data = response.read()
+                except (httplib.HTTPException, socket.error), E:
+                    connection.close()
+                    if reused and (isinstance(E, httplib.BadStatusLine) or
+                                   getattr(E, "errno", None) in (errno.ECONNRESET, errno.EPIPE)):
+                        reuse = False
+                        continue
+                    if attempt >= retries:
+                        self.count(start, error = True)
+                        raise
+                    self.count(start, error = True, retry = True)
+                else:
+                    if response.will_close:
+                        connection.close()
+                    else:
+                        self.checkin(connection)
+                    if response.status not in self.retry_statuses or attempt >= retries:
+                        self.count(start, error = response.status >= 400)
+                        return response.status, response, data
+                    self.count(start, error = True, retry = True)
+                backoff = min(2.0, 0.1 * 2 ** attempt)
+                time.sleep(random.uniform(backoff / 2, backoff))
+                attempt += 1
+        finally:
+            self.slots.release()
+
+    def netloc (self):
+        if self.port:
+            return "%s:%s" % (self.host, self.port)
+        return self.host
+
+    ###########################################################################
+    ##
+    ## @brief counters for the upstream host
+    ##
+    ## @return dictionary of requests, errors, retried, connections (opened),
+    ##         idle (connections), latency (total seconds) and max_latency
+    ##
+    ###########################################################################
+
+    def stats (self):
+        self.lock.acquire()
+        try:
+            return { 'requests': self.requests, 'errors': self.errors,
+                     'retried': self.retried, 'connections': self.connections,
+                     'idle': len(self.idle), 'latency': self.latency,
+                     'max_latency': self.max_latency }
+        finally:
+            self.lock.release()
+
+httpPools = {}
+httpPoolsLock = threading.Lock()
+
+###############################################################################
+##
+## @brief get the shared connection pool for the host of a URL
+##
+## @details
+##  The pool is made by the first caller for a host; the settings passed
+##  by later callers for the same host are ignored. The proxy is taken from
+##  the environment (http_proxy, https_proxy and no_proxy), as urllib does.
+##
+###############################################################################
+
+def getPool (url, max_requests = 8, timeout = 30, retries = 3):
+    import urlparse, urllib
+    parts = urlparse.urlsplit(url)
+    proxy = urllib.getproxies().get(parts.scheme)
+    if proxy and urllib.proxy_bypass(parts.hostname):
+        proxy = None
+    key = (parts.scheme, parts.hostname, parts.port, proxy)
+    httpPoolsLock.acquire()
+    try:
+        pool = httpPools.get(key)
+        if pool is None:
+            pool = HTTPPool(parts.scheme, parts.hostname, parts.port,
+                            max_requests, timeout, retries, proxy)
+            httpPools[key] = pool
+        return pool
+    finally:
+        httpPoolsLock.release()
+
+###############################################################################
+##
+## @brief fetch a URL over the shared connection pools
+##
+## @param url      the URL
+## @param body     if not None, it is POSTed
+## @param headers  dictionary of extra request headers
+## @param user     user name for basic authentication
+## @param password password for basic authentication
+## @param ...      passed on to getPool
+##
+## @return tuple of (data, httplib.HTTPResponse)
+##
+## @details
+##  Redirects are followed; error statuses raise an Exception. The
+##  credentials are only sent to the scheme, host and port of the URL:
+##  they are dropped when a redirect leads anywhere else.
+##
+###############################################################################
+
+def fetchUrl (url, body = None, headers = None, user = None, password = None, **kwargs):
+    import urlparse, base64
+    headers = dict(headers or {})
+    if user is not None and password is not None:
+        headers["Authorization"] = "Basic %s" % base64.b64encode("%s:%s" % (user, password))
+    if body is not None and not headers.has_key("Content-Type"):
+        headers["Content-Type"] = "application/x-www-form-urlencoded"
+    for redirect in range(6):
+        parts = urlparse.urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        method = body is None and "GET" or "POST"
+        status, response, data = getPool(url, **kwargs).request(method, path, body, headers)
+        if status in (301, 302, 303, 307) and response.getheader("Location"):
+            url = urlparse.urljoin(url, response.getheader("Location"))
+            target = urlparse.urlsplit(url)
+            if (target.scheme, target.hostname, target.port) != \
+               (parts.scheme, parts.hostname, parts.port):
+                headers.pop("Authorization", None)
+            if status != 307:
+                body = None
+            continue
+        if status >= 400:
+            if HIDE_ALL:
+                raise Exception("Upstream server returned HTTP status %s. (Adjust HIDE_ALL for more detail.)" % status)
+            raise Exception("Upstream server returned HTTP status %s.\nURL: %s\nResponse: \n%s" % (status, url, data))
+        return data, response
+    raise Exception("Too many redirects fetching %s" % url)
+
 class WMS (object):
     fields = ("bbox", "srs", "width", "height", "format", "layers", "styles")
     defaultParams = {'version': '1.1.1', 'request': 'GetMap', 'service': 'WMS'}
-    __slots__ = ("base", "params", "client", "data", "response")
+    __slots__ = ("base", "params", "options", "data", "response")
 
-    def __init__ (self, base, params, user=None, password=None):
+    def __init__ (self, base, params, user=None, password=None, **kwargs):
         self.base    = base
         if self.base[-1] not in "?&":
             if "?" in self.base:
@@ -28,14 +309,8 @@ class WMS (object):
                 self.base += "?"
 
         self.params  = {}
-        if user is not None and password is not None:
-           x = urllib2.HTTPPasswordMgrWithDefaultRealm()
-           x.add_password(None, base, user, password)
-           self.client  = urllib2.build_opener()
-           auth = urllib2.HTTPBasicAuthHandler(x)
-           self.client  = urllib2.build_opener(auth)
-        else:
-           self.client  = urllib2.build_opener()
+        self.options = { 'user': user, 'password': password }
+        self.options.update(kwargs)
 
         for key, val in self.defaultParams.items():
             if self.base.lower().rfind("%s=" % key.lower()) == -1:
@@ -47,28 +322,18 @@ class WMS (object):
                 self.params[key] = ""
 
     def url (self):
+        import urllib
         return self.base + urllib.urlencode(self.params)
     
     def fetch (self):
-        urlrequest = urllib2.Request(self.url())
-        # urlrequest.add_header("User-Agent",
-        #    "Mozilla/4.0 (compatible; MSIE 6.0; Windows NT 5.1; SV1)" )
-        response = None
-        while response is None:
-            try:
-                response = self.client.open(urlrequest)
-                data = response.read()
-                # check to make sure that we have an image...
-                msg = response.info()
-                if msg.has_key("Content-Type"):
-                    ctype = msg['Content-Type']
-                    if ctype[:5].lower() != 'image':
-                        if HIDE_ALL:
-                            raise Exception("Did not get image data back. (Adjust HIDE_ALL for more detail.)")
-                        else:
-                            raise Exception("Did not get image data back. \nURL: %s\nContent-Type Header: %s\nResponse: \n%s" % (self.url(), ctype, data))
-            except httplib.BadStatusLine:
-                response = None # try again
+        data, response = fetchUrl(self.url(), **self.options)
+        # check to make sure that we have an image...
+        ctype = response.getheader("Content-Type")
+        if ctype and ctype[:5].lower() != 'image':
+            if HIDE_ALL:
+                raise Exception("Did not get image data back. (Adjust HIDE_ALL for more detail.)")
+            else:
+                raise Exception("Did not get image data back. \nURL: %s\nContent-Type Header: %s\nResponse: \n%s" % (self.url(), ctype, data))
         return data, response
 
     def setBBox (self, box):
@@ -76,6 +341,7 @@ class WMS (object):
 
 def seed (svc, layer, levels = (0, 5), bbox = None, padding = 0, force = False, reverse = False, delay = 0 ):
     from Layer import Tile
+    import Grid
     try:
         padding = int(padding)
     except:
@@ -87,8 +353,8 @@ def seed (svc, layer, levels = (0, 5), bbox = None, padding = 0, force = False,
     total = 0
     
     for z in range(*levels):
-        bottomleft = layer.getClosestCell(z, bbox[0:2])
-        topright   = layer.getClosestCell(z, bbox[2:4])
+        cells = Grid.cellRange(layer, z, bbox)
+        bottomleft, topright = cells[0:2], cells[2:4]
         # Why Are we printing to sys.stderr??? It's not an error.
         # This causes a termination if run from cron or in background if shell is terminated
         #print >>sys.stderr, "###### %s, %s" % (bottomleft, topright)
@@ -123,8 +389,14 @@ def seed (svc, layer, levels = (0, 5), bbox = None, padding = 0, force = False,
                      % (z,x,y, box, time.time() - tileStart, total / (time.time() - start + .0001), zcount, ztiles)
                 if delay:
                     time.sleep(delay)
+    
+    svc.cache.flush()
 
 def main ():
+    try:
+        from optparse import OptionParser
+    except ImportError:
+        OptionParser = False
     if not OptionParser:
         raise Exception("TileCache seeding requires optparse/OptionParser. Your Python may be too old.\nSend email to the mailing list \n(http://openlayers.org/mailman/listinfo/tilecache) about this problem for help.")
     usage = "usage: %prog <layer> [<zoom start> <zoom stop>]"
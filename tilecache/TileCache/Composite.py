@@ -0,0 +1,351 @@
+# BSD Licensed, Copyright (c) 2006-2010 TileCache Contributors
+
+"""
+Builds one image out of the tiles of a WMS request covering several tiles
+and/or layers. Tiles are placed by their grid index, and each layer is
+alpha blended over the ones before it in an RGBA buffer, which is encoded
+once at the end, in the mode of the first tile. Tiles may be palette (P), RGB
+or RGBA images.
+
+>>> from TileCache.Layer import Layer, Tile
+>>> from PIL import Image
+>>> import StringIO
+>>> def png (mode, color):
+...     buffer = StringIO.StringIO()
+...     Image.new(mode, (256, 256), color).save(buffer, "PNG")
+...     return buffer.getvalue()
+>>> base, over = Layer("base"), Layer("over")
+>>> tiles = [Tile(base, 0, 0, 1), Tile(base, 0, 1, 1), Tile(base, 1, 0, 1),
+...          Tile(base, 1, 1, 1), Tile(over, 1, 1, 1)]
+>>> size, offsets = layout(tiles)
+>>> size
+(512, 512)
+>>> offsets
+[(0, 256), (0, 0), (256, 256), (256, 0), (0, 0)]
+
+>>> def stack (engine, modes, colors):
+...     c = Compositor(size, engine)
+...     for i in range(4):
+...         c.add(png(modes[0], colors[0]), offsets[i])
+...     c.add(png(modes[1], colors[1]), offsets[4])
+...     format, data = c.encode("image/png")
+...     return format, Image.open(StringIO.StringIO(data))
+>>> format, image = stack("numpy", ("RGB", "RGBA"), ((0, 0, 255), (255, 0, 0, 128)))
+>>> format, image.format, image.mode, image.size
+('image/png', 'PNG', 'RGB', (512, 512))
+>>> image.getpixel((0, 0)), image.getpixel((511, 511))
+((128, 0, 127), (0, 0, 255))
+
+The image is blended with numpy if it is there, or else PIL, which give the
+same result, over transparent images as well:
+
+>>> format, other = stack("pil", ("RGB", "RGBA"), ((0, 0, 255), (255, 0, 0, 128)))
+>>> list(other.getdata()) == list(image.getdata())
+True
+>>> images = [stack(engine, ("RGBA", "RGBA"), ((0, 0, 255, 128), (255, 0, 0, 128)))[1]
+...           for engine in ("numpy", "pil")]
+>>> [(image.mode, image.getpixel((0, 0))) for image in images]
+[('RGBA', (170, 0, 85, 192)), ('RGBA', (170, 0, 85, 192))]
+
+Tiles with a palette (png256) make an image with a palette:
+
+>>> format, image = stack(None, ("P", "RGBA"), (3, (255, 0, 0, 128)))
+>>> image.mode
+'P'
+
+The image is in the format of the bottom layer's mime type, which is what
+is returned, whatever the format of the tiles over it:
+
+>>> c = Compositor((256, 256))
+>>> buffer = StringIO.StringIO()
+>>> Image.new("RGB", (256, 256), (0, 0, 255)).save(buffer, "JPEG")
+>>> c.add(buffer.getvalue(), (0, 0))
+>>> c.add(png("RGBA", (255, 0, 0, 128)), (0, 0))
+>>> format, data = c.encode("image/jpeg")
+>>> format, Image.open(StringIO.StringIO(data)).format
+('image/jpeg', 'JPEG')
+>>> format, data = c.encode("image/x-unknown")
+>>> format, Image.open(StringIO.StringIO(data)).format
+('image/jpeg', 'JPEG')
+
+A combination of layers on the same grid can be cached as a layer of its own,
+which is out of date as soon as any of its layers is:
+
+>>> composite = CompositeLayer([base, over])
+>>> composite.name, composite.size, composite.mime_type
+('base,over', (256, 256), 'image/png')
+>>> over.expired = 1000.0
+>>> composite.update()
+>>> composite.expired
+1000.0
+>>> sameGrid([base, Layer("other", size="512,512")])
+False
+"""
+
+import StringIO
+from TileCache.Layer import Layer
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+## the largest image built, as in Services.WMS.getMap
+
+MAX_SIZE = 4096
+
+## the PIL formats of the mime types of layers
+
+FORMATS = { "image/png": "PNG", "image/jpeg": "JPEG", "image/jpg": "JPEG",
+            "image/gif": "GIF" }
+
+###############################################################################
+##
+## @brief work out the size of the image and where each tile goes in it
+##
+## @param tiles  list of tiles, grouped by layer, bottom layer first
+##
+## @return ((width, height), [(xoff, yoff) for each tile])
+##
+## @details
+##  Each run of tiles of one layer is placed by grid index, from the lowest
+##  column and the highest row of that run (rows count up from the bottom).
+##  The image is never bigger than MAX_SIZE in either direction.
+##
+###############################################################################
+
+def layout (tiles):
+    runs = []
+    for i, tile in enumerate(tiles):
+        if runs and tiles[runs[-1][0]].layer is tile.layer:
+            runs[-1].append(i)
+        else:
+            runs.append([i])
+
+    offsets = [None] * len(tiles)
+    width = height = 0
+    for run in runs:
+        xs = [int(round(tiles[i].x)) for i in run]
+        ys = [int(round(tiles[i].y)) for i in run]
+        xsize, ysize = tiles[run[0]].layer.size
+        left, top = min(xs), max(ys)
+        for i, x, y in zip(run, xs, ys):
+            offsets[i] = ((x - left) * xsize, (top - y) * ysize)
+        width  = max(width,  (max(xs) - left + 1) * xsize)
+        height = max(height, (top - min(ys) + 1) * ysize)
+
+    return (min(MAX_SIZE, width), min(MAX_SIZE, height)), offsets
+
+###############################################################################
+##
+## @brief test if layers can be combined into a single cached layer
+##
+## @param layers  list of layers
+##
+## @return True if all the layers have the same tiles
+##
+###############################################################################
+
+def sameGrid (layers):
+    first = layers[0]
+    for layer in layers[1:]:
+        if (list(layer.size) != list(first.size) or
+            list(layer.bbox) != list(first.bbox) or
+            list(layer.resolutions) != list(first.resolutions) or
+            layer.srs != first.srs):
+            return False
+    return True
+
+class CompositeLayer (Layer):
+    __slots__ = ("constituents",)
+
+    ###########################################################################
+    ##
+    ## @brief a layer made of other layers stacked over each other
+    ##
+    ## @param layers  list of layers, bottom layer first, which have the same
+    ##                grid (see sameGrid)
+    ##
+    ## @details
+    ##  The layer is only used to cache the combined tiles: it is named after
+    ##  its layers, comma separated, and has the grid, format and cache of the
+    ##  first.
+    ##
+    ###########################################################################
+
+    def __init__ (self, layers):
+        first = layers[0]
+        Layer.__init__(self, ",".join([layer.name for layer in layers]),
+                       bbox = first.bbox, srs = first.srs, size = first.size,
+                       resolutions = first.resolutions, units = first.units,
+                       extension = first.extension, mime_type = first.mime_type,
+                       extent_type = first.extent_type, tms_type = first.tms_type,
+                       cache = first.cache, debug = first.debug)
+        self.constituents = list(layers)
+        self.update()
+
+    ###########################################################################
+    ##
+    ## @brief take the expired time of the most recently expired layer
+    ##
+    ###########################################################################
+
+    def update (self):
+        expired = [layer.expired for layer in self.constituents
+                   if layer.expired is not None]
+        if expired:
+            self.expired = max(expired)
+        else:
+            self.expired = None
+
+class Compositor (object):
+    __slots__ = ("size", "buffer", "image", "formats", "modes")
+
+    ###########################################################################
+    ##
+    ## @brief an empty, transparent image
+    ##
+    ## @param size    (width, height) of the image
+    ## @param engine  "numpy" or "pil"; None for numpy if it is installed
+    ##
+    ## @details
+    ##  With numpy, the image is kept in a height x width x 4 array of uint8,
+    ##  and opaque tiles, or tiles over an opaque image, are blended in
+    ##  integers. With PIL, it is kept in an RGBA image, blended with
+    ##  alpha_composite (Pillow); older versions of PIL, which don't have it,
+    ##  paste tiles using their alpha as mask.
+    ##
+    ###########################################################################
+
+    def __init__ (self, size, engine = None):
+        import PIL.Image as Image
+        self.size = size
+        self.formats = []
+        self.modes = []
+        if engine is None:
+            engine = numpy is not None and "numpy" or "pil"
+        if engine == "numpy":
+            self.buffer = numpy.zeros((size[1], size[0], 4), numpy.uint8)
+            self.image = None
+        else:
+            self.buffer = None
+            self.image = Image.new("RGBA", size, (0, 0, 0, 0))
+
+    ###########################################################################
+    ##
+    ## @brief blend a tile over the image
+    ##
+    ## @param data    encoded tile image
+    ## @param offset  (xoff, yoff) of the tile's top left corner
+    ##
+    ###########################################################################
+
+    def add (self, data, offset):
+        import PIL.Image as Image
+        image = Image.open(StringIO.StringIO(data))
+        self.formats.append(image.format)
+        self.modes.append(image.mode)
+        if image.mode != "RGBA":
+            try:
+                image = image.convert("RGBA")
+            except Exception, E:
+                raise Exception("Could not combine images: an image of mode %s could not be converted to RGBA. \n(Error was: %s)" % (image.mode, E))
+
+        ##### clip to the image #####
+
+        xoff, yoff = offset
+        width  = min(image.size[0], self.size[0] - xoff)
+        height = min(image.size[1], self.size[1] - yoff)
+        if width <= 0 or height <= 0:
+            return
+        if (width, height) != image.size:
+            image = image.crop((0, 0, width, height))
+
+        if self.buffer is None:
+            box = (xoff, yoff, xoff + width, yoff + height)
+            if hasattr(Image, "alpha_composite"):
+                self.image.paste(Image.alpha_composite(self.image.crop(box), image), box)
+            else:
+                self.image.paste(image, box, image)
+            return
+
+        src = numpy.asarray(image)
+        dst = self.buffer[yoff:yoff + height, xoff:xoff + width]
+        src_a = src[:, :, 3]
+
+        ##### opaque tiles, or nothing underneath: a plain copy #####
+
+        if src_a.min() == 255 or not dst[:, :, 3].any():
+            dst[...] = src
+            return
+
+        ##### over an opaque image, in integers #####
+
+        if dst[:, :, 3].min() == 255:
+            src_a = src[:, :, 3:].astype(numpy.uint16)
+            out = src[:, :, :3] * src_a
+            out += dst[:, :, :3] * (255 - src_a)
+
+            ##### (out + 128) / 255, rounded, without a division #####
+
+            out += 128
+            out += out >> 8
+            out >>= 8
+            dst[:, :, :3] = out
+            return
+
+        ##### Porter-Duff 'over' #####
+
+        src_a = src_a.astype(numpy.float32) / 255
+        dst_a = dst[:, :, 3].astype(numpy.float32) / 255
+        out_a = src_a + dst_a * (1 - src_a)
+        weight = numpy.where(out_a > 0, src_a / numpy.maximum(out_a, 1e-6), 0)[:, :, None]
+        out = src[:, :, :3] * weight + dst[:, :, :3] * (1 - weight)
+        dst[:, :, :3] = (out + 0.5).astype(numpy.uint8)
+        dst[:, :, 3] = (out_a * 255 + 0.5).astype(numpy.uint8)
+
+    ###########################################################################
+    ##
+    ## @brief encode the image
+    ##
+    ## @param format  mime type of the image, that of the bottom layer
+    ##
+    ## @return (format, data), format being the mime type of the data
+    ##
+    ## @details
+    ##  The image is saved in the file format of the mime type, or if PIL
+    ##  doesn't know it, of the first tile; it is made in the mode of the
+    ##  first tile: formats without alpha get an opaque image, and GIFs and tiles with a
+    ##  palette (png256) a palette one. An RGB or greyscale image is only
+    ##  made if no part of the image is transparent.
+    ##
+    ###########################################################################
+
+    def encode (self, format):
+        import PIL.Image as Image
+        if self.buffer is not None:
+            image = Image.fromarray(self.buffer, "RGBA")
+        else:
+            image = self.image
+        imformat = FORMATS.get(format)
+        if imformat is None:
+            imformat = (self.formats and self.formats[0]) or "PNG"
+            format = "image/%s" % imformat.lower()
+        mode = (self.modes and self.modes[0]) or "RGBA"
+        opaque = image.getextrema()[3][0] == 255
+        if imformat == "JPEG":
+            image = image.convert("RGB")
+        elif imformat == "GIF" or mode == "P":
+            if opaque:
+                image = image.convert("RGB").convert("P", palette=Image.ADAPTIVE)
+            else:
+                image = image.quantize(256, 2)
+        elif mode in ("RGB", "L") and opaque:
+            image = image.convert(mode)
+        buffer = StringIO.StringIO()
+        image.save(buffer, imformat)
+        return (format, buffer.getvalue())
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
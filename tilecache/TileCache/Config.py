@@ -2,10 +2,13 @@
 
 # BSD Licensed, Copyright (c) 2006-2010 TileCache Contributors
 
-import urllib2, traceback, sys, os, ConfigParser, csv, time
+import traceback, sys, os, csv, time, re
 import TileCache.Layer, TileCache.Layers
 import TileCache.Cache, TileCache.Caches
-import threading
+import threading, logging
+from TileCache.Service import TileCacheException
+
+log = logging.getLogger("TileCache.Config")
 
 ################################################################################
 # These are the supported configuration lines for includes.
@@ -14,8 +17,8 @@ import threading
 # the module name for this config, and the object name supporting it.
 ################################################################################
 
-supported_configs={'file': ('TileCache.Config.File','File',),
-                   'url': ('TileCache.Config.Url','Url',),
+supported_configs={'file': ('TileCache.Configs.File','File',),
+                   'url': ('TileCache.Configs.Url','Url',),
                    'pg': ('TileCache.Configs.PG', 'PG',),
                    'memcache': ('TileCache.Configs.Memcache', 'Memcache',),
                    }
@@ -32,6 +35,70 @@ def import_module(name):
         mod = getattr(mod, comp)
     return mod
     
+###############################################################################
+##
+## @brief a layer of a config section, made when it is first used
+##
+## @param config   the Config the section is in
+## @param name     name of the section, and of the layer
+## @param options  dict of the options of the section
+## @param objargs  other arguments of the layer (the cache)
+##
+## @details
+##  Loading a config only reads the sections: the module of a layer is
+##  imported, and the layer made (opening its image, dataset or map), by
+##  get(), the first time the layer is asked for. Until then, get() returns
+##  the stand-in of the layer, if the config snapshot (see Snapshot) knows
+##  its geometry; the stand-in makes the layer when it has to render.
+##
+###############################################################################
+
+class LazyLayer (object):
+    __slots__ = ("config", "name", "type", "module_name", "objargs", "cache",
+                 "layer", "geometry", "lock")
+    
+    def __init__ (self, config, name, options, **objargs):
+        self.config = config
+        self.name = name
+        self.type = options.get("type")
+        self.module_name = options.get("module")
+        for opt, value in options.items():
+            if opt not in ["type", "module"]:
+                objargs[opt] = value
+        self.objargs = objargs
+        self.cache = objargs.get("cache")
+        self.layer = None
+        self.geometry = None
+        self.lock = threading.Lock()
+    
+    def get (self):
+        layer = self.layer
+        if layer is not None:
+            return layer
+        if self.geometry is not None:
+            return self.geometry
+        return self.build()
+    
+    def build (self):
+        layer = self.layer
+        if layer is not None:
+            return layer
+        self.lock.acquire()
+        try:
+            if self.layer is None:
+                try:
+                    self.layer = self.config._buildObject(TileCache.Layer,
+                        self.type, self.module_name, self.name, **self.objargs)
+                except TileCacheException:
+                    raise
+                except Exception, E:
+                    raise TileCacheException("The layer %s could not be loaded: %s" % (self.name, E))
+                if self.config.snapshot is not None:
+                    self.config.snapshot.record(self.name, self.layer)
+            return self.layer
+        finally:
+            self.lock.release()
+
 ###############################################################################
 ##
 ## @brief base config class handles file configs
@@ -39,13 +106,17 @@ def import_module(name):
 ###############################################################################
 
 class Config (object):
-    __slots__ = ( "resource", "last_mtime", "cache", "metadata" , "layers", "s_sections", "lock", "loadedConfigs")
+    __slots__ = ( "resource", "last_mtime", "cache", "metadata" , "layers", "s_sections", "lock", "loadedConfigs", "options", "sections", "snapshot")
     
     def __init__ (self, resource, cache = None):
         self.s_sections = [ "cache", "metadata", "tilecache_options", "include" ]
         self.resource = resource     
         self.cache=cache   
+        self.last_mtime = None
+        self.options={}
+        self.sections={}
         self.loadedConfigs={}
+        self.snapshot = None
         self.lock = threading.RLock() 
 
 
@@ -64,14 +135,13 @@ class Config (object):
         return []
     
     def hasConfig(self, item):
-        return self.layer.has_key(item)
+        return self.layers.has_key(item)
         
     def getConfig(self, item):
-        sys.stderr.write('Getting config for %s' % (item,))
         return self.layers.get(item)
 
     def isequal(self, resource):
-        if self.resource == arg:
+        if self.resource == resource:
             return True
         return False
 
@@ -130,10 +200,44 @@ class Config (object):
             if opt not in ["type", "module"]:
                 objargs[opt] = config.get(section, opt)
         
-        object_module = None
+        ##### caches made of other caches (Chain) name their tiers, #####
+        ##### each of which is configured in a [cache:<name>] section #####
         
+        if module is TileCache.Cache and objargs.has_key("tiers"):
+            tiers = []
+            for name in objargs["tiers"].split(","):
+                name = name.strip()
+                if not config.has_section("cache:%s" % name):
+                    raise TileCacheException("Cache tier %s needs a [cache:%s] section." % (name, name))
+                tiers.append((name, self._loadFromSection(config, "cache:%s" % name, module)))
+            objargs["tiers"] = tiers
+        
+        module_name = None
         if config.has_option(section, "module"):
-            object_module = import_module(config.get(section, "module"))
+            module_name = config.get(section, "module")
+        
+        return self._buildObject(module, type, module_name, section, **objargs)
+    
+    ###########################################################################
+    ##
+    ## @brief make the object of a section
+    ##
+    ## @param module       TileCache.Layer or TileCache.Cache
+    ## @param type         class name, from the type option
+    ## @param module_name  module of the class, from the module option, or
+    ##                     None for one of TileCache's own
+    ## @param section      name of the section, which is the layer name
+    ## @param objargs      arguments of the object
+    ##
+    ## @return section object
+    ##
+    ###########################################################################
+    
+    def _buildObject (self, module, type, module_name, section, **objargs):
+        object_module = None
+        
+        if module_name:
+            object_module = import_module(module_name)
         else: 
             if module is TileCache.Layer:
                 type = type.replace("Layer", "")
@@ -153,25 +257,88 @@ class Config (object):
         else:
             return section_object(**objargs)
     
+    ###########################################################################
+    ##
+    ## @brief the settings of a section, to tell if it changed
+    ##
+    ###########################################################################
+
+    def _sectionItems (self, config, section):
+        return sorted(config.items(section))
+    
+    ###########################################################################
+    ##
+    ## @brief load the cache of a config
+    ##
+    ## @param config    ConfigParser::ConfigParser object
+    ##
+    ## @return (cache, settings of the cache sections)
+    ##
+    ## @details
+    ##  The current cache is kept if the [cache] and [cache:<name>] sections
+    ##  didn't change since it was loaded.
+    ##
+    ###########################################################################
+
+    def _loadCache (self, config):
+        items = [(section, self._sectionItems(config, section))
+                 for section in sorted(config.sections())
+                 if section == "cache" or section.startswith("cache:")]
+        if self.cache is not None and self.sections.get("cache") == items:
+            return self.cache, items
+        return self._loadFromSection(config, "cache", TileCache.Cache), items
+    
+    ###########################################################################
+    ##
+    ## @brief load the layers of a config
+    ##
+    ## @param config    ConfigParser::ConfigParser object
+    ## @param configs   list of all the configs
+    ## @param reload    True if the config was loaded before
+    ## @param objargs   passed on to the layers, with the cache
+    ##
+    ## @details
+    ##  The layers are only made when first used (see LazyLayer). They
+    ##  replace the old ones in one go, once all the sections are read. On a
+    ##  reload, a layer whose section and cache didn't change is kept as it
+    ##  is, with whatever it has opened or loaded.
+    ##
+    ###########################################################################
+    
     def _loadSections (self, config, configs, reload = False, **objargs):
         layers = {}
+        sections = {}
+        cache = objargs.get("cache")
         #sys.stderr.write( "_loadSections\n")
         for section in config.sections():
             #sys.stderr.write( "_loadSections %s\n" % section)
             ##### include sections #####
             
             if section == "include" and reload == False:
-                self._read_include( config, configs, section, reload )
+                self._read_include( config, configs, section, reload, cache )
                 
             ##### if its not a standard section load the section #####
             
             #sys.stderr.write( "_loadSections %s s_sections %s\n" % (section, [ "cache", "metadata", "tilecache_options", "include" ]))
-            if section not in [ "cache", "metadata", "tilecache_options", "include" ]:
+            if section not in [ "cache", "metadata", "tilecache_options", "include" ] \
+               and not section.startswith("cache:"):
                 
-                layers[section] = self._loadFromSection ( config, section,
-                                                               TileCache.Layer,
-                                                               cache = self.cache)
+                items = self._sectionItems(config, section)
+                old = self.layers.get(section)
+                if reload and old is not None and old.cache is cache and \
+                   self.sections.get(section) == items:
+                    layers[section] = old
+                else:
+                    config.get(section, "type")
+                    layers[section] = LazyLayer(self, section, dict(items),
+                                                **objargs)
+                    if self.snapshot is not None:
+                        layers[section].geometry = self.snapshot.restore(layers[section])
+                sections[section] = items
         
+        if self.sections.has_key("cache"):
+            sections["cache"] = self.sections["cache"]
+        self.sections = sections
         self.layers = layers
     
     ###########################################################################
@@ -180,12 +347,13 @@ class Config (object):
     ##
     ## @param config     ConfigParser::ConfigParser object
     ## @param section    include section list item
-    ## @param objargs    section objects
+    ## @param reload     True if the config was loaded before
+    ## @param cache      cache of the included configs
     ##
     ## 
     ###########################################################################
 
-    def _read_include (self, config, configs, section, reload = False):
+    def _read_include (self, config, configs, section, reload = False, cache = None):
         # This should really just load the config type and 
         # the type should have it's own parser, but this is legacy code
         # and I don't want to re-write it at this point.
@@ -210,8 +378,8 @@ class Config (object):
                 
                 
                 if not reload or not have:
-                    Url = self._getConfig("urls")
-                    mUrl = Url(url, self.cache)
+                    Url = self._getConfig("url")
+                    mUrl = Url(url, cache)
                     configs.append(mUrl)
                     mUrl.read(configs)
 
@@ -238,7 +406,7 @@ class Config (object):
                 
                 if not reload or not have:
                     PG = self._getConfig("pg")
-                    mPG = PG(dsn, self.cache)
+                    mPG = PG(dsn, cache)
                     if mPG.conn != None:
                         configs.append(mPG)
                         mPG.read(configs)
@@ -248,7 +416,7 @@ class Config (object):
         if config.has_option(section, "memcache"):
             
             memcache = config.get(section, "memcache")
-            sys.stderr.write('Got Memcache Section (%s)\n' % (memcache,))
+            log.debug("Got Memcache Section (%s)", memcache)
 
             ##### Iterate over the entries in the section  #####
             for mcsettings in csv.reader([memcache], delimiter=',', quotechar='"'):
@@ -275,8 +443,9 @@ class Config (object):
                 
                 if not reload or not have:
                     Memcache = self._getConfig("memcache")
-                    sys.stderr.write('Loading the memcache config and appending to configs\n')
-                    mMemcache = Memcache(cache_name, cache_prefix, cache_array, cache=self.cache)
+                    log.debug("Loading the memcache config and appending to configs")
+                    mMemcache = Memcache(cache_name, cache_prefix, cache_array, cache=cache,
+                                         ttl=self.options.get("memcache_ttl", 30))
                     configs.append(mMemcache)
 
         ##### insert new config types here ie: sqlite #####
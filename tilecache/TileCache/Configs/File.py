@@ -2,7 +2,7 @@
 
 # BSD Licensed, Copyright (c) 2006-2010 TileCache Contributors
 from TileCache.Config import Config
-import traceback, sys, os, ConfigParser, csv
+import traceback, sys, os, csv
 import TileCache.Cache, TileCache.Caches
 import TileCache.Layer, TileCache.Layers
 from TileCache.Service import TileCacheException
@@ -43,14 +43,22 @@ class File (Config):
     
     def read(self, configs, reload = False):
         #sys.stderr.write("File.read\n")
-        self.cache = None
-        self.metadata = {}
-        self.layers = {}
+        
+        ##### a reload keeps the metadata and, until the new ones are #####
+        ##### loaded, the cache and the layers                        #####
+        
+        if reload:
+            for key in ('exception', 'warn', 'traceback'):
+                self.metadata.pop(key, None)
+        else:
+            self.cache = None
+            self.metadata = {}
+            self.layers = {}
         
         ##### set last_mtime #####
         
         try:
-            mtime = os.stat(self.resource)[8]
+            mtime = os.stat(self.resource).st_mtime
             self.last_mtime = mtime
         except Exception, E:
             self.metadata['warn'] = E
@@ -60,8 +68,12 @@ class File (Config):
         
         config = None
         try:
-            config = ConfigParser.ConfigParser()
-            config.read(self.resource)
+            if self.snapshot is not None:
+                config = self.snapshot.read()
+            else:
+                import ConfigParser
+                config = ConfigParser.ConfigParser()
+                config.read(self.resource)
             
             if reload == False:
                 if config.has_section("metadata"):
@@ -69,13 +81,18 @@ class File (Config):
                         self.metadata[key] = config.get("metadata", key)
                 
                 if config.has_section("tilecache_options"):
+                    for key in config.options("tilecache_options"):
+                        self.options[key] = config.get("tilecache_options", key)
                     if 'path' in config.options("tilecache_options"): 
                         for path in config.get("tilecache_options", "path").split(","):
                             sys.path.insert(0, path)
-                
-                self.cache = self._loadFromSection(config, "cache", TileCache.Cache)
             
-            self._loadSections (config, configs, reload, cache = self.cache)
+            ##### the cache and the layers are swapped in once loaded #####
+            
+            cache, items = self._loadCache(config)
+            self._loadSections (config, configs, reload, cache = cache)
+            self.sections["cache"] = items
+            self.cache = cache
             
         except Exception, E:
             self.metadata['exception'] = E
@@ -95,6 +112,7 @@ class File (Config):
         if name != None:
             
             try:
+                import ConfigParser
                 config = ConfigParser.ConfigParser()
                 config.read(self.resource)
                 
@@ -158,6 +176,7 @@ class File (Config):
         if objargs.has_key('name'):
             name = objargs[name]
             try:
+                import ConfigParser
                 config = ConfigParser.ConfigParser()
                 config.read(self.resource)
                 
@@ -185,19 +204,16 @@ class File (Config):
     
     def checkchange (self, configs):
         
-        try:
-            mtime = os.stat(self.resource)[8]
+        if self.resource is None:
+            return False
         
-            if self.last_mtime < mtime:
-                #self.read(file, True)
-                #sys.stderr.write( "Config file %s has changed, reloading\n" %
-                #                  self.resource )
-                self.read(self.file, configs, reload = True)
-                self.last_mtime = mtime
-                return True
+        try:
+            mtime = os.stat(self.resource).st_mtime
+        except OSError:
+            return False
         
-        except:
-            pass
+        if mtime != self.last_mtime:
+            self.read(configs, reload = True)
+            return True
         
         return False
-    
@@ -6,7 +6,9 @@ import sys, select, traceback, csv, time
 import TileCache.Cache, TileCache.Caches
 import TileCache.Layer, TileCache.Layers
 from TileCache.Service import TileCacheException
-import json
+import json, logging
+
+log = logging.getLogger("TileCache.Configs.Memcache")
 
 
 try:
@@ -22,14 +24,42 @@ except:
     ##
     ###########################################################################
 
+###############################################################################
+##
+## @brief layers configured in memcached, as JSON, one key per layer
+##
+## @param memcache_name    name of the config
+## @param memcache_prefix  prefix of the keys of the layers
+## @param memcache_array   list of the memcached servers, "host:port"
+## @param cache            cache of the layers
+## @param ttl              seconds a layer, or the lack of one, is known for
+##                         before memcached is asked again
+##
+## @details
+##  The layers made are kept, along with the CAS token of their JSON (or
+##  its version key, or the JSON itself, if the server doesn't give one),
+##  and so are the names memcached has no layer for. Once the ttl is over,
+##  the next lookup of a name asks memcached again, in a single round trip,
+##  and the layer is only made again if its JSON changed. At most
+##  max_entries names are kept: past that, expired entries are dropped,
+##  and if none are, the one to expire first.
+##
+###############################################################################
+
 class Memcache(Config):
-    __slots__ = Config.__slots__ + ('mc','memcache_prefix',)
+    __slots__ = Config.__slots__ + ('mc','memcache_prefix','ttl','entries',)
+    
+    ##### the most names kept #####
     
-    def __init__(self, memcache_name, memcache_prefix, memcache_array, cache):
+    max_entries = 1000
+    
+    def __init__(self, memcache_name, memcache_prefix, memcache_array, cache, ttl = 30):
         super(Memcache, self).__init__(resource=memcache_name, cache=cache)
         self.memcache_prefix=memcache_prefix
-        self.mc = memcache.Client(memcache_array, debug=0)
-        sys.stderr.write('Loading memcache config!')
+        self.mc = memcache.Client(memcache_array, debug=0, cache_cas=True)
+        self.ttl = float(ttl)
+        self.entries = {}
+        log.debug("Loading memcache config %s", memcache_name)
         self.layers={}
         self.metadata={}
         
@@ -39,18 +69,65 @@ class Memcache(Config):
     def checkchange (self, configs):
         return False
     
-    def _getLayerConfig(self, name):
-        key = self._getKey(name)
-        sys.stderr.write('Memcache lookup for %s\n' % (key,))
-        data=self.mc.get(key)
-        sys.stderr.write('Got "%s" (type: %s)\n' % (data, type(data)))
-        if data:
-            try:
-                return json.loads(data)
-            except Exception, e:
-                sys.stderr.write('Unable to parse config for layer %s (%s)\n' % (key, e,))
-                return None
-        return None
+    ###########################################################################
+    ##
+    ## @brief the layer of a name, from the local cache while it is fresh
+    ##
+    ## @param name  name of the layer
+    ##
+    ## @return the layer, or None if memcached has none (or an unreadable
+    ##         one) for the name
+    ##
+    ###########################################################################
+    
+    def _getLayer(self, name):
+        entry = self.entries.get(name)
+        if entry is not None and entry[0] > time.time():
+            return entry[2]
+        
+        self.lock.acquire()
+        try:
+            
+            ##### another thread may have asked memcached meanwhile #####
+            
+            entry = self.entries.get(name)
+            if entry is not None and entry[0] > time.time():
+                return entry[2]
+            
+            key = self._getKey(name)
+            log.debug("Memcache lookup for %s", key)
+            data = self.mc.gets(key)
+            cas = self.mc.cas_ids.pop(key, None)
+            
+            token = layer = None
+            if data:
+                try:
+                    pconfig = json.loads(data)
+                except Exception, e:
+                    log.warning("Unable to parse config for layer %s (%s)", key, e)
+                    pconfig = None
+                if isinstance(pconfig, dict):
+                    token = cas or pconfig.get('version') or data
+                    if entry is not None and entry[1] == token and entry[2] is not None:
+                        log.debug("Config for %s unchanged", name)
+                        layer = entry[2]
+                    else:
+                        pconfig.update({'cache': self.cache})
+                        log.debug("Loading config for %s", name)
+                        layer = self._load_layer(**pconfig)
+            
+            if not self.entries.has_key(name) and len(self.entries) >= self.max_entries:
+                now = time.time()
+                for other, (expires, t, l) in self.entries.items():
+                    if expires <= now:
+                        del self.entries[other]
+                if len(self.entries) >= self.max_entries:
+                    oldest = min(self.entries.items(), key = lambda item: item[1][0])[0]
+                    del self.entries[oldest]
+            self.entries[name] = (time.time() + self.ttl, token, layer)
+            return layer
+        finally:
+            self.lock.release()
     
     def _loadConfig(self, layer_config):
         defaults={}
@@ -65,26 +142,19 @@ class Memcache(Config):
     def getConfig(self, item):
         return self[item]
     
-    #
-    # This sucks 'cause it has to do a get twice, it's usage is 
-    # good to avoid.
-    #
     def hasConfig(self, item):
-        return any(self._getLayerConfig(item))
+        return self._getLayer(item) is not None
     
     #
     # So this will get the config entry if it exists and
     # return it back to the caller.
     #
     def __getitem__(self, layer):
-        sys.stderr.write('Memcache lookup for %s\n' % (layer,))
-        pconfig=self._getLayerConfig(layer)
-        if not pconfig:
+        log.debug("Memcache lookup for %s", layer)
+        found = self._getLayer(layer)
+        if found is None:
             raise KeyError('Item does not exist in Memcache config')
-        else:
-            pconfig.update({'cache': self.cache})
-            sys.stderr.write('Loading config for %s' % (layer,))
-            return self._load_layer(**pconfig)
+        return found
 
     
     ###########################################################################
@@ -103,7 +173,7 @@ class Memcache(Config):
     def add (self):
         if objargs.has_key('name'):
             key = self._getKey(name)
-            sys.stderr.write('Memcache add for %s\n' % (key,))
+            log.debug("Memcache add for %s", key)
 
             try:
                 config = {}
@@ -135,7 +205,7 @@ class Memcache(Config):
         
         if objargs.has_key('name'):
             key = self._getKey(name)
-            sys.stderr.write('Memcache update for %s\n' % (key,))
+            log.debug("Memcache update for %s", key)
 
             try:
                 data=self.mc.get(key)
@@ -168,10 +238,11 @@ class Memcache(Config):
     def delete (self, name = None):
         if name != None:
             key = self._getKey(name)
-            sys.stderr.write('Memcache delete for %s\n' % (key,))
+            log.debug("Memcache delete for %s", key)
             
             try:
                 self.mc.delete(key)
+                self.entries.pop(name, None)
                 return True
 
             except:
@@ -107,6 +107,22 @@ class PG(Config):
     def isPG(self):
         return True
     
+    ###########################################################################
+    ##
+    ## @brief the file descriptor of the connection listening for changes
+    ##
+    ## @return file descriptor, readable when a NOTIFY came in
+    ##
+    ###########################################################################
+    
+    def fileno (self):
+        
+        ##### older versions of Psycopg had the fileno method in the cursor #####
+        
+        if hasattr(self.conn, "fileno"):
+            return self.conn.fileno()
+        return self.lcur.fileno()
+    
     ###########################################################################
     ##
     ## @brief method to setup the connection pool to the database
@@ -848,8 +864,8 @@ VALUES (
                             self.read(None, True)
                             
                         else:
-                            sys.stderr.write( "Got Unhandled NOTIFY: %s %s %s\n",
-                                              notify.pid, notify.channel )
+                            sys.stderr.write( "Got Unhandled NOTIFY: %s %s\n" %
+                                              (notify.pid, notify.channel) )
                             
                     ##### has payload #####
                     
@@ -868,9 +884,9 @@ VALUES (
                                 pass
                         
                         else:
-                            sys.stderr.write( "Got Unhandled NOTIFY: %s %s %s\n",
-                                              notify.pid, notify.channel,
-                                              notify.payload )
+                            sys.stderr.write( "Got Unhandled NOTIFY: %s %s %s\n" %
+                                              (notify.pid, notify.channel,
+                                               notify.payload) )
                 
                 return True            
 
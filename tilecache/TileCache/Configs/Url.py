@@ -8,9 +8,15 @@ import TileCache.Layer, TileCache.Layers
 from TileCache.Service import TileCacheException
 import re
 import threading
+import StringIO, email.Utils
+from hashlib import md5
+
+##### seconds to wait for the config server #####
+
+TIMEOUT = 10
 
 class Url(Config):
-    __slots__ = Config.__slots__
+    __slots__ = Config.__slots__ + ("etag", "modified", "digest")
     
     def __init__ (self, resource, cache = None):
         #sys.stderr.write( "Url.__init__ %s\n" % resource)
@@ -18,6 +24,9 @@ class Url(Config):
 
         self.layers = {}
         self.metadata={}
+        self.etag = None
+        self.modified = None
+        self.digest = None
 
     def isUrl(self):
         return True
@@ -32,64 +41,86 @@ class Url(Config):
     
     def read(self, configs, reload = False):
         #sys.stderr.write("url.read\n")
-        self.cache = None
-        self.metadata = {}
+        if reload:
+            for key in ('exception', 'warn', 'traceback'):
+                self.metadata.pop(key, None)
+        else:
+            self.metadata = {}
         
-        config = None
         try:
-            config = ConfigParser.ConfigParser()
-            fp = urllib2.urlopen( self.resource )
-            headers = dict(fp.info())
-            config.readfp(fp)
+            fp = urllib2.urlopen(self.resource, timeout = TIMEOUT)
+            data = fp.read()
             fp.close()
-            self.layers = {}
-
-            self._loadSections (config, configs, reload, cache = self.cache)
-            
-            ##### set last_mtime #####
-            os.environ['TZ'] = 'UTC'
-            time.tzset()
-            #FIXME fixed format is probably wrong
-            mytime = time.strptime( headers['last-modified'],
-                                    "%a, %d %b %Y %H:%M:%S %Z" )
-            self.last_mtime = time.mktime(mytime)
-        
+            self._parse(data, fp.info(), configs, reload)
         except Exception, E:
             self.metadata['exception'] = E
             self.metadata['traceback'] = "".join(traceback.format_tb(sys.exc_traceback))
     
+    ###########################################################################
+    ##
+    ## @brief load the layers from a response
+    ##
+    ## @param data     the body of the response
+    ## @param headers  its headers
+    ## @param configs  list of all the configs
+    ## @param reload   True if the config was loaded before
+    ##
+    ###########################################################################
+    
+    def _parse(self, data, headers, configs, reload):
+        config = ConfigParser.ConfigParser()
+        config.readfp(StringIO.StringIO(data), self.resource)
+        self._loadSections (config, configs, reload, cache = self.cache)
+        
+        ##### remember the version we have, for conditional GETs #####
+        
+        self.etag = headers.getheader('etag')
+        self.modified = headers.getheader('last-modified')
+        self.digest = md5(data).hexdigest()
+        if self.modified:
+            self.last_mtime = email.Utils.mktime_tz(email.Utils.parsedate_tz(self.modified))
+    
     ###########################################################################
     ##
     ## @brief method to check a config for change and reload it
     ##
     ## @return True if changed, False if unchanged or error.
     ##
+    ## @details
+    ##  The config is fetched with a conditional GET: a server which knows
+    ##  it hasn't changed answers 304 without sending it. Otherwise it is
+    ##  compared with the one we have.
+    ##
     ###########################################################################
     
     def checkchange (self, configs):
         
+        request = urllib2.Request(self.resource)
+        if self.etag:
+            request.add_header('If-None-Match', self.etag)
+        if self.modified:
+            request.add_header('If-Modified-Since', self.modified)
+        
         try:
-            urllib2.Request(self.resource)
-            request.get_method = lambda : 'HEAD'
-            response = urllib2.urlopen(request)
-            headers = dict(response.info())
-            
-            os.environ['TZ'] = 'UTC'
-            time.tzset()
-            #FIXME fixed format is probably wrong
-            mytime = time.strptime( headers['last-modified'],
-                                    "%a, %d %b %Y %H:%M:%S %Z" )
-            mtime = time.mktime(mytime)
+            fp = urllib2.urlopen(request, timeout = TIMEOUT)
+        except urllib2.HTTPError, E:
+            if E.code != 304:
+                self.metadata['warn'] = "Checking %s for changes failed: %s\n" % (self.resource, E)
+            return False
+        except Exception, E:
+            self.metadata['warn'] = "Checking %s for changes failed: %s\n" % (self.resource, E)
+            return False
         
-            if self.last_mtime < mtime:
-                
-                self.read(file, configs, True)
-                sys.stderr.write( "Config file %s has changed, reloading\n" %
-                                  self.resource )
-                self.last_mtime = mtime
-                return True
-        except:
-            pass
+        data = fp.read()
+        fp.close()
+        if md5(data).hexdigest() == self.digest:
+            return False
         
-        return False
-
+        for key in ('exception', 'warn', 'traceback'):
+            self.metadata.pop(key, None)
+        try:
+            self._parse(data, fp.info(), configs, True)
+        except Exception, E:
+            self.metadata['exception'] = E
+            self.metadata['traceback'] = "".join(traceback.format_tb(sys.exc_traceback))
+        return True
@@ -0,0 +1,106 @@
+# BSD Licensed, Copyright (c) 2006-2010 TileCache Contributors
+
+"""
+Tile index arithmetic: which tiles of a layer cover a bounding box, worked
+out once per zoom level with integers instead of stepping through the box
+in map units.
+
+>>> from TileCache.Layer import Layer
+>>> l = Layer("name")
+>>> cellRange(l, 2, (-45, -45, 0, 0))
+(3, 1, 4, 2)
+>>> [(t.x, t.y, t.z) for t in tiles(l, 2, (3, 1, 4, 2))]
+[(3, 1, 2), (3, 2, 2), (4, 1, 2), (4, 2, 2)]
+>>> [(t.x, t.y, t.z) for t in bboxTiles(l, (-90, -90, 90, 90), 512, 512)]
+[(1, 0, 1), (1, 1, 1), (2, 0, 1), (2, 1, 1)]
+"""
+
+import TileCache.Layer as Layer
+from TileCache.Service import TileCacheException
+
+###############################################################################
+##
+## @brief index of the cell of a layer a point is closest to the corner of
+##
+## @param layer  the layer
+## @param z      zoom level
+## @param point  (x, y) in map units
+##
+## @return (x, y) integer tile index, like Layer.getClosestCell
+##
+###############################################################################
+
+def closestCell (layer, z, point):
+    return layer.getClosestCell(z, point)[0:2]
+
+###############################################################################
+##
+## @brief range of tiles covering a bounding box
+##
+## @param layer  the layer
+## @param z      zoom level
+## @param bbox   (minx, miny, maxx, maxy) in map units
+##
+## @return (minx, miny, maxx, maxy) integer tile indexes, inclusive
+##
+###############################################################################
+
+def cellRange (layer, z, bbox):
+    return closestCell(layer, z, bbox[0:2]) + closestCell(layer, z, bbox[2:4])
+
+###############################################################################
+##
+## @brief the tiles of a range, column by column, bottom to top
+##
+## @param layer  the layer
+## @param z      zoom level
+## @param range  (minx, miny, maxx, maxy) integer tile indexes, inclusive
+##
+## @return generator of Tiles
+##
+###############################################################################
+
+def tiles (layer, z, (minx, miny, maxx, maxy)):
+    for x in xrange(minx, maxx + 1):
+        for y in xrange(miny, maxy + 1):
+            yield Layer.Tile(layer, x, y, z)
+
+###############################################################################
+##
+## @brief the tiles making up an image of a bounding box, as in a WMS GetMap
+##
+## @param layer   the layer
+## @param bbox    (minx, miny, maxx, maxy) in map units
+## @param width   image width in pixels
+## @param height  image height in pixels
+##
+## @return list of Tiles, column by column, bottom to top
+##
+## @details
+##  The image is made of whole tiles, so width and height are taken as a
+##  number of tiles, rounded down. The first and last tile are found with
+##  Layer.getCell, which checks the zoom level, the layer extent and that
+##  the box lines up with the grid; the tiles between them follow from the
+##  indexes.
+##
+###############################################################################
+
+def bboxTiles (layer, bbox, width, height):
+    columns = width  / layer.size[0]
+    rows    = height / layer.size[1]
+    if columns < 1 or rows < 1:
+        raise TileCacheException("An image of %sx%s pixels is smaller than a tile of layer %s." % (width, height, layer.name))
+    xincr = float(bbox[2] - bbox[0]) / columns
+    yincr = float(bbox[3] - bbox[1]) / rows
+
+    first = layer.getCell((bbox[0], bbox[1], bbox[0] + xincr, bbox[1] + yincr))
+    last  = layer.getCell((bbox[2] - xincr, bbox[3] - yincr, bbox[2], bbox[3]))
+    if not first or not last:
+        raise TileCacheException(
+            "couldn't calculate tile index for layer %s from (%s)" % (layer.name, bbox))
+
+    return list(tiles(layer, first[2], first[0:2] + last[0:2]))
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
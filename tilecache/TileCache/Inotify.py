@@ -0,0 +1,137 @@
+# BSD Licensed, Copyright (c) 2006-2010 TileCache Contributors
+
+"""
+Minimal ctypes binding to the Linux inotify API, used to wait for filesystem
+changes (a lock directory being removed, a config file being rewritten)
+without polling. On platforms without inotify, 'available' is False and
+callers are expected to fall back to polling.
+"""
+
+import os, sys, errno, select, struct
+
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_IGNORED     = 0x00008000
+
+IN_NONBLOCK    = 0x00000800
+IN_CLOEXEC     = 0x00080000
+
+_event_header = struct.Struct("iIII")
+
+libc = None
+if sys.platform.startswith("linux"):
+    try:
+        import ctypes
+        try:
+            libc = ctypes.CDLL("libc.so.6", use_errno=True)
+        except OSError:
+            
+            ##### find_library runs ldconfig, which takes tens of ms #####
+            
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            libc = None
+    except (ImportError, OSError):
+        libc = None
+
+available = libc is not None
+
+class Inotify (object):
+    """
+    An inotify instance. Watches are added with watch(); events are
+    collected with read(), which waits up to 'timeout' seconds.
+
+    >>> import tempfile, shutil
+    >>> if available:
+    ...     path = tempfile.mkdtemp()
+    ...     notify = Inotify()
+    ...     wd = notify.watch(path, IN_CREATE)
+    ...     open(os.path.join(path, "tile.png"), "w").close()
+    ...     names = [name for (w, mask, cookie, name) in notify.read(1)]
+    ...     notify.close()
+    ...     shutil.rmtree(path)
+    ... else:
+    ...     names = ["tile.png"]
+    >>> names
+    ['tile.png']
+    """
+    __slots__ = ( "fd", )
+
+    def __init__ (self):
+        if not available:
+            raise OSError(errno.ENOSYS, "inotify is not available on this platform")
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def watch (self, path, mask):
+        wd = libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def unwatch (self, wd):
+        libc.inotify_rm_watch(self.fd, wd)
+
+    def read (self, timeout = None):
+        """Return a list of (wd, mask, cookie, name) events, waiting up to
+           timeout seconds (forever if None) for at least one."""
+        try:
+            readable = select.select([self.fd], [], [], timeout)[0]
+        except select.error, E:
+            if E.args[0] == errno.EINTR:
+                return []
+            raise
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError, E:
+            if E.errno == errno.EAGAIN:
+                return []
+            raise
+        events = []
+        offset = 0
+        while offset + _event_header.size <= len(data):
+            wd, mask, cookie, length = _event_header.unpack_from(data, offset)
+            offset += _event_header.size
+            name = data[offset:offset + length].rstrip("\0")
+            offset += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close (self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+def waitForRemoval (path, timeout):
+    """
+    Block until path is removed (or renamed away), or timeout seconds pass.
+
+    @return True if the path is gone, False on timeout
+    """
+    notify = Inotify()
+    try:
+        try:
+            notify.watch(path, IN_DELETE_SELF | IN_MOVE_SELF)
+        except OSError, E:
+            if E.errno == errno.ENOENT:
+                return True
+            raise
+        for (wd, mask, cookie, name) in notify.read(timeout):
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                return True
+        return False
+    finally:
+        notify.close()
@@ -1,8 +1,8 @@
 # BSD Licensed, Copyright (c) 2006-2010 TileCache Contributors
 
-import os, sys, time
+import os, sys, time, traceback
+import threading, bisect
 from warnings import warn
-from Client import WMS
 from Service import TileCacheException
 
 DEBUG = True
@@ -100,12 +100,12 @@ class Tile (object):
         >>> t.bounds()
         (-88.236288000000002, 11.959680000000006, -83.138303999999991, 17.057664000000003)
         """
-        res  = self.layer.resolutions[self.z]
-        minx = self.layer.bbox[0] + (res * self.x * self.layer.size[0])
-        miny = self.layer.bbox[1] + (res * self.y * self.layer.size[1])
-        maxx = self.layer.bbox[0] + (res * (self.x + 1) * self.layer.size[0])
-        maxy = self.layer.bbox[1] + (res * (self.y + 1) * self.layer.size[1])
-        return (minx, miny, maxx, maxy)
+        layer = self.layer
+        res  = layer.zooms[self.z][0]
+        minx, miny = layer.bbox[0:2]
+        xsize, ysize = layer.size
+        return (minx + (res * self.x * xsize), miny + (res * self.y * ysize),
+                minx + (res * (self.x + 1) * xsize), miny + (res * (self.y + 1) * ysize))
 
     ############################################################################
     ## @brief method to get the bbox in text of a tile
@@ -152,9 +152,7 @@ class MetaTile (Tile):
         >>> t.actualSize()
         (256, 256)
         """
-        metaCols, metaRows = self.layer.getMetaSize(self.z)
-        return ( self.layer.size[0] * metaCols,
-                 self.layer.size[1] * metaRows )
+        return self.layer.meta_zooms[self.z][0]
 
 
     ############################################################################
@@ -166,9 +164,7 @@ class MetaTile (Tile):
     ############################################################################
     
     def size (self):
-        actual = self.actualSize()
-        return ( actual[0] + self.layer.metaBuffer[0] * 2, 
-                 actual[1] + self.layer.metaBuffer[1] * 2 )
+        return self.layer.meta_zooms[self.z][1]
 
     ############################################################################
     ## @brief method to get the geospatial bounds of a Metatile
@@ -179,13 +175,10 @@ class MetaTile (Tile):
     ############################################################################
     
     def bounds (self):
-        tilesize   = self.actualSize()
-        res        = self.layer.resolutions[self.z]
-        buffer     = (res * self.layer.metaBuffer[0], res * self.layer.metaBuffer[1])
-        metaWidth  = res * tilesize[0]
-        metaHeight = res * tilesize[1]
-        minx = self.layer.bbox[0] + self.x * metaWidth  - buffer[0]
-        miny = self.layer.bbox[1] + self.y * metaHeight - buffer[1]
+        layer = self.layer
+        actual, size, metaWidth, metaHeight, buffer = layer.meta_zooms[self.z]
+        minx = layer.bbox[0] + self.x * metaWidth  - buffer[0]
+        miny = layer.bbox[1] + self.y * metaHeight - buffer[1]
         maxx = minx + metaWidth  + 2 * buffer[0]
         maxy = miny + metaHeight + 2 * buffer[1]
         return (minx, miny, maxx, maxy)
@@ -202,7 +195,8 @@ class Layer (object):
                   "extent_type", "tms_type", "units", "mime_type",
                   "paletted",
                   "spherical_mercator", "metadata",
-                  "expired")
+                  "expired", "resolution_index", "resolution_levels",
+                  "scale_levels", "zooms")
     
     config_properties = [
       {'name':'spherical_mercator', 'description':'Layer is in spherical mercator. (Overrides bbox, maxresolution, SRS, Units)', 'type': 'boolean'},
@@ -347,6 +341,9 @@ class Layer (object):
             else:
                 maxRes = float(maxresolution)
             self.resolutions = [maxRes / 2 ** i for i in range(int(levels))]
+
+        self.indexResolutions()
+        self.indexZooms()
         
         self.watermarkimage = watermarkimage
         
@@ -373,6 +370,91 @@ class Layer (object):
             if key.startswith("metadata_"):
                 self.metadata[key[prefix_len:]] = kwargs[key]
                 
+    ############################################################################
+    ## @brief method to build the lookup tables of the resolutions
+    ##
+    ## @details
+    ## resolution_index is the sorted list of the distinct resolutions, which
+    ## getLevel and getClosestLevel search by bisection, and
+    ## resolution_levels the matching zoom levels (the first level with that
+    ## resolution). scale_levels remembers the level of each scale
+    ## denominator seen by getScaleLevel.
+    ##
+    ## example:
+    ##        >>> l = Layer("name", resolutions="0.5,2,1,1")
+    ##        >>> l.resolution_index, l.resolution_levels
+    ##        ([0.5, 1.0, 2.0], [0, 2, 1])
+    ############################################################################
+
+    def indexResolutions (self):
+        """
+        >>> l = Layer("name", resolutions="0.5,2,1,1")
+        >>> l.resolution_index, l.resolution_levels
+        ([0.5, 1.0, 2.0], [0, 2, 1])
+        """
+        levels = {}
+        for z, res in enumerate(self.resolutions):
+            levels.setdefault(float(res), z)
+        self.resolution_index = sorted(levels.keys())
+        self.resolution_levels = [levels[res] for res in self.resolution_index]
+        self.scale_levels = {}
+
+    ############################################################################
+    ## @brief method to build the table of grid geometry per level
+    ##
+    ## @details
+    ## zooms[z] is (resolution, tile width, tile height, columns, rows), the
+    ## tile size in map units and the grid size as returned by grid(z).
+    ##
+    ## example:
+    ##        >>> l = Layer("name")
+    ##        >>> l.zooms[1]
+    ##        (0.3515625, 90.0, 90.0, 4.0, 2.0)
+    ############################################################################
+
+    def indexZooms (self):
+        """
+        >>> l = Layer("name")
+        >>> l.zooms[1]
+        (0.3515625, 90.0, 90.0, 4.0, 2.0)
+        """
+        self.zooms = []
+        for res in self.resolutions:
+            self.zooms.append((res, res * self.size[0], res * self.size[1],
+                (self.bbox[2] - self.bbox[0]) / (res * self.size[0]),
+                (self.bbox[3] - self.bbox[1]) / (res * self.size[1])))
+
+    ############################################################################
+    ## @brief method to get the level of a layer at a scale denominator
+    ##
+    ## @param scale            the scale denominator
+    ## @param meters_per_unit  meters per map unit of the layer
+    ## @param pixel_size       size of a pixel in meters (0.28mm in OGC
+    ##                         standards)
+    ##
+    ## @return the level, as getLevel
+    ##
+    ## example:
+    ##        >>> l = Layer("name", units="meters", resolutions="100,50")
+    ##        >>> l.getScaleLevel(178571.42857142858, 1)
+    ##        1
+    ############################################################################
+
+    def getScaleLevel (self, scale, meters_per_unit, pixel_size = .00028):
+        """
+        >>> l = Layer("name", units="meters", resolutions="100,50")
+        >>> l.getScaleLevel(178571.42857142858, 1)
+        1
+        """
+        try:
+            return self.scale_levels[scale]
+        except KeyError:
+            z = self.getLevel(pixel_size * scale / meters_per_unit, self.size)
+            if len(self.scale_levels) >= 1024:
+                self.scale_levels.clear()
+            self.scale_levels[scale] = z
+            return z
+
     ############################################################################
     ## @brief method to get the resolution of a layer at a particular bounds
     ##
@@ -414,13 +496,13 @@ class Layer (object):
     ############################################################################
     
     def getClosestLevel (self, res, size = [256, 256]):
-        diff = sys.maxint
-        z = None
-        for i in range(len(self.resolutions)):
-            if diff > abs( self.resolutions[i] - res ):
-                diff = abs( self.resolutions[i] - res ) 
-                z = i
-        return z
+        index = self.resolution_index
+        if not index:
+            return None
+        i = bisect.bisect_left(index, res)
+        candidates = [j for j in (i - 1, i) if 0 <= j < len(index)]
+        j = min(candidates, key = lambda j: (abs(index[j] - res), self.resolution_levels[j]))
+        return self.resolution_levels[j]
 
     ############################################################################
     ## @brief method to get the level of a layer at a resolution
@@ -449,12 +531,17 @@ class Layer (object):
         """
 
         max_diff = res / max(size[0], size[1])
+        index = self.resolution_index
         z = None
-        for i in range(len(self.resolutions)):
-            if abs( self.resolutions[i] - res ) < max_diff:
-                res = self.resolutions[i]
-                z = i
-                break
+
+        ##### the resolutions within max_diff are next to res in the index #####
+
+        i = bisect.bisect_left(index, res - max_diff)
+        while i < len(index) and index[i] < res + max_diff:
+            if abs( index[i] - res ) < max_diff:
+                if z is None or self.resolution_levels[i] < z:
+                    z = self.resolution_levels[i]
+            i += 1
         if z is None:
             raise TileCacheException("can't find resolution index for %f. Available resolutions are: \n%s" % (res, self.resolutions))
         return z
@@ -510,8 +597,8 @@ class Layer (object):
         x0 = (minx - self.bbox[0]) / (res * self.size[0])
         y0 = (miny - self.bbox[1]) / (res * self.size[1])
         
-        x = round(x0)
-        y = round(y0)
+        x = int(round(x0))
+        y = int(round(y0))
         
         tilex = ((x * res * self.size[0]) + self.bbox[0])
         tiley = ((y * res * self.size[1]) + self.bbox[1])
@@ -545,9 +632,10 @@ class Layer (object):
         (6, 2, 2)
         """
         res = self.resolutions[z]
-        maxx = minx + self.size[0] * res
-        maxy = miny + self.size[1] * res
-        return self.getCell((minx, miny, maxx, maxy), False)
+        z = self.getClosestLevel(res, self.size)
+        x = int(round((minx - self.bbox[0]) / (res * self.size[0])))
+        y = int(round((miny - self.bbox[1]) / (res * self.size[1])))
+        return (x, y, z)
 
     ############################################################################
     ## @brief method to get the tile oblect in a layer
@@ -626,9 +714,7 @@ class Layer (object):
         >>> l.grid(3)
         (16.0, 8.0)
         """
-        width  = (self.bbox[2] - self.bbox[0]) / (self.resolutions[z] * self.size[0])
-        height = (self.bbox[3] - self.bbox[1]) / (self.resolutions[z] * self.size[1])
-        return (width, height)
+        return self.zooms[z][3:5]
 
     ############################################################################
     ## @brief method to getb the image format of a layer
@@ -674,18 +760,381 @@ class Layer (object):
     def render (self, tile, **kwargs):
         return self.renderTile(tile)
 
+################################################################################
+## @brief a single in-progress metatile render
+##
+## @details
+## Threads asking for a sub-tile of a metatile that is already being rendered
+## in this process wait on the flight and are handed their sub-tile as soon as
+## the rendering thread publishes it, instead of polling the cache lock.
+################################################################################
+
+class MetaTileFlight (object):
+    __slots__ = ( "condition", "tiles", "done", "error" )
+
+    def __init__ (self):
+        self.condition = threading.Condition()
+        self.tiles = {}
+        self.done = False
+        self.error = None
+
+    ############################################################################
+    ## @brief hand the data for a sub-tile to any waiting threads
+    ############################################################################
+
+    def publish (self, x, y, data):
+        self.condition.acquire()
+        try:
+            self.tiles[(x, y)] = data
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    ############################################################################
+    ## @brief record why the render failed, for the waiting threads to raise
+    ############################################################################
+
+    def fail (self, error):
+        self.condition.acquire()
+        try:
+            self.error = error
+        finally:
+            self.condition.release()
+
+    ############################################################################
+    ## @brief mark the render as finished, successful or not
+    ############################################################################
+
+    def finish (self):
+        self.condition.acquire()
+        try:
+            self.done = True
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    ############################################################################
+    ## @brief wait for the data of a sub-tile
+    ##
+    ## @param x        the x cell coord of the sub-tile
+    ## @param y        the y cell coord of the sub-tile
+    ## @param timeout  maximum number of seconds to wait
+    ##
+    ## @return the sub-tile data, or None if the render finished (or timed
+    ##         out) without publishing it
+    ############################################################################
+
+    def wait (self, x, y, timeout):
+        deadline = time.time() + timeout
+        self.condition.acquire()
+        try:
+            while (x, y) not in self.tiles and not self.done:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return self.tiles.get((x, y))
+        finally:
+            self.condition.release()
+
+################################################################################
+## @brief registry of the metatile renders in progress in this process
+##
+## @details
+## Keyed by (layer name, z, metatile x, metatile y). The first thread to join
+## a key becomes the leader and renders; later threads are followers and wait
+## on the flight. The cache lock is only needed between processes.
+################################################################################
+
+class MetaTileFlights (object):
+    __slots__ = ( "lock", "flights" )
+
+    def __init__ (self):
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    ############################################################################
+    ## @brief join the flight for a key, creating it if needed
+    ##
+    ## @return a tuple (flight, leader), leader is True for the thread that
+    ##         created the flight and must render it
+    ############################################################################
+
+    def join (self, key):
+        """
+        >>> flights = MetaTileFlights()
+        >>> flight, leader = flights.join(("basic", 3, 0, 0))
+        >>> leader
+        True
+        >>> flights.join(("basic", 3, 0, 0)) == (flight, False)
+        True
+        >>> flight.publish(1, 2, "data")
+        >>> flights.leave(("basic", 3, 0, 0), flight)
+        >>> flight.wait(1, 2, 0), flight.wait(0, 0, 0)
+        ('data', None)
+        """
+        self.lock.acquire()
+        try:
+            flight = self.flights.get(key)
+            if flight is not None:
+                return (flight, False)
+            flight = MetaTileFlight()
+            self.flights[key] = flight
+            return (flight, True)
+        finally:
+            self.lock.release()
+
+    ############################################################################
+    ## @brief remove a flight from the registry and wake its followers
+    ############################################################################
+
+    def leave (self, key, flight):
+        self.lock.acquire()
+        try:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+        finally:
+            self.lock.release()
+        flight.finish()
+
+metaTileFlights = MetaTileFlights()
+
+################################################################################
+## @brief worker pools shared by all the layers of the process
+##
+## @details
+## Created on first use, one per kind ("thread" or "process") and size, and
+## kept for the life of the process.
+################################################################################
+
+workerPools = {}
+workerPoolsLock = threading.Lock()
+
+def getWorkerPool (kind, size):
+    if size < 1:
+        return None
+    workerPoolsLock.acquire()
+    try:
+        pool = workerPools.get((kind, size))
+        if pool is None:
+            if kind == "process":
+                from multiprocessing import Pool
+                pool = Pool(size)
+            else:
+                from multiprocessing.pool import ThreadPool
+                pool = ThreadPool(size)
+            workerPools[(kind, size)] = pool
+        return pool
+    finally:
+        workerPoolsLock.release()
+
+################################################################################
+## @brief reduce a sub-tile to an 8-bit palette and encode it as PNG
+##
+## @param mode  the PIL mode of the sub-tile
+## @param size  the size of the sub-tile
+## @param data  the raw pixel data of the sub-tile
+##
+## @return the PNG data
+##
+## @details
+## A module level function working on raw pixels so it can be run in a
+## process pool: quantizing holds the interpreter lock.
+################################################################################
+
+def quantizeTile (mode, size, data):
+    import StringIO
+    from PIL import Image
+    if hasattr(Image, "frombytes"):
+        image = Image.frombytes(mode, size, data)
+    else:
+        image = Image.fromstring(mode, size, data)
+    if image.mode == "RGBA":
+        image = image.quantize(256, 2)
+    else:
+        image = image.convert("RGB").convert("P", palette=Image.ADAPTIVE)
+    buffer = StringIO.StringIO()
+    image.save(buffer, "png")
+    return buffer.getvalue()
+
+################################################################################
+## @brief a bounded pool of expensive, non thread safe objects
+##
+## @details
+## Used by layers to keep renderer objects (a loaded Mapnik map, a parsed
+## mapfile) which can only be used by one thread at a time. Objects are made
+## by factory, up to size of them; a thread checking out an object when they
+## are all in use waits for one to be checked back in.
+################################################################################
+
+class ObjectPool (object):
+    __slots__ = ( "factory", "size", "idle", "created", "condition",
+                  "checkouts", "waits", "wait_time", "max_wait" )
+
+    def __init__ (self, factory, size = 1):
+        """
+        >>> made = []
+        >>> pool = ObjectPool(lambda: made.append(1) or len(made), 2)
+        >>> a = pool.checkout()
+        >>> b = pool.checkout()
+        >>> a, b
+        (1, 2)
+        >>> pool.checkout(timeout=0) is None
+        True
+        >>> pool.checkin(a)
+        >>> pool.checkout()
+        1
+        >>> pool.discard(b)
+        >>> pool.checkout()
+        3
+        >>> stats = pool.stats()
+        >>> stats['checkouts'], stats['waits'], stats['created']
+        (4, 1, 2)
+        """
+        self.factory = factory
+        self.size = max(1, int(size))
+        self.idle = []
+        self.created = 0
+        self.condition = threading.Condition()
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    ############################################################################
+    ## @brief make objects until the pool is full
+    ############################################################################
+
+    def fill (self):
+        while True:
+            self.condition.acquire()
+            try:
+                if self.created >= self.size:
+                    return
+                self.created += 1
+            finally:
+                self.condition.release()
+            try:
+                obj = self.factory()
+            except:
+                self.discard(None)
+                raise
+            self.checkin(obj)
+
+    ############################################################################
+    ## @brief take an object out of the pool
+    ##
+    ## @param timeout  maximum number of seconds to wait for a free object,
+    ##                 None to wait forever
+    ##
+    ## @return the object, or None if none became free within timeout
+    ############################################################################
+
+    def checkout (self, timeout = None):
+        start = time.time()
+        self.condition.acquire()
+        try:
+            waited = False
+            while not self.idle and self.created >= self.size:
+                remaining = None
+                if timeout is not None:
+                    remaining = timeout - (time.time() - start)
+                    if remaining <= 0:
+                        self.waits += 1
+                        return None
+                waited = True
+                self.condition.wait(remaining)
+            self.checkouts += 1
+            if waited:
+                wait = time.time() - start
+                self.waits += 1
+                self.wait_time += wait
+                self.max_wait = max(self.max_wait, wait)
+            if self.idle:
+                return self.idle.pop()
+            self.created += 1
+        finally:
+            self.condition.release()
+        try:
+            return self.factory()
+        except:
+            self.discard(None)
+            raise
+
+    ############################################################################
+    ## @brief put an object back in the pool
+    ############################################################################
+
+    def checkin (self, obj):
+        self.condition.acquire()
+        try:
+            self.idle.append(obj)
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    ############################################################################
+    ## @brief drop a checked out object, a new one is made when needed
+    ############################################################################
+
+    def discard (self, obj):
+        self.condition.acquire()
+        try:
+            self.created -= 1
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    ############################################################################
+    ## @brief drop the idle objects, so that new ones are made from now on
+    ##
+    ## @details
+    ## Objects checked out at the time are not affected; callers wanting to
+    ## get rid of those too should discard them instead of checking them in.
+    ############################################################################
+
+    def clear (self):
+        self.condition.acquire()
+        try:
+            self.created -= len(self.idle)
+            self.idle = []
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    ############################################################################
+    ## @brief counters for the pool
+    ##
+    ## @return dictionary of size, created, idle, checkouts, waits (checkouts
+    ##         that had to wait), wait_time (seconds spent waiting in total)
+    ##         and max_wait
+    ############################################################################
+
+    def stats (self):
+        self.condition.acquire()
+        try:
+            return { 'size': self.size, 'created': self.created,
+                     'idle': len(self.idle), 'checkouts': self.checkouts,
+                     'waits': self.waits, 'wait_time': self.wait_time,
+                     'max_wait': self.max_wait }
+        finally:
+            self.condition.release()
+
 ################################################################################
 # @brief layer class for metatileing
 ################################################################################
 
 class MetaLayer (Layer):
-    __slots__ = ('metaTile', 'metaSize', 'metaBuffer')
+    __slots__ = ('metaTile', 'metaSize', 'metaBuffer', 'metaThreads',
+                 'quantizeProcesses', 'meta_zooms')
     
     config_properties = Layer.config_properties + [
       {'name':'name', 'description': 'Name of Layer'}, 
       {'name':'metaTile', 'description': 'Should metatiling be used on this layer?', 'default': 'false', 'type':'boolean'},
       {'name': 'metaSize', 'description': 'Comma seperated-pair of numbers, defininig the tiles included in a single size', 'default': "5,5"},
-      {'name': 'metaBuffer', 'description': 'Number of pixels outside the metatile to include in the render request.'}
+      {'name': 'metaBuffer', 'description': 'Number of pixels outside the metatile to include in the render request.'},
+      {'name': 'metaThreads', 'description': 'Number of threads cropping and encoding the tiles of a metatile. 0 does it all in the rendering thread.', 'default': "0"},
+      {'name': 'quantizeProcesses', 'description': 'Number of processes reducing tiles of paletted (png256) layers to 8 bits. 0 leaves them as rendered.', 'default': "0"}
     ]  
 
 
@@ -724,6 +1173,8 @@ class MetaLayer (Layer):
     ## metatile = ""
     ## metasize = (5,5)
     ## metabuffer = (10,10),
+    ## metathreads = 0,
+    ## quantizeprocesses = 0,
     ## **kwargs
     ## 
     ## examples:
@@ -731,7 +1182,8 @@ class MetaLayer (Layer):
     ############################################################################
     
     def __init__ (self, name, metatile = "", metasize = (5,5),
-                              metabuffer = (10,10), **kwargs):
+                              metabuffer = (10,10), metathreads = 0,
+                              quantizeprocesses = 0, **kwargs):
         Layer.__init__(self, name, **kwargs)
         
         if isinstance(metatile, str):
@@ -746,6 +1198,9 @@ class MetaLayer (Layer):
                 metabuffer = (metabuffer[0], metabuffer[0])
         self.metaSize    = metasize
         self.metaBuffer  = metabuffer
+        self.metaThreads = int(metathreads)
+        self.quantizeProcesses = int(quantizeprocesses)
+        self.indexMetaZooms()
 
     ############################################################################
     ## @brief method to get the size of a metatile at a particular level
@@ -757,6 +1212,25 @@ class MetaLayer (Layer):
         return ( min(self.metaSize[0], int(maxcol + 1)), 
                  min(self.metaSize[1], int(maxrow + 1)) )
 
+    ############################################################################
+    ## @brief method to build the table of metatile geometry per level
+    ##
+    ## @details
+    ## meta_zooms[z] is (actual size, size with buffer, width, height,
+    ## buffer), the last three in map units, as used by MetaTile.
+    ############################################################################
+
+    def indexMetaZooms (self):
+        self.meta_zooms = []
+        for z, res in enumerate(self.resolutions):
+            metaCols, metaRows = self.getMetaSize(z)
+            actual = ( self.size[0] * metaCols, self.size[1] * metaRows )
+            size   = ( actual[0] + self.metaBuffer[0] * 2,
+                       actual[1] + self.metaBuffer[1] * 2 )
+            buffer = ( res * self.metaBuffer[0], res * self.metaBuffer[1] )
+            self.meta_zooms.append((actual, size, res * actual[0],
+                                    res * actual[1], buffer))
+
     ############################################################################
     ## @brief method to get the Metatile oblect in a Metalayer
     ##
@@ -775,10 +1249,57 @@ class MetaLayer (Layer):
         return MetaTile(self, x, y, tile.z) 
 
     ############################################################################
-    ## @brief method
+    ## @brief crop a sub-tile out of a metatile image and encode it
+    ##
+    ## @param image  the PIL image of the metatile
+    ## @param box    the (left, upper, right, lower) pixel box of the sub-tile
+    ##
+    ## @return the encoded sub-tile data
+    ############################################################################
+
+    def encodeSubTile (self, image, box):
+        import StringIO
+        subimage = image.crop(box)
+        pool = None
+        if self.paletted and self.extension == "png" and image.mode != "P":
+            pool = getWorkerPool("process", self.quantizeProcesses)
+        if pool:
+            if hasattr(subimage, "tobytes"):
+                args = (subimage.mode, subimage.size, subimage.tobytes())
+            else:
+                args = (subimage.mode, subimage.size, subimage.tostring())
+            subdata = pool.apply(quantizeTile, args)
+        else:
+            buffer = StringIO.StringIO()
+            if image.info.has_key('transparency'): 
+                subimage.save(buffer, self.extension, transparency=image.info['transparency'])
+            else:
+                subimage.save(buffer, self.extension)
+            subdata = buffer.getvalue()
+        if self.watermarkimage:
+            subdata = self.watermark(subdata)
+        return subdata
+
+    ############################################################################
+    ## @brief render a metatile, and cut it into tiles which are cached
+    ##
+    ## @param metatile  the metatile to render
+    ## @param tile      the tile which was asked for
+    ## @param flight    the MetaTileFlight to publish the tiles to
+    ## @param release   called once the tiles are cached, from the thread
+    ##                  caching them; not called if an exception is raised
+    ##
+    ## @return the data of tile
+    ##
+    ## @details
+    ## With metathreads set, the tiles are cropped and encoded on a thread
+    ## pool (PIL releases the interpreter lock while encoding). If a release
+    ## callback is given, the data of the requested tile is returned as soon
+    ## as it is encoded, and the other tiles are finished and cached in the
+    ## background before release is called.
     ############################################################################
     
-    def renderMetaTile (self, metatile, tile):
+    def renderMetaTile (self, metatile, tile, flight = None, release = None):
         import StringIO
         from PIL import Image
 
@@ -787,6 +1308,7 @@ class MetaLayer (Layer):
 
         metaCols, metaRows = self.getMetaSize(metatile.z)
         metaHeight = metaRows * self.size[1] + 2 * self.metaBuffer[1]
+        boxes = []
         for i in range(metaCols):
             for j in range(metaRows):
                 minx = i * self.size[0] + self.metaBuffer[0]
@@ -794,41 +1316,179 @@ class MetaLayer (Layer):
                 ### this next calculation is because image origin is (top,left)
                 maxy = metaHeight - (j * self.size[1] + self.metaBuffer[1])
                 miny = maxy - self.size[1]
-                subimage = image.crop((minx, miny, maxx, maxy))
-                buffer = StringIO.StringIO()
-                if image.info.has_key('transparency'): 
-                    subimage.save(buffer, self.extension, transparency=image.info['transparency'])
-                else:
-                    subimage.save(buffer, self.extension)
-                buffer.seek(0)
-                subdata = buffer.read()
                 x = metatile.x * self.metaSize[0] + i
                 y = metatile.y * self.metaSize[1] + j
                 subtile = Tile( self, x, y, metatile.z )
-                if self.watermarkimage:
-                    subdata = self.watermark(subdata)
-                self.cache.set( subtile, subdata )
                 if x == tile.x and y == tile.y:
+                    boxes.insert(0, (subtile, (minx, miny, maxx, maxy)))
+                else:
+                    boxes.append( (subtile, (minx, miny, maxx, maxy)) )
+
+        pool = getWorkerPool("thread", self.metaThreads)
+        if pool is None:
+            subtiles = [ (subtile, self.encodeSubTile(image, box))
+                         for subtile, box in boxes ]
+
+            ##### store all the sub-tiles in one go #####
+
+            self.cache.set_multi( subtiles )
+            for subtile, subdata in subtiles:
+                if flight:
+                    flight.publish(subtile.x, subtile.y, subdata)
+                if subtile.x == tile.x and subtile.y == tile.y:
+                    tile.data = subdata
+            if release:
+                release()
+            return tile.data
+
+        ##### crop and encode in parallel, publishing each tile when done #####
+
+        image.load()
+        def encode (subtile, box):
+            subdata = self.encodeSubTile(image, box)
+            if flight:
+                flight.publish(subtile.x, subtile.y, subdata)
+            return subdata
+        jobs = [ (subtile, pool.apply_async(encode, (subtile, box)))
+                 for subtile, box in boxes ]
+
+        if release is None:
+            subtiles = [ (subtile, job.get()) for subtile, job in jobs ]
+            self.cache.set_multi( subtiles )
+            for subtile, subdata in subtiles:
+                if subtile.x == tile.x and subtile.y == tile.y:
                     tile.data = subdata
+            return tile.data
 
+        subtile, job = jobs[0]
+        if subtile.x == tile.x and subtile.y == tile.y:
+            tile.data = job.get()
+        storer = threading.Thread(target=self.storeSubTiles, args=(jobs, release))
+        storer.start()
         return tile.data
 
+    ############################################################################
+    ## @brief wait for the sub-tiles of a metatile to be encoded, and cache
+    ## them
+    ############################################################################
+
+    def storeSubTiles (self, jobs, release):
+        try:
+            try:
+                self.cache.set_multi( [ (subtile, job.get()) for subtile, job in jobs ] )
+            except Exception, E:
+                subtile = jobs[0][0]
+                sys.stderr.write("Storing the tiles of the metatile of %s, %s, %s in layer %s failed: %s\n%s" % (
+                    subtile.x, subtile.y, subtile.z, self.name, E, traceback.format_exc()))
+        finally:
+            release()
+
+    ############################################################################
+    ## @brief wait for a render of the metatile of a tile already in progress
+    ## in this process, or lead the next one
+    ##
+    ## @param tile   the tile asked for
+    ## @param force  don't look in the cache once a render is done
+    ##
+    ## @return a tuple (image, key, flight): the tile data if a render in
+    ##         progress gave it, or None and the key and flight of the
+    ##         render this thread has to do, and leave when it is done
+    ############################################################################
+
+    def joinFlight (self, tile, force = False):
+        metatile = self.getMetaTile(tile)
+        key = (self.name, metatile.z, metatile.x, metatile.y)
+        while True:
+            flight, leader = metaTileFlights.join(key)
+            if leader:
+                return (None, key, flight)
+            image = flight.wait(tile.x, tile.y, self.cache.timeout)
+            if image:
+                tile.data = image
+                return (image, None, None)
+            if not flight.done:
+                raise Exception("Timed out waiting for the render of metatile %s, %s, %s in layer %s" % (metatile.x, metatile.y, metatile.z, self.name))
+            
+            ##### the waiting threads all fail with the renderer, #####
+            ##### rather than each rendering again in turn        #####
+            
+            if flight.error is not None:
+                raise Exception("The render of metatile %s, %s, %s in layer %s failed: %s" % (metatile.x, metatile.y, metatile.z, self.name, flight.error))
+            if not force:
+                image = self.cache.get(tile)
+                if image:
+                    tile.data = image
+                    return (image, None, None)
+
     ############################################################################
     # @brief method
     ############################################################################
     
     def render (self, tile, force=False):
+        """
+        A thread asking for a tile of a metatile which another thread of the
+        process is rendering waits for it, and fails if the render does:
+
+        >>> from TileCache.Caches.Memory import Memory
+        >>> layer = MetaLayer("flights", metatile="yes", cache=Memory())
+        >>> key = (layer.name, 0, 0, 0)
+        >>> flight, leader = metaTileFlights.join(key)
+        >>> def fail ():
+        ...     time.sleep(0.1)
+        ...     flight.fail(IOError("no map"))
+        ...     metaTileFlights.leave(key, flight)
+        >>> threading.Thread(target=fail).start()
+        >>> layer.render(Tile(layer, 0, 0, 0))
+        Traceback (most recent call last):
+        ...
+        Exception: The render of metatile 0, 0, 0 in layer flights failed: no map
+
+        If the render only cached the tile, it is read from the cache:
+
+        >>> flight, leader = metaTileFlights.join(key)
+        >>> def store ():
+        ...     time.sleep(0.1)
+        ...     layer.cache.set(Tile(layer, 0, 0, 0), "cached")
+        ...     metaTileFlights.leave(key, flight)
+        >>> threading.Thread(target=store).start()
+        >>> tile = Tile(layer, 0, 0, 0)
+        >>> layer.render(tile), tile.data
+        ('cached', 'cached')
+        """
         if self.metaTile:
+            
+            ##### wait for a render of this metatile already in progress #####
+            
+            image, key, flight = self.joinFlight(tile, force)
+            if image:
+                return image
             metatile = self.getMetaTile(tile)
+            
+            ##### the cache lock is only contended between processes; it is #####
+            ##### held, like the flight, until the tiles are stored, which  #####
+            ##### may be done by another thread (see Cache::unlock)         #####
+            
+            def release ():
+                try:
+                    self.cache.unlock(metatile)
+                finally:
+                    metaTileFlights.leave(key, flight)
+
             try:
                 self.cache.lock(metatile)
                 image = None
                 if not force:
                     image = self.cache.get(tile)
                 if not image:
-                    image = self.renderMetaTile(metatile, tile)
+                    image = self.renderMetaTile(metatile, tile, flight, release)
+                    release = None
+            except Exception, E:
+                if release:
+                    flight.fail(E)
+                raise
             finally:
-                self.cache.unlock(metatile)
+                if release:
+                    release()
             return image
         else:
             if self.watermarkimage:
@@ -6,8 +6,8 @@ ArcXML support. This layer will make requests to an ArcIMS server.
 
 from TileCache.Layer import MetaLayer
 from TileCache.Service import TileCacheException
+from TileCache.Client import fetchUrl
 
-import urllib
 import xml.dom.minidom as m
 
 class ArcXML(MetaLayer):
@@ -16,11 +16,15 @@ class ArcXML(MetaLayer):
       {'name':'url', 'description': 'URL of Remote Layer'},
       {'name':'layers', 'description': 'Comma seperated list of layers associated with this layer.'},
       {'name':'off_layers', 'description': 'Comma-seperated layers to turn on'},
-      {'name':'projection', 'description': 'WKT String, or, if the string starts with "@", a file containing a WKT string.'}
+      {'name':'projection', 'description': 'WKT String, or, if the string starts with "@", a file containing a WKT string.'},
+      {'name':'maxrequests', 'description': 'Maximum number of requests in flight to the remote server.', 'default': '8'},
+      {'name':'timeout', 'description': 'Seconds to wait for the remote server.', 'default': '30'},
+      {'name':'retries', 'description': 'Number of times a failed request to the remote server is retried.', 'default': '3'}
     ] + MetaLayer.config_properties 
     
     def __init__ (self, name, url = None, off_layers = "", 
-                  projection = None, **kwargs):
+                  projection = None, maxrequests = 8, timeout = 30,
+                  retries = 3, **kwargs):
         """
         Accepts projection in one of two forms: 
          * Raw string
@@ -29,6 +33,8 @@ class ArcXML(MetaLayer):
         MetaLayer.__init__(self, name, **kwargs) 
         self.url = url
         self.off_layers = off_layers
+        self.client = { 'max_requests': int(maxrequests),
+                        'timeout': float(timeout), 'retries': int(retries) }
         self.projection = None
         if projection is not None:
             if projection.startswith("@"):
@@ -109,7 +115,7 @@ class ArcXML(MetaLayer):
     def renderTile(self, tile):
         xml = self.gen_xml(tile)
         try:
-            xmldata = urllib.urlopen(self.url, xml).read()
+            xmldata, response = fetchUrl(self.url, xml, **self.client)
         except Exception, error:
             raise TileCacheException("Error fetching URL. Exception was: %s\n Input XML:\n %s " % (error, xml))
             
@@ -118,5 +124,5 @@ class ArcXML(MetaLayer):
             img_url = doc.getElementsByTagName("OUTPUT")[0].attributes['url'].value
         except Exception, error:
             raise TileCacheException("Error fetching URL. Exception was: %s\n Output XML: \n%s\n\nInput XML:\n %s " % (error, xmldata, xml))
-        tile.data = urllib.urlopen(img_url).read()
+        tile.data, response = fetchUrl(img_url, **self.client)
         return tile.data 
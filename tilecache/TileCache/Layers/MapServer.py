@@ -1,22 +1,41 @@
 # BSD Licensed, Copyright (c) 2006-2010 TileCache Contributors
 
-from TileCache.Layer import MetaLayer 
+import os, time, threading
+from TileCache.Layer import MetaLayer, ObjectPool
 
 class MapServer(MetaLayer):
     
     config_properties = [
       {'name':'name', 'description': 'Name of Layer'}, 
       {'name':'mapfile', 'description': 'Location of MapServer map file.'},
+      {'name':'poolsize', 'description': 'Number of parsed map files to keep, at most one render per map at a time.', 'default': '1'},
     ] + MetaLayer.config_properties 
+
+    ##### subclasses may make the map and request of each tile (get_map,  #####
+    ##### get_request); parsed maps are only reused for them if they set  #####
+    ##### this, saying their get_map doesn't need the tile                 #####
+
+    reuse_maps = False
     
-    def __init__ (self, name, mapfile = None, styles = "", **kwargs):
+    def __init__ (self, name, mapfile = None, styles = "", poolsize = 1, **kwargs):
         MetaLayer.__init__(self, name, **kwargs) 
         self.mapfile = mapfile
         self.styles = styles
+        
+        ##### parsed maps are kept, with their request, until the #####
+        ##### mapfile changes                                     #####
+        
+        self.pool = ObjectPool(self.load, poolsize)
+        self.generation = 0
+        self.mtime = None
+        self.checked = 0
+        self.lock = threading.Lock()
 
     def get_map(self, tile):
         # tile is unused here but might be used in a subclass
-        # where the mapfile config depends on the tile extents or layer
+        # where the mapfile config depends on the tile extents or layer.
+        # Such subclasses get a newly parsed map for every tile, unless
+        # they set reuse_maps.
         import mapscript
         wms = mapscript.mapObj(self.mapfile) 
         if self.metaBuffer:
@@ -32,11 +51,13 @@ class MapServer(MetaLayer):
         return wms
 
     def get_request(self, tile):
+        req = self.base_request()
+        self.set_request(req, tile)
+        return req
+
+    def base_request(self):
         import mapscript
         req = mapscript.OWSRequest()
-        req.setParameter("bbox", tile.bbox())
-        req.setParameter("width", str(tile.size()[0]))
-        req.setParameter("height", str(tile.size()[1]))
         req.setParameter("srs", self.srs)
         req.setParameter("format", self.mime_type)
         req.setParameter("layers", self.layers)
@@ -44,10 +65,64 @@ class MapServer(MetaLayer):
         req.setParameter("request", "GetMap")
         return req
 
+    def set_request(self, req, tile):
+        req.setParameter("bbox", tile.bbox())
+        req.setParameter("width", str(tile.size()[0]))
+        req.setParameter("height", str(tile.size()[1]))
+
+    def load(self):
+        return (self.generation, self.get_map(None), self.base_request())
+
+    ###########################################################################
+    ##
+    ## @brief throw the parsed maps away if the mapfile has changed
+    ##
+    ## @details
+    ##  The mapfile is stat'ed at most once a second. Maps checked out while
+    ##  it changes are dropped when they are checked back in.
+    ##
+    ###########################################################################
+
+    def check_mapfile(self):
+        now = time.time()
+        if now - self.checked < 1:
+            return
+        self.lock.acquire()
+        try:
+            if now - self.checked < 1:
+                return
+            self.checked = now
+            try:
+                mtime = os.stat(self.mapfile).st_mtime
+            except OSError:
+                return
+            if self.mtime is not None and mtime != self.mtime:
+                self.generation += 1
+                self.pool.clear()
+            self.mtime = mtime
+        finally:
+            self.lock.release()
+
     def renderTile(self, tile):
-        wms = self.get_map(tile)
-        req = self.get_request(tile)
-        wms.loadOWSParameters(req)
-        mapImage = wms.draw()
-        tile.data = mapImage.getBytes()
-        return tile.data 
+        if type(self) is not MapServer and not self.reuse_maps:
+            wms = self.get_map(tile)
+            req = self.get_request(tile)
+            wms.loadOWSParameters(req)
+            mapImage = wms.draw()
+            tile.data = mapImage.getBytes()
+            return tile.data
+        
+        self.check_mapfile()
+        entry = self.pool.checkout()
+        generation, wms, req = entry
+        try:
+            self.set_request(req, tile)
+            wms.loadOWSParameters(req)
+            mapImage = wms.draw()
+            tile.data = mapImage.getBytes()
+        finally:
+            if generation == self.generation:
+                self.pool.checkin(entry)
+            else:
+                self.pool.discard(entry)
+        return tile.data
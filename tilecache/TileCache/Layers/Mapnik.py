@@ -2,7 +2,7 @@
 
 import sys
 
-from TileCache.Layer import MetaLayer
+from TileCache.Layer import MetaLayer, ObjectPool
 
 class Mapnik(MetaLayer):
     
@@ -11,49 +11,63 @@ class Mapnik(MetaLayer):
       {'name':'mapfile', 'description': 'Location of Mapnik XML map description.'},
       {'name':'projection', 'description': 'Target map projection.'},
       {'name':'fonts', 'description': 'Comma-seperated list of fonts to add to the Mapik registered fonts list.'},
+      {'name':'poolsize', 'description': 'Number of loaded maps to keep, at most one render per map at a time.', 'default': '1'},
     ] + MetaLayer.config_properties 
     
-    def __init__ (self, name, mapfile = None, projection = None, fonts = None, **kwargs):
+    def __init__ (self, name, mapfile = None, projection = None, fonts = None, poolsize = 1, **kwargs):
         MetaLayer.__init__(self, name, **kwargs) 
         self.mapfile = mapfile
-        self.mapnik  = None
         self.projection = projection
         if fonts:
             self.fonts = fonts.split(",")
         else:
             self.fonts = []
-            
-    def renderTile(self, tile):
+        self.fonts_registered = False
+        
+        ##### maps are loaded now, rather than by the first request #####
+        
+        self.pool = ObjectPool(self.loadMap, poolsize)
+        try:
+            self.pool.fill()
+        except Exception, E:
+            print >>sys.stderr, "Loading %s for layer %s failed, will retry on render: %s" % (self.mapfile, self.name, E)
+    
+    def loadMap(self):
         import mapnik
         
-        if self.mapnik:
-            m = self.mapnik
-        else:
-            if self.fonts:
-                engine = mapnik.FontEngine.instance()
-                for font in self.fonts:
-                    engine.register_font(font)
-            
-            # Init it as 0,0
-            m = mapnik.Map( 0, 0 )
-            mapnik.load_map(m,self.mapfile)
-             
-            if self.projection:
-                m.srs = self.projection
-            
-            # Restrict layer list, if requested
-            if self.layers and self.layers != self.name:
-                layers = self.layers.split(",")
-                for layer_num in range(len(m.layers)-1, -1, -1):
-                    l = m.layers[layer_num]
-                    if l.name not in layers:
-                        del m.layers[layer_num]
-                        if self.debug:
-                            print >>sys.stderr, "Removed layer %s loaded from %s, not in list: %s" % (l.name, self.mapfile, layers)
-                        
-            # this will insure that it gets cached in mod_python
-            self.mapnik = m
+        if self.fonts and not self.fonts_registered:
+            engine = mapnik.FontEngine.instance()
+            for font in self.fonts:
+                engine.register_font(font)
+            self.fonts_registered = True
         
+        # Init it as 0,0
+        m = mapnik.Map( 0, 0 )
+        mapnik.load_map(m,self.mapfile)
+         
+        if self.projection:
+            m.srs = self.projection
+        
+        # Restrict layer list, if requested
+        if self.layers and self.layers != self.name:
+            layers = self.layers.split(",")
+            for layer_num in range(len(m.layers)-1, -1, -1):
+                l = m.layers[layer_num]
+                if l.name not in layers:
+                    del m.layers[layer_num]
+                    if self.debug:
+                        print >>sys.stderr, "Removed layer %s loaded from %s, not in list: %s" % (l.name, self.mapfile, layers)
+        return m
+    
+    def renderTile(self, tile):
+        m = self.pool.checkout()
+        try:
+            return self.renderMap(m, tile)
+        finally:
+            self.pool.checkin(m)
+    
+    def renderMap(self, m, tile):
+        import mapnik
         
         # Set the mapnik size to match the size of the current tile 
         m.width = tile.size()[0]
@@ -9,13 +9,20 @@ class WMS(MetaLayer):
       {'name':'url', 'description': 'URL of Remote Layer'},
       {'name':'user', 'description': 'Username of remote server: used for basic-auth protected backend WMS layers.'},
       {'name':'password', 'description': 'Password of remote server: Use for basic-auth protected backend WMS layers.'},
+      {'name':'maxrequests', 'description': 'Maximum number of requests in flight to the remote server.', 'default': '8'},
+      {'name':'timeout', 'description': 'Seconds to wait for the remote server.', 'default': '30'},
+      {'name':'retries', 'description': 'Number of times a failed request to the remote server is retried.', 'default': '3'},
     ] + MetaLayer.config_properties  
      
-    def __init__ (self, name, url = None, user = None, password = None, **kwargs):
+    def __init__ (self, name, url = None, user = None, password = None,
+                  maxrequests = 8, timeout = 30, retries = 3, **kwargs):
         MetaLayer.__init__(self, name, **kwargs) 
         self.url = url
         self.user = user
         self.password = password
+        self.maxrequests = int(maxrequests)
+        self.timeout = float(timeout)
+        self.retries = int(retries)
 
     def renderTile(self, tile):
         wms = WMSClient.WMS( self.url, {
@@ -25,6 +32,7 @@ class WMS(MetaLayer):
           "srs": self.srs,
           "format": self.mime_type,
           "layers": self.layers,
-        }, self.user, self.password)
+        }, self.user, self.password, max_requests = self.maxrequests,
+           timeout = self.timeout, retries = self.retries)
         tile.data, response = wms.fetch()
         return tile.data 
@@ -0,0 +1,196 @@
+# BSD Licensed, Copyright (c) 2006-2010 TileCache Contributors
+
+"""
+A pool of long lived render processes. Each process loads the configuration
+itself, so it holds its own layer objects (a loaded Mapnik map, an open GDAL
+dataset), and renders the tiles the web process hands it over a pipe. A
+crashing or hanging render only takes down a worker, which is replaced.
+
+Enabled with the render_processes option of [tilecache_options]:
+
+    [tilecache_options]
+    render_processes=4
+    render_timeout=60
+    render_max_jobs=1000
+"""
+
+import os, sys, time, traceback, threading, Queue
+import multiprocessing
+
+################################################################################
+## @brief the loop run by a render process
+##
+## @param conn   the worker's end of the pipe
+## @param files  the config files to load
+################################################################################
+
+def work (conn, files):
+    from TileCache.Service import Service
+    from TileCache.Layer import Tile
+    service = Service.load(files, renderpool = False)
+    service.watch()
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        name, x, y, z, force = job
+        try:
+            layer = service.layers[name]
+            if not layer:
+                raise Exception("The layer %s does not exist." % name)
+            data = layer.render(Tile(layer, x, y, z), force=force)
+            conn.send(("ok", data))
+        except Exception, E:
+            conn.send(("error", "%s\n%s" % (E, traceback.format_exc())))
+
+class RenderWorker (object):
+    __slots__ = ("process", "conn", "jobs")
+
+    def __init__ (self, files):
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=work, args=(child, files))
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+        self.jobs = 0
+
+    def stop (self, kill = False):
+        if kill:
+            self.process.terminate()
+        else:
+            try:
+                self.conn.send(None)
+            except (IOError, OSError):
+                pass
+        self.conn.close()
+
+class RenderPool (object):
+    __slots__ = ("files", "processes", "timeout", "max_jobs", "idle",
+                 "lock", "workers", "pid")
+
+    ###########################################################################
+    ##
+    ## @brief set up the pool; the render processes are started on first use
+    ##
+    ## @param files      the config files the processes load
+    ## @param processes  number of render processes
+    ## @param timeout    seconds a render may take before its process is
+    ##                   killed
+    ## @param max_jobs   renders after which a process is replaced, to bound
+    ##                   leaks in the renderers
+    ##
+    ###########################################################################
+
+    def __init__ (self, files, processes = 2, timeout = 60, max_jobs = 1000):
+        self.files = files
+        self.processes = int(processes)
+        self.timeout = float(timeout)
+        self.max_jobs = int(max_jobs)
+        self.idle = None
+        self.lock = threading.Lock()
+        self.workers = []
+        self.pid = None
+
+    ###########################################################################
+    ##
+    ## @brief start the render processes of this process, if not done yet
+    ##
+    ## @details
+    ##  A process forked after the pool was made (prefork servers loading the
+    ##  config before forking) doesn't use the workers of the process it was
+    ##  forked from, whose pipes are shared with its siblings: it lets go of
+    ##  them, and starts its own.
+    ##
+    ###########################################################################
+
+    def start (self):
+        if self.pid == os.getpid():
+            return
+        self.lock.acquire()
+        try:
+            if self.pid == os.getpid():
+                return
+            for worker in self.workers:
+                worker.conn.close()
+            self.workers = [RenderWorker(self.files) for i in range(self.processes)]
+            self.idle = Queue.Queue()
+            for worker in self.workers:
+                self.idle.put(worker)
+            self.pid = os.getpid()
+        finally:
+            self.lock.release()
+
+    def spawn (self):
+        worker = RenderWorker(self.files)
+        self.lock.acquire()
+        try:
+            self.workers.append(worker)
+        finally:
+            self.lock.release()
+        return worker
+
+    def retire (self, worker, kill = False):
+        self.lock.acquire()
+        try:
+            if worker in self.workers:
+                self.workers.remove(worker)
+        finally:
+            self.lock.release()
+        worker.stop(kill)
+        multiprocessing.active_children()
+
+    ###########################################################################
+    ##
+    ## @brief render a tile in one of the processes
+    ##
+    ## @param tile   the tile to render
+    ## @param force  passed on to Layer.render
+    ##
+    ## @return the tile data
+    ##
+    ###########################################################################
+
+    def render (self, tile, force = False):
+        self.start()
+        try:
+            worker = self.idle.get(True, self.timeout)
+        except Queue.Empty:
+            raise Exception("No render process became free within %s seconds." % self.timeout)
+        replace = True
+        try:
+            try:
+                worker.conn.send((tile.layer.name, tile.x, tile.y, tile.z, force))
+                if not worker.conn.poll(self.timeout):
+                    self.retire(worker, kill = True)
+                    raise Exception("Rendering tile %s, %s, %s of layer %s took longer than %s seconds." % (tile.x, tile.y, tile.z, tile.layer.name, self.timeout))
+                status, result = worker.conn.recv()
+            except (EOFError, IOError, OSError), E:
+                self.retire(worker, kill = True)
+                raise Exception("The render process for tile %s, %s, %s of layer %s died: %s" % (tile.x, tile.y, tile.z, tile.layer.name, E))
+            worker.jobs += 1
+            if worker.jobs >= self.max_jobs:
+                self.retire(worker)
+            else:
+                replace = False
+                self.idle.put(worker)
+        finally:
+            if replace:
+                self.idle.put(self.spawn())
+        if status != "ok":
+            raise Exception(result)
+        tile.data = result
+        return result
+
+    def close (self):
+        if self.pid != os.getpid():
+            return
+        self.lock.acquire()
+        try:
+            workers = list(self.workers)
+        finally:
+            self.lock.release()
+        for worker in workers:
+            self.retire(worker)
@@ -0,0 +1,143 @@
+# BSD Licensed, Copyright (c) 2006-2010 TileCache Contributors
+
+"""
+Tells the protocols TileCache speaks apart, from the path and the parameters
+of a request, and hands each request to a single, shared handler for its
+protocol.
+
+>>> router = Router(None)
+>>> router.route({}, "/1.0.0/basic/0/0/0.png")
+'TMS'
+>>> router.route({"LAYERS": "basic", "SERVICE": "WMS"}, "/")
+'WMS'
+>>> router.route({"request": "GetMap", "scale": "1000"}, "/")
+'WMTS'
+>>> router.route({"v": "mgmaps"}, "/"), router.route({"v": "2"}, "/")
+('MGMaps', 'TMS')
+>>> router.route({"format": "JSON"}, "/"), router.route({}, "/1.0.0/basic/0/0/0.kml")
+('JSON', 'KML')
+>>> router.route({}, "/crossdomain.xml")
+'crossdomain'
+>>> router.handler("TMS") is router.handler("TMS")
+True
+"""
+
+##### protocol: (module, class) of its handler #####
+
+PROTOCOLS = {
+    "KML":         ("TileCache.Services.KML", "KML"),
+    "WMTS":        ("TileCache.Services.WMTS", "WMTS"),
+    "WMS":         ("TileCache.Services.WMS", "WMS"),
+    "WorldWind":   ("TileCache.Services.WorldWind", "WorldWind"),
+    "TileService": ("TileCache.Services.TileService", "TileService"),
+    "MGMaps":      ("TileCache.Services.MGMaps", "MGMaps"),
+    "VETMS":       ("TileCache.Services.VETMS", "VETMS"),
+    "JSON":        ("TileCache.Services.JSON", "JSON"),
+    "TMS":         ("TileCache.Services.TMS", "TMS"),
+}
+
+##### protocols whose handler returns the response itself #####
+
+RESPONSES = ("KML", "JSON")
+
+##### (parameter, test of its value or None, protocol), the first match  #####
+##### in this list wins; requests matching none of them are TMS           #####
+
+SIGNATURES = [
+    ("scale",     None,                                "WMTS"),
+    ("SCALE",     None,                                "WMTS"),
+    ("service",   None,                                "WMS"),
+    ("SERVICE",   None,                                "WMS"),
+    ("REQUEST",   lambda value: value == "GetMap",     "WMS"),
+    ("request",   lambda value: value == "GetMap",     "WMS"),
+    ("L",         None,                                "WorldWind"),
+    ("l",         None,                                "WorldWind"),
+    ("request",   lambda value: value == "metadata",   "WorldWind"),
+    ("interface", None,                                "TileService"),
+    ("v",         lambda value: value in ("mgm", "mgmaps"), "MGMaps"),
+    ("tile",      None,                                "VETMS"),
+    ("format",    lambda value: value.lower() == "json", "JSON"),
+]
+
+class Router (object):
+    __slots__ = ("service", "signatures", "handlers")
+
+    ###########################################################################
+    ##
+    ## @brief compile the signatures into a lookup by parameter name
+    ##
+    ## @param service  the Service the handlers serve
+    ##
+    ###########################################################################
+
+    def __init__ (self, service):
+        self.service = service
+        self.handlers = {}
+        self.signatures = {}
+        for priority, (key, test, protocol) in enumerate(SIGNATURES):
+            self.signatures.setdefault(key, []).append((priority, test, protocol))
+
+    ###########################################################################
+    ##
+    ## @brief find the protocol of a request
+    ##
+    ## @param params     the request parameters
+    ## @param path_info  the request path
+    ##
+    ## @return a key of PROTOCOLS, or 'crossdomain' for crossdomain.xml
+    ##
+    ###########################################################################
+
+    def route (self, params, path_info):
+        if path_info.find("crossdomain.xml") != -1:
+            return "crossdomain"
+        if path_info.endswith(".kml") or path_info == "kml":
+            return "KML"
+
+        ##### with more than a few parameters (WMS), going through the    #####
+        ##### signatures in order is quicker than looking each one up    #####
+
+        if len(params) > 3:
+            for key, test, protocol in SIGNATURES:
+                if params.has_key(key) and (test is None or test(params[key])):
+                    return protocol
+            return "TMS"
+
+        best = None
+        signatures = self.signatures
+        for key in params.keys():
+            if key not in signatures:
+                continue
+            for priority, test, protocol in signatures[key]:
+                if best is not None and priority >= best[0]:
+                    break
+                if test is None or test(params[key]):
+                    best = (priority, protocol)
+                    break
+        if best is None:
+            return "TMS"
+        return best[1]
+
+    ###########################################################################
+    ##
+    ## @brief the handler of a protocol
+    ##
+    ## @param protocol  a key of PROTOCOLS
+    ##
+    ## @return the Request instance of that protocol, made on first use
+    ##
+    ###########################################################################
+
+    def handler (self, protocol):
+        try:
+            return self.handlers[protocol]
+        except KeyError:
+            from TileCache.Service import import_module
+            module, name = PROTOCOLS[protocol]
+            handler = getattr(import_module(module), name)(self.service)
+            self.handlers[protocol] = handler
+            return handler
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -4,12 +4,16 @@
 
 class TileCacheException(Exception): pass
 
-import sys, cgi, time, os, traceback, email, ConfigParser
+import sys, time, os, traceback
 import Cache, Caches, Config, Configs
-import Layer, Layers
-import urllib2, csv
+import Layer, Layers, Router
 from Configs.File import File
-import threading
+from Config import LazyLayer
+import threading, logging
+
+##### diagnostics, off unless the logger is configured #####
+
+log = logging.getLogger("TileCache.Service")
 
 # Windows doesn't always do the 'working directory' check correctly.
 if sys.platform == 'win32':
@@ -33,6 +37,8 @@ class Request (object):
     def getLayer(self, layername):    
         try:
             return self.service.layers[layername]
+        except TileCacheException:
+            raise
         except:
             raise TileCacheException("The requested layer (%s) does not exist. Available layers are: \n * %s" % (layername, "\n * ".join(self.service.layers.keys()))) 
 
@@ -44,13 +50,44 @@ def import_module(name):
         mod = getattr(mod, comp)
     return mod
 
+###############################################################################
+##
+## @brief the layers of a service at one point in time; a reload makes a new
+##        snapshot instead of changing this one
+##
+## @param version  number of the snapshot, counting up from 0
+## @param index    dict of the layers by name
+## @param names    list of the layer names, in config order
+## @param dynamic  list of the configs to ask for names not in the index
+##
+###############################################################################
+
+class LayerSnapshot (object):
+    __slots__ = ("version", "index", "names", "dynamic")
+
+    def __init__ (self, version, index, names, dynamic):
+        self.version = version
+        self.index = index
+        self.names = names
+        self.dynamic = dynamic
+
 class Service (object):
-    __slots__ = ("files", "configs", "layers", "lastcheckchange", "cache", "thread_lock")
+    __slots__ = ("files", "configs", "layers", "lastcheckchange", "cache", "thread_lock",
+                 "options", "renderpool", "threadpool", "composites",
+                 "router", "config_error", "watcher")
 
     def __init__ (self, configs, layers):
         self.configs = configs
         self.layers = layers
         self.lastcheckchange = time.time()
+        self.renderpool = None
+        self.threadpool = None
+        self.options = {}
+        self.composites = {}
+        self.router = Router.Router(self)
+        self.config_error = None
+        self.watcher = None
+        self.cache = None
         
         ##### we need a mutex for reading the configs #####
 
@@ -60,27 +97,34 @@ class Service (object):
     ##
     ## @brief load method to parse the config.
     ##
-    ## @param files    config files to parse
+    ## @param files       config files to parse
+    ## @param renderpool  render in worker processes, if the config asks for
+    ##                    them; each process starts its own on first use
+    ## @param snapshots   directory of the config snapshots (see Snapshot),
+    ##                    True for the default one, or None not to use them
     ##
     ###########################################################################
     
-    def _load (cls, files):
+    def _load (cls, files, renderpool = True, snapshots = None):
         
         configs = []
         initconfigs = []
+        if snapshots:
+            from TileCache.Snapshot import Snapshot, directory
+            snapshots = directory(snapshots)
 
         print >> sys.stderr, "Loading Configs: %s" % (','.join(files),)
         for f in files:
             #sys.stderr.write( "_load f %s\n" % f )
             cfg = File(f)
+            if cfg.resource != None and snapshots:
+                cfg.snapshot = Snapshot(snapshots, cfg.resource)
             if cfg.resource != None:
                 configs.append( cfg )
                 initconfigs.append( cfg )
 
         for conf in initconfigs:
             conf.read( configs )
-            if conf.cache != None:
-                cls.cache = conf.cache
             
 #        layers = {}
         layers = cls.LayerConfig()  
@@ -92,6 +136,34 @@ class Service (object):
         service = cls(configs, layers)
         
         service.files = files
+        service.cache = service.getDefaultCache()
+        service.checkConfigs()
+
+        ##### [tilecache_options], the first config to set one wins #####
+
+        for conf in configs:
+            for key, value in conf.options.items():
+                service.options.setdefault(key, value)
+
+        ##### combinations of layers cached as layers of their own #####
+
+        for names in service.options.get("composites", "").split(";"):
+            names = [name.strip() for name in names.split(",") if name.strip()]
+            if len(names) > 1:
+                service.composites[",".join(names)] = None
+
+        ##### layers made up front, rather than when first used #####
+
+        service.preload()
+
+        ##### hand rendering off to worker processes #####
+
+        if renderpool and int(service.options.get("render_processes", 0)) > 0:
+            from TileCache.RenderPool import RenderPool
+            service.renderpool = RenderPool(files,
+                service.options["render_processes"],
+                service.options.get("render_timeout", 60),
+                service.options.get("render_max_jobs", 1000))
             
         return service
 
@@ -103,15 +175,16 @@ class Service (object):
     # what *used* to be the layers dictionary, which contained configs for the
     # layers.
     # 
-    # Each config is checked (in the order they appear in the config file) for 
-    # the requested layer.  The first match is returned.  That means that
-    # it's possible for a config to be defined more than once, but the first
-    # definition will always take precedence.
-    # This allows for "dynamic" configs (like memcache) where we don't know
-    #    if a layer config exists in advance.
+    # The layers of the configs that load them up front (files, urls, pg) are
+    # kept in an index by name, rebuilt whenever a config is added or changes.
+    # If a layer is defined more than once, the first definition (in the
+    # order the configs appear in the config file) takes precedence.
+    # "Dynamic" configs (like memcache), where we don't know if a layer config
+    # exists in advance, are only asked for names not in the index.
     ############################################################################
 
     class LayerConfig(object):
+        __slots__ = ("list", "snapshot", "lock")
 
         ########################################################################
         # The constructor
@@ -119,6 +192,8 @@ class Service (object):
         
         def __init__(self):
             self.list=[]
+            self.snapshot=LayerSnapshot(0, {}, [], [])
+            self.lock=threading.Lock()
         
         ########################################################################
         # @brief get the number of objects in the list, Not number of config
@@ -133,26 +208,29 @@ class Service (object):
             return len(self.list)
         
         ########################################################################
-        # @brief iterate over the LayerConfig list and check each item for a
-        #        layer
+        # @brief look a layer up in the index, then in the dynamic configs
         # 
         # @param key    the name of the layer to search for
         #
-        # @return the layer object if found. or None when no config is found.
+        # @return the layer object if found. or False when no config is found.
         ########################################################################
 
         def __getitem__(self, key):
-            '''
-
-            '''
-            sys.stderr.write('Getitem for %s\n' % (key,))
-            sys.stderr.write('list contains %s items\n' % (len(self),))
-            for item in self.list:
-                sys.stderr.write('Lookup for %s\n' % (item.resource,))
-                c=item.getConfig(key)
-                sys.stderr.write('Value is %s\n' % (c,))
-                if c:
-                    return c
+            snapshot = self.snapshot
+            layer = snapshot.index.get(key)
+            if layer:
+                if isinstance(layer, LazyLayer):
+                    return layer.get()
+                return layer
+            for item in snapshot.dynamic:
+                log.debug("Lookup for %s in %s", key, item.resource)
+                try:
+                    layer = item.getConfig(key)
+                except KeyError:
+                    continue
+                if layer:
+                    return layer
+            log.debug("No config for %s", key)
             return False
         
         ########################################################################
@@ -165,10 +243,32 @@ class Service (object):
 
         def keys(self):
             
-            layers=[]
-            for item in self.list:
-                layers += item.getLayers()
-            return layers
+            return list(self.snapshot.names)
+        
+        def values(self):
+            
+            return [layer for name, layer in self.items()]
+        
+        ########################################################################
+        # @details
+        #  Layers which can't be made are left out, so that one broken layer
+        #  doesn't fail the capabilities of all the others.
+        ########################################################################
+
+        def items(self):
+            
+            snapshot = self.snapshot
+            items = []
+            for name in snapshot.names:
+                layer = snapshot.index[name]
+                if isinstance(layer, LazyLayer):
+                    try:
+                        layer = layer.get()
+                    except TileCacheException, E:
+                        log.warning("Leaving out layer %s: %s", name, E)
+                        continue
+                items.append((name, layer))
+            return items
             
         ########################################################################
         # @brief Add a config, this'll update the item (maintaining the same order
@@ -182,24 +282,57 @@ class Service (object):
         
         def update(self, configObj):
 
-            for pos, item in enumerate(self.list):
-                if configObj.resource == item.resource:
-                    self.list[pos]=configObj
-                    break
-            else:
-                self.list.append(configObj)
+            self.lock.acquire()
+            try:
+                for pos, item in enumerate(self.list):
+                    if configObj.resource == item.resource:
+                        self.list[pos]=configObj
+                        break
+                else:
+                    self.list.append(configObj)
+                self.reindex()
+            finally:
+                self.lock.release()
+        
+        ########################################################################
+        # @brief build the index of the layers by name
+        #
+        # @details
+        #  The index is built aside and swapped in as a whole, in a new
+        #  snapshot, so lookups going on meanwhile see either the old or the
+        #  new one.
+        ########################################################################
+        
+        def reindex(self):
+            
+            index = {}
+            names = []
+            dynamic = []
+            for item in self.list:
+                if item.isMemcache():
+                    dynamic.append(item)
+                    continue
+                for name, layer in (getattr(item, "layers", None) or {}).items():
+                    if not index.has_key(name):
+                        index[name] = layer
+                        names.append(name)
+            self.snapshot = LayerSnapshot(self.snapshot.version + 1,
+                                          index, names, dynamic)
             
         ########################################################################
-        # @brief This is in case someone tries to do something like:
+        # @brief This is in case someone tries to do something like: 
         #    if layer_name in LayerConfig_object ...
         #    this is the membership test.
         #
-        # @param key    the 
+        # @param key    the name of the layer
         ########################################################################
     
         def __contains__(self, key):
             
-            for item in self.list:
+            snapshot = self.snapshot
+            if snapshot.index.has_key(key):
+                return True
+            for item in snapshot.dynamic:
                 if item.hasConfig(key): 
                     return True
             return False
@@ -208,26 +341,154 @@ class Service (object):
     ##
     ## @brief method to check the configs for change
     ##
+    ## @param configs  the configs to check, all of them by default
+    ## @param busy     if a list, the configs another thread was checking
+    ##                 are appended to it, to be checked again later
+    ##
+    ## @return the number of configs which changed
+    ##
+    ## @details
+    ##  The layers of the configs which changed are published to the layer
+    ##  index. Requests don't call this: the configs are watched by a
+    ##  background thread (see watch).
     ##
     ###########################################################################
     
-    def checkchange (self):
+    def checkchange (self, configs = None, busy = None):
     
-        if self.lastcheckchange < time.time() + 1:
-           
-            #sys.stderr.write( "service.checkchange\n" )
-            configs = []
-            initconfigs = []
-            changes = 0;
+        changes = 0
 
-            for conf in self.configs:
+        for conf in configs or self.configs:
 
-                ##### only one thread needs to check a single config #####
+            ##### only one thread needs to check a single config #####
 
-                if conf.lock.acquire( blocking=0 ):
+            if conf.lock.acquire( blocking=0 ):
+                try:
                     if conf.checkchange(self.configs):
                         self.layers.update(conf)
+                        changes += 1
+                finally:
                     conf.lock.release()
+            elif busy is not None:
+                busy.append(conf)
+
+        self.lastcheckchange = time.time()
+        if changes:
+            self.cache = self.getDefaultCache()
+            self.checkConfigs(reload = True)
+            self.preload()
+        return changes
+
+    ###########################################################################
+    ##
+    ## @brief make the layers of the preload_layers option
+    ##
+    ## @details
+    ##  Layers are made when first used; those which are named in the
+    ##  comma separated preload_layers option ([tilecache_options]), or all
+    ##  of them if it is '*', are made when the config is loaded instead, so
+    ##  that the first requests for them aren't slower.
+    ##
+    ###########################################################################
+
+    def preload (self):
+        names = self.options.get("preload_layers", "").strip()
+        if names == "*":
+            names = self.layers.keys()
+        else:
+            names = [name.strip() for name in names.split(",") if name.strip()]
+        for name in names:
+            try:
+                layer = self.layers[name]
+                if not layer:
+                    sys.stderr.write("Can't preload layer %s: there is no such layer.\n" % name)
+                elif hasattr(layer, "lazy"):
+                    layer.lazy.build()
+            except Exception, E:
+                sys.stderr.write("Preloading layer %s failed: %s\n" % (name, E))
+
+    ###########################################################################
+    ##
+    ## @brief the cache of the service: that of the last config file which
+    ##        has one
+    ##
+    ###########################################################################
+
+    def getDefaultCache (self):
+        cache = None
+        for conf in self.configs:
+            if conf.isFile() and conf.cache is not None:
+                cache = conf.cache
+        return cache
+
+    ###########################################################################
+    ##
+    ## @brief the cache of a layer
+    ##
+    ## @details
+    ##  A layer keeps the cache of the config it was loaded with, so requests
+    ##  going on while the config is reloaded use the cache of their layers.
+    ##  Layers without a cache of their own use the cache of the service.
+    ##
+    ###########################################################################
+
+    def getCache (self, layer):
+        if layer.cache is not None:
+            return layer.cache
+        return self.cache
+
+    ###########################################################################
+    ##
+    ## @brief start watching the configs for changes, in a background thread
+    ##
+    ## @return the Watcher, or None if config_check_interval is 0
+    ##
+    ## @details
+    ##  For long running servers; the watcher is only started once.
+    ##
+    ###########################################################################
+
+    def watch (self):
+        interval = float(self.options.get("config_check_interval", 30))
+        if interval <= 0:
+            return None
+        self.thread_lock.acquire()
+        try:
+            if self.watcher is None:
+                from TileCache.Watcher import Watcher
+                self.watcher = Watcher(self, interval)
+                self.watcher.start()
+        finally:
+            self.thread_lock.release()
+        return self.watcher
+
+    ###########################################################################
+    ##
+    ## @brief check the configs for errors and warnings
+    ##
+    ## @param reload  True if the configs were loaded before
+    ##
+    ## @details
+    ##  Warnings are written to stderr once. The first error of the configs
+    ##  as first loaded is kept in config_error, and fails every request
+    ##  until the config is fixed. A config which fails to reload keeps its
+    ##  previous layers, which go on being served: the error is only written
+    ##  to stderr.
+    ##
+    ###########################################################################
+
+    def checkConfigs (self, reload = False):
+        error = None
+        for conf in self.configs:
+            if conf.metadata.has_key('exception'):
+                if error is None:
+                    error = "%s\n%s" % (conf.metadata['exception'], conf.metadata['traceback'])
+            elif conf.metadata.has_key('warn'):
+                sys.stderr.write("%s\n%s" % (conf.metadata.pop('warn'), conf.metadata.get('traceback', '')))
+        if reload and error is not None:
+            sys.stderr.write("Reloading the config failed, the previous one is still served: %s\n" % error)
+        else:
+            self.config_error = error
 
             
     
@@ -246,6 +507,39 @@ class Service (object):
         xml.append("</cross-domain-policy>")        
         return ('text/xml', "\n".join(xml))       
 
+    ###########################################################################
+    ##
+    ## @brief render a tile in the render processes
+    ##
+    ## @param tile   the tile to render
+    ## @param force  passed on to RenderPool::render
+    ##
+    ## @return the tile data
+    ##
+    ## @details
+    ##  The tiles of one metatile asked for at the same time make a single
+    ##  job: the others wait for it, as for a render in this process (see
+    ##  MetaLayer::joinFlight), and then find their tile in the cache.
+    ##
+    ###########################################################################
+
+    def renderPooled (self, tile, force = False):
+        layer = tile.layer
+        if not isinstance(layer, Layer.MetaLayer) or not layer.metaTile:
+            return self.renderpool.render(tile, force=force)
+        image, key, flight = layer.joinFlight(tile, force)
+        if image:
+            return image
+        try:
+            data = self.renderpool.render(tile, force=force)
+            flight.publish(tile.x, tile.y, data)
+            return data
+        except Exception, E:
+            flight.fail(E)
+            raise
+        finally:
+            Layer.metaTileFlights.leave(key, flight)
+
     def renderTile (self, tile, force = False):
         from warnings import warn
         start = time.time()
@@ -253,14 +547,20 @@ class Service (object):
         # do more cache checking here: SRS, width, height, layers 
 
         layer = tile.layer
+        cache = self.getCache(layer)
         image = None
         if not force:
-            image = self.cache.get(tile)
+            image = cache.get(tile)
+        else:
+            self.expireComposites(tile)
         
         if not image:
-            data = layer.render(tile, force=force)
+            if self.renderpool:
+                data = self.renderPooled(tile, force)
+            else:
+                data = layer.render(tile, force=force)
             if (data):
-                image = self.cache.set(tile, data)
+                image = cache.set(tile, data)
             else:
                 raise Exception("Zero length data returned from layer.")
             
@@ -276,63 +576,119 @@ class Service (object):
         
         return (layer.mime_type, image)
 
+    ###########################################################################
+    ##
+    ## @brief render several tiles at once
+    ##
+    ## @param tiles  list of tiles
+    ## @param force  passed on to renderTile
+    ##
+    ## @return generator of (index in tiles, (format, data)), in the order the
+    ##         tiles are done
+    ##
+    ## @details
+    ##  The tiles are rendered by a pool of request_threads threads (default
+    ##  8, [tilecache_options]), so a request for many uncached tiles takes
+    ##  about as long as the slowest of them. If they aren't all done within
+    ##  request_timeout seconds (default 60), an Exception is raised.
+    ##
+    ###########################################################################
+
+    def renderTiles (self, tiles, force = False):
+        threads = int(self.options.get("request_threads", 8))
+        if len(tiles) < 2 or threads < 2:
+            for i, tile in enumerate(tiles):
+                yield i, self.renderTile(tile, force)
+            return
+        if self.threadpool is None:
+            self.thread_lock.acquire()
+            try:
+                if self.threadpool is None:
+                    from multiprocessing.pool import ThreadPool
+                    self.threadpool = ThreadPool(threads)
+            finally:
+                self.thread_lock.release()
+        from multiprocessing import TimeoutError
+        timeout = float(self.options.get("request_timeout", 60))
+        deadline = time.time() + timeout
+        results = self.threadpool.imap_unordered(
+            lambda (i, tile): (i, self.renderTile(tile, force)), enumerate(tiles))
+        for n in range(len(tiles)):
+            try:
+                yield results.next(max(0, deadline - time.time()))
+            except TimeoutError:
+                raise Exception("Rendering %s tiles took longer than %s seconds." % (len(tiles), timeout))
+
     def expireTile (self, tile):
+        import Grid
         bbox  = tile.bounds()
         layer = tile.layer 
+        cache = self.getCache(layer)
         for z in range(len(layer.resolutions)):
-            bottomleft = layer.getClosestCell(z, bbox[0:2])
-            topright   = layer.getClosestCell(z, bbox[2:4])
-            for y in range(bottomleft[1], topright[1] + 1):
-                for x in range(bottomleft[0], topright[0] + 1):
-                    coverage = Layer.Tile(layer,x,y,z)
-                    self.cache.delete(coverage)
+            for coverage in Grid.tiles(layer, z, Grid.cellRange(layer, z, bbox)):
+                cache.delete(coverage)
+                self.expireComposites(coverage)
+
+    ###########################################################################
+    ##
+    ## @brief get the layer caching a combination of layers
+    ##
+    ## @param names  list of layer names, bottom layer first
+    ##
+    ## @return a Composite.CompositeLayer, or None if the combination is not
+    ##         one of the composites of [tilecache_options]
+    ##
+    ###########################################################################
+
+    def getCompositeLayer (self, names):
+        name = ",".join(names)
+        if name not in self.composites:
+            return None
+        layers = [self.layers[n] for n in names]
+        if not all(layers):
+            return None
+        composite = self.composites[name]
+        if composite is None or composite.constituents != layers:
+            import Composite
+            if not Composite.sameGrid(layers):
+                sys.stderr.write("The layers of composite %s don't have the same grid: it is not cached.\n" % name)
+                return None
+            composite = Composite.CompositeLayer(layers)
+            self.composites[name] = composite
+        else:
+            composite.update()
+        return composite
+
+    ###########################################################################
+    ##
+    ## @brief delete the cached composites a tile is part of
+    ##
+    ## @param tile  a tile which was deleted or is re-rendered
+    ##
+    ###########################################################################
+
+    def expireComposites (self, tile):
+        for name in self.composites.keys():
+            names = name.split(",")
+            if tile.layer.name in names:
+                composite = self.getCompositeLayer(names)
+                if composite:
+                    self.getCache(composite).delete(Layer.Tile(composite, tile.x, tile.y, tile.z))
 
     def dispatchRequest (self, params, path_info="/", req_method="GET", host="http://example.com/"):
 
-        ##### loop over the config instances and #####
-        ##### check for warnings and exceptions  #####
-        
-        for conf in self.configs:
-            if conf.metadata.has_key('exception'):
-                raise TileCacheException("%s\n%s" % (conf.metadata['exception'], conf.metadata['traceback']))
-            elif conf.metadata.has_key('warn'):
-                sys.stderr.write("%s\n%s" % (conf.metadata['warn'], conf.metadata['traceback']))
-        
-        if path_info.find("crossdomain.xml") != -1:
+        ##### a config that failed to load fails every request #####
+
+        if self.config_error:
+            raise TileCacheException(self.config_error)
+
+        protocol = self.router.route(params, path_info)
+        if protocol == "crossdomain":
             return self.generate_crossdomain_xml()
 
-        if path_info.split(".")[-1] == "kml":
-            from TileCache.Services.KML import KML 
-            return KML(self).parse(params, path_info, host)
-        
-        if params.has_key("scale") or params.has_key("SCALE"): 
-            from TileCache.Services.WMTS import WMTS
-            tile = WMTS(self).parse(params, path_info, host)
-        elif params.has_key("service") or params.has_key("SERVICE") or \
-           params.has_key("REQUEST") and params['REQUEST'] == "GetMap" or \
-           params.has_key("request") and params['request'] == "GetMap": 
-            from TileCache.Services.WMS import WMS
-            tile = WMS(self).parse(params, path_info, host)
-        elif params.has_key("L") or params.has_key("l") or \
-             params.has_key("request") and params['request'] == "metadata":
-            from TileCache.Services.WorldWind import WorldWind
-            tile = WorldWind(self).parse(params, path_info, host)
-        elif params.has_key("interface"):
-            from TileCache.Services.TileService import TileService
-            tile = TileService(self).parse(params, path_info, host)
-        elif params.has_key("v") and \
-             (params['v'] == "mgm" or params['v'] == "mgmaps"):
-            from TileCache.Services.MGMaps import MGMaps 
-            tile = MGMaps(self).parse(params, path_info, host)
-        elif params.has_key("tile"):
-            from TileCache.Services.VETMS import VETMS 
-            tile = VETMS(self).parse(params, path_info, host)
-        elif params.has_key("format") and params['format'].lower() == "json":
-            from TileCache.Services.JSON import JSON 
-            return JSON(self).parse(params, path_info, host)
-        else:
-            from TileCache.Services.TMS import TMS
-            tile = TMS(self).parse(params, path_info, host)
+        tile = self.router.handler(protocol).parse(params, path_info, host)
+        if protocol in Router.RESPONSES:
+            return tile
         
         #if hasattr(tile, "data"): # duck-typing for Layer.Tile
         #if isinstance(tile, Layer.Tile):
@@ -366,77 +722,56 @@ class Service (object):
                     import PIL.Image as Image
                 except ImportError:
                     raise Exception("Combining multiple layers requires Python Imaging Library.")
-                try:
-                    import cStringIO as StringIO
-                except ImportError:
-                    import StringIO
-                
-                
-                ##### calc image size #####
-
-                xoff=0;
-                yoff=0;
-                prev = None
-                xmax=0
-                ymax=0
-                for t in tile:
-                    
-                    
-                    xincr = t.layer.size[0]
-                    yincr = t.layer.size[1]
-                    if prev:
-                        if t.x < prev.x:
-                            xoff = 0;
-                        elif  t.x > prev.x:
-                            xoff += xincr
-                        
-                        if t.y < prev.y:
-                            yoff = 0;
-                        elif t.y > prev.y:
-                            yoff += yincr
-                    
-                    xmax = max(xmax, xoff + xincr)
-                    ymax = max(ymax, yoff + yincr)
-                    prev=t
-
-                ##### build an image from the tiles #####
-
-                result = None
-                xoff=0;
-                yoff = ymax - yincr
-                prev = None
-                for t in tile:
-
-                    xincr = t.layer.size[0]
-                    yincr = t.layer.size[1]
-                    if prev:
-                        if t.x < prev.x:
-                            xoff = 0;
-                        elif  t.x > prev.x:
-                            xoff += xincr
-
-                        if t.y < prev.y:
-                            yoff = ymax - yincr;
-                        elif t.y > prev.y:
-                            yoff -= yincr
-
-                    (format, data) = self.renderTile(t, params.has_key('FORCE'))
-                    image = Image.open(StringIO.StringIO(data))
-                    if not result:
-                        result = Image.new(image.mode, (xmax, ymax))
-                        imformat = image.format
-                    
-                    try:
-                        result.paste(image, (xoff, yoff) , image)
-                    except Exception, E:
-                        raise Exception("Could not combine images: Is it possible that some layers are not \n8-bit transparent images? \n(Error was: %s)" % E) 
-                    prev=t
-
-                buffer = StringIO.StringIO()
-                result.save(buffer, imformat)
-                buffer.seek(0)
-
-                return (format, buffer.read())
+                import Composite
+
+                ##### a cached composite, if there is one #####
+
+                composite = None
+                if len(set([(t.x, t.y, t.z) for t in tile])) == 1:
+                    layer = self.getCompositeLayer([t.layer.name for t in tile])
+                    if layer:
+                        composite = Layer.Tile(layer, tile[0].x, tile[0].y, tile[0].z)
+                        if not params.has_key('FORCE'):
+                            data = self.getCache(layer).get(composite)
+                            if data:
+                                return (layer.mime_type, data)
+
+                ##### work out the image size and where each tile goes #####
+
+                size, offsets = Composite.layout(tile)
+
+                ##### fetch the cached tiles in one go, if they are in #####
+                ##### one cache (renderTile looks in the others)      #####
+
+                caches = set([self.getCache(t.layer) for t in tile])
+                if params.has_key('FORCE') or len(caches) > 1:
+                    images = [None] * len(tile)
+                else:
+                    images = caches.pop().get_multi(tile)
+                missing = [i for i, data in enumerate(images) if not data]
+                pending = set(missing)
+                rendered = self.renderTiles([tile[i] for i in missing],
+                                            params.has_key('FORCE'))
+
+                ##### build an image from the tiles, in order, #####
+                ##### as soon as each one is there              #####
+
+                result = Composite.Compositor(size)
+                i = 0
+                while i < len(tile):
+                    if i in pending:
+                        j, (mime_type, data) = rendered.next()
+                        images[missing[j]] = data
+                        pending.discard(missing[j])
+                        continue
+                    result.add(images[i], offsets[i])
+                    images[i] = None
+                    i += 1
+
+                format, data = result.encode(tile[0].layer.mime_type)
+                if composite:
+                    self.getCache(composite.layer).set(composite, data)
+                return (format, data)
         
         ##### unknown object #####
         
@@ -444,6 +779,18 @@ class Service (object):
             raise NotImplementedError("Service instance must return a Tile or Capabilities object")
         
 
+###############################################################################
+##
+## @brief the HTTP date a response expires at
+##
+## @param seconds  from now
+##
+###############################################################################
+
+def expires (seconds):
+    import email.Utils
+    return email.Utils.formatdate(time.time() + seconds, False, True)
+
 def modPythonHandler (apacheReq, service):
     from mod_python import apache, util
     try:
@@ -454,10 +801,6 @@ def modPythonHandler (apacheReq, service):
         #host += apacheReq.uri[:-len(apacheReq.path_info)]
         host += "/tilecache/tilecache.py"
         
-        ##### test configs for changes #####
-        
-        service.checkchange()
-        
         format, image = service.dispatchRequest( 
                                 util.FieldStorage(apacheReq), 
                                 apacheReq.path_info,
@@ -469,7 +812,7 @@ def modPythonHandler (apacheReq, service):
             if service.cache.sendfile:
                 apacheReq.headers_out['X-SendFile'] = image
             if service.cache.expire:
-                apacheReq.headers_out['Expires'] = email.Utils.formatdate(time.time() + service.cache.expire, False, True)
+                apacheReq.headers_out['Expires'] = expires(service.cache.expire)
                 
         apacheReq.set_content_length(len(image))
         apacheReq.send_http_header()
@@ -509,17 +852,13 @@ def wsgiHandler (environ, start_response, service):
         req_method = environ["REQUEST_METHOD"]
         fields = parse_formvars(environ)
         
-        ##### test configs for changes #####
-        
-        service.checkchange()
-        
         format, image = service.dispatchRequest( fields, path_info, req_method, host )
         headers = [( 'Content-Type', format.encode('utf-8') )]
         if format.startswith("image/"):
             if service.cache.sendfile:
                 headers.append(('X-SendFile', image))
             if service.cache.expire:
-                headers.append(('Expires', email.Utils.formatdate(time.time() + service.cache.expire, False, True)))
+                headers.append(('Expires', expires(service.cache.expire)))
 
         start_response("200 OK", headers)
         if service.cache.sendfile and format.startswith("image/"):
@@ -540,8 +879,16 @@ def wsgiHandler (environ, start_response, service):
 def cgiHandler (service):
     try:
         params = {}
-        input = cgi.FieldStorage()
-        for key in input.keys(): params[key] = input[key].value
+        
+        ##### the cgi module is only needed for the body of a POST #####
+        
+        if os.environ.get("REQUEST_METHOD", "GET") in ("GET", "HEAD"):
+            import urlparse
+            params = dict(urlparse.parse_qsl(os.environ.get("QUERY_STRING", "")))
+        else:
+            import cgi
+            input = cgi.FieldStorage()
+            for key in input.keys(): params[key] = input[key].value
         path_info = host = ""
 
         if "PATH_INFO" in os.environ: 
@@ -555,17 +902,13 @@ def cgiHandler (service):
         host += os.environ["SCRIPT_NAME"]
         req_method = os.environ["REQUEST_METHOD"]
         
-        ##### test configs for changes #####
-        
-        service.checkchange()
-        
         format, image = service.dispatchRequest( params, path_info, req_method, host )
         print "Content-type: %s" % format
         if format.startswith("image/"):
             if service.cache.sendfile:
                 print "X-SendFile: %s" % image
             if service.cache.expire:
-                print "Expires: %s" % email.Utils.formatdate(time.time() + service.cache.expire, False, True)
+                print "Expires: %s" % expires(service.cache.expire)
         print ""
         if (not service.cache.sendfile) or (not format.startswith("image/")):
             if sys.platform == "win32":
@@ -606,7 +949,10 @@ def handler (apacheReq):
         configFile = 'default'
         
     if not theService.has_key(configFile) or fileChanged:
+        if theService.has_key(configFile) and theService[configFile].watcher:
+            theService[configFile].watcher.stop()
         theService[configFile] = Service.load(cfgfiles)
+        theService[configFile].watch()
         
     return modPythonHandler(apacheReq, theService[configFile])
 
@@ -615,6 +961,7 @@ def wsgiApp (environ, start_response):
     cfgs    = cfgfiles
     if not theService:
         theService = Service.load(cfgs)
+        theService.watch()
     return wsgiHandler(environ, start_response, theService)
 
 def binaryPrint(binary_data):
@@ -637,6 +984,7 @@ def paste_deploy_app(global_conf, full_stack=True, **app_conf):
     theService = Service.load(*cfgfiles)
     if 'exception' in theService.metadata:
         raise theService.metadata['exception']
+    theService.watch()
     
     def pdWsgiApp (environ,start_response):
         return wsgiHandler(environ,start_response,theService)
@@ -644,5 +992,5 @@ def paste_deploy_app(global_conf, full_stack=True, **app_conf):
     return pdWsgiApp
 
 if __name__ == '__main__':
-    svc = Service.load(cfgfiles)
+    svc = Service.load(cfgfiles, snapshots = True)
     cgiHandler(svc)
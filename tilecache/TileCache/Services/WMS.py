@@ -2,6 +2,7 @@
 
 from TileCache.Service import Request, Capabilities
 import TileCache.Layer as Layer
+import TileCache.Grid as Grid
 import sys
 
 class WMS (Request):
@@ -26,29 +27,10 @@ class WMS (Request):
         width  = min( 4096, int(param["width"]) )
         tiles =  []
 
-        ##### loop over the layers #####
+        ##### the tiles of each layer covering the bbox #####
 
         for name in layers:
-
-            ##### calc the increment for each of the tiles in the bbox #####
-
-            xincr = ( bbox[2] - bbox[0] ) / (width  / self.getLayer(name).size[0])
-            yincr = ( bbox[3] - bbox[1] ) / (height / self.getLayer(name).size[1])
-            
-            ##### loop over the bbox  and build a list of tiles #####
-            
-            x = bbox[0]
-            while x < bbox[2] - xincr / 2: #### cant use the exact bbox value because of floating point errors
-                y = bbox[1]
-                while y < bbox[3] - yincr / 2:
-                    tile  = self.getLayer(name).getTile((x, y, x+xincr, y+yincr))
-                    if not tile:
-                        raise Exception(
-                            "couldn't calculate tile index for layer %s from (%s)"
-                            % (layer.name, bbox))
-                    tiles.append(tile)
-                    y += yincr
-                x += xincr
+            tiles.extend(Grid.bboxTiles(self.getLayer(name), bbox, width, height))
 
         if len(tiles) > 1:
             return tiles
@@ -17,8 +17,9 @@ class WMTS (Request):
         layer = self.getLayer(fields['layer'])
         if not layer.units:
             raise TileCacheException("No units were specified on the layer. WMTS support requires units to be defined for the layer.") 
-        res =  .00028 * float(fields['scale']) / self.meters_per_unit[layer.units]
-        z = layer.getLevel(res, layer.size)
+        scale = float(fields['scale'])
+        res =  .00028 * scale / self.meters_per_unit[layer.units]
+        z = layer.getScaleLevel(scale, self.meters_per_unit[layer.units])
         tile = None
         maxY = int(
           round(
@@ -0,0 +1,403 @@
+# BSD Licensed, Copyright (c) 2006-2010 TileCache Contributors
+
+"""
+Compiled configs, for processes which only live for a request or a few (CGI).
+
+A snapshot keeps what loading a config file works out: its sections, parsed,
+and the geometry of each of its layers (bbox, resolutions, grids, ...) once
+the layer has been made. It is saved in a file of its own, along with the
+modification time, size and sha1 of the config file it was made from, and
+used instead of parsing the config again for as long as they don't change.
+
+A layer whose geometry is in the snapshot is loaded as a stand-in: an
+instance of Layer (or MetaLayer) with that geometry, which is all that is
+needed to answer a request from the cache. The real layer, which imports its
+module and opens its image, dataset or map, is only made when a tile has to
+be rendered, or something the stand-in doesn't have is asked for. Only the
+layers of TileCache whose geometry comes from their section alone (see
+CONFIG_LAYERS) are recorded: a GDAL layer takes its extent from its dataset,
+and layers of other modules may work theirs out in any way, so these are
+always made.
+
+Snapshots are kept in marshal files, which only hold plain data; they are
+only read from a directory which belongs to the user the process runs as,
+and which nobody else can write to.
+
+>>> import os, shutil, tempfile
+>>> path = tempfile.mkdtemp()
+>>> cfg = os.path.join(path, "tilecache.cfg")
+>>> open(cfg, "w").write("[cache]\\ntype=Disk\\nbase=%s\\n[basic]\\ntype=WMS\\n"
+...     "url=http://example.com/wms\\nmetatile=yes\\n" % path)
+>>> snapshot = Snapshot(directory(os.path.join(path, "snapshots")), cfg)
+
+The first time, the config is parsed, and the snapshot saved:
+
+>>> config = snapshot.read()
+>>> config.__class__.__name__, config.get("basic", "metatile")
+('ConfigParser', 'yes')
+
+after which it is read instead of the config:
+
+>>> config = Snapshot(snapshot.directory, cfg).read()
+>>> config.__class__.__name__, config.get("basic", "metatile")
+('Sections', 'yes')
+>>> sorted(config.sections()), config.has_option("basic", "URL")
+(['basic', 'cache'], True)
+
+Layers made from it are recorded in the snapshot, and loaded as stand-ins
+by the processes which come after:
+
+>>> from TileCache.Service import Service
+>>> service = Service.load([cfg], snapshots = snapshot.directory)
+>>> layer = service.layers["basic"]
+>>> layer.__class__.__name__, layer.metaTile
+('WMS', True)
+>>> service = Service.load([cfg], snapshots = snapshot.directory)
+>>> stand_in = service.layers["basic"]
+>>> stand_in.__class__.__name__, stand_in.metaTile, stand_in.resolutions == layer.resolutions
+('MetaLayerGeometry', True, True)
+>>> stand_in.cache is service.cache
+True
+
+Anything the stand-in doesn't know is asked of the real layer, which is then
+made:
+
+>>> stand_in.url
+'http://example.com/wms'
+>>> service.layers["basic"].__class__.__name__
+'WMS'
+
+A change to the config makes a new snapshot:
+
+>>> open(cfg, "a").write("[other]\\ntype=WMS\\nurl=http://example.com/wms\\n")
+>>> os.utime(cfg, (0, 0))
+>>> service = Service.load([cfg], snapshots = snapshot.directory)
+>>> sorted(service.layers.keys())
+['basic', 'other']
+
+Layers of other modules are always made:
+
+>>> open(cfg, "a").write("[custom]\\ntype=MetaLayer\\nmodule=TileCache.Layer\\n")
+>>> for i in range(2):
+...     service = Service.load([cfg], snapshots = snapshot.directory)
+...     service.layers["custom"].__class__.__name__
+'MetaLayer'
+'MetaLayer'
+
+>>> shutil.rmtree(path)
+"""
+
+import os, sys, marshal, threading, logging
+from TileCache.Layer import Layer, MetaLayer
+
+log = logging.getLogger("TileCache.Snapshot")
+
+##### bumped whenever what is saved, or how, changes #####
+
+FORMAT = 2
+
+##### the layer types whose geometry only comes from their section #####
+
+CONFIG_LAYERS = ("WMS", "ArcXML", "Image", "MapServer", "Mapnik")
+
+###############################################################################
+##
+## @brief the directory snapshots are kept in
+##
+## @param path  the directory, True for the default one (the
+##              TILECACHE_SNAPSHOTS environment variable, or a directory of
+##              the user in the temporary directory), or None
+##
+## @return the directory, made if needed, or None if there is none that
+##         can safely be used
+##
+###############################################################################
+
+def directory (path = True):
+    if not path:
+        return None
+    if path is True:
+        path = os.environ.get("TILECACHE_SNAPSHOTS") or \
+               os.path.join(os.environ.get("TMPDIR", "/tmp"),
+                            "tilecache-snapshots-%s" % os.getuid())
+    try:
+        os.mkdir(path, 0700)
+    except OSError:
+        pass
+    try:
+        st = os.stat(path)
+    except OSError, E:
+        log.warning("Not using config snapshots: %s", E)
+        return None
+    if st.st_uid != os.getuid() or st.st_mode & 022:
+        log.warning("Not using config snapshots: %s belongs to someone else, "
+                    "or others can write to it.", path)
+        return None
+    return path
+
+###############################################################################
+##
+## @brief the parsed sections of a config, read from a snapshot
+##
+## @details
+##  Answers what Config asks of a ConfigParser::ConfigParser.
+##
+###############################################################################
+
+class Sections (object):
+    __slots__ = ("order", "values")
+
+    def __init__ (self, sections):
+        self.order = [name for name, items in sections]
+        self.values = dict([(name, dict(items)) for name, items in sections])
+
+    def sections (self):
+        return list(self.order)
+
+    def has_section (self, section):
+        return self.values.has_key(section)
+
+    def options (self, section):
+        return self.values[section].keys()
+
+    def has_option (self, section, option):
+        return self.values.has_key(section) and \
+               self.values[section].has_key(option.lower())
+
+    def get (self, section, option):
+        return self.values[section][option.lower()]
+
+    def items (self, section):
+        return self.values[section].items()
+
+###############################################################################
+##
+## @brief a layer, as far as its geometry goes
+##
+## @details
+##  Stands in for a LazyLayer's layer until the real one is needed: to
+##  render, or for anything that isn't part of the geometry.
+##
+###############################################################################
+
+class Geometry (object):
+    __slots__ = ()
+
+    def __getattr__ (self, name):
+        if name == "lazy" or name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(self.lazy.build(), name)
+
+    def render (self, tile, **kwargs):
+        return self.lazy.build().render(tile, **kwargs)
+
+class LayerGeometry (Geometry, Layer):
+    __slots__ = ("lazy",)
+
+class MetaLayerGeometry (Geometry, MetaLayer):
+    __slots__ = ("lazy",)
+
+###############################################################################
+##
+## @brief the snapshot of a config file
+##
+## @param directory  where the snapshot is kept, see directory()
+## @param resource   path of the config file
+##
+###############################################################################
+
+class Snapshot (object):
+    __slots__ = ("directory", "resource", "path", "key", "sections", "items",
+                 "layers", "lock")
+
+    def __init__ (self, directory, resource):
+        import hashlib
+        self.directory = directory
+        self.resource = os.path.realpath(resource)
+        self.path = os.path.join(directory,
+            "%s.snapshot" % hashlib.sha1(self.resource).hexdigest())
+        self.key = None
+        self.sections = []
+        self.items = {}
+        self.layers = {}
+        self.lock = threading.Lock()
+
+    ###########################################################################
+    ##
+    ## @brief parse the config file, or read the snapshot of it
+    ##
+    ## @return ConfigParser::ConfigParser object, or Sections if the snapshot
+    ##         is up to date
+    ##
+    ## @details
+    ##  A parsed config is saved as the new snapshot, with the geometry of
+    ##  the layers whose section didn't change.
+    ##
+    ###########################################################################
+
+    def read (self):
+        import hashlib
+        st = os.stat(self.resource)
+        data = open(self.resource).read()
+        key = [FORMAT, st.st_mtime, st.st_size, hashlib.sha1(data).hexdigest()]
+
+        saved = self.load()
+        if saved.get("key") == key:
+            self.lock.acquire()
+            try:
+                self.key = key
+                self.sections = saved["sections"]
+                self.items = dict([(name, sorted(items))
+                                   for name, items in self.sections])
+                self.layers = saved["layers"]
+            finally:
+                self.lock.release()
+            return Sections(self.sections)
+
+        import ConfigParser, cStringIO
+        config = ConfigParser.ConfigParser()
+        config.readfp(cStringIO.StringIO(data), self.resource)
+        try:
+            sections = [(name, config.items(name)) for name in config.sections()]
+        except ConfigParser.Error:
+            return config
+
+        self.lock.acquire()
+        try:
+            self.key = key
+            self.sections = sections
+            self.items = dict([(name, sorted(items)) for name, items in sections])
+            self.layers = {}
+            for name, geometry in saved.get("layers", {}).items():
+                if geometry[0] == self.items.get(name):
+                    self.layers[name] = geometry
+            self.save()
+        finally:
+            self.lock.release()
+        return config
+
+    ###########################################################################
+    ##
+    ## @brief the saved snapshot, or an empty dict
+    ##
+    ###########################################################################
+
+    def load (self):
+        try:
+            f = open(self.path, "rb")
+        except IOError:
+            return {}
+        try:
+            try:
+                saved = marshal.load(f)
+            except (EOFError, ValueError, TypeError):
+                return {}
+        finally:
+            f.close()
+        if not isinstance(saved, dict):
+            return {}
+        return saved
+
+    ###########################################################################
+    ##
+    ## @brief write the snapshot, replacing the saved one in one go
+    ##
+    ## @details
+    ##  Called with the lock held. A snapshot which can't be written is
+    ##  only a lost optimization: the error is logged.
+    ##
+    ###########################################################################
+
+    def save (self):
+        temp = "%s.%s" % (self.path, os.getpid())
+        try:
+            f = os.fdopen(os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), "wb")
+            try:
+                marshal.dump({ "key": self.key, "sections": self.sections,
+                               "layers": self.layers }, f)
+            finally:
+                f.close()
+            os.rename(temp, self.path)
+        except (IOError, OSError), E:
+            log.warning("Could not save the snapshot of %s: %s", self.resource, E)
+
+    ###########################################################################
+    ##
+    ## @brief record the geometry of a layer which was just made
+    ##
+    ## @param name   name of the layer (its section)
+    ## @param layer  the layer
+    ##
+    ## @details
+    ##  The geometry is what the Layer and MetaLayer slots hold, other than
+    ##  the cache, as far as it is plain data. Only layers of the classes of
+    ##  CONFIG_LAYERS, from TileCache.Layers, are recorded. The layers
+    ##  recorded by other processes since the snapshot was read are kept.
+    ##
+    ###########################################################################
+
+    def record (self, name, layer):
+        items = self.items.get(name)
+        if self.key is None or items is None or self.layers.has_key(name):
+            return
+        cls = layer.__class__
+        if cls.__name__ not in CONFIG_LAYERS or \
+           cls.__module__ != "TileCache.Layers.%s" % cls.__name__:
+            return
+        state = {}
+        for cls in (Layer, MetaLayer):
+            if not isinstance(layer, cls):
+                continue
+            for slot in cls.__slots__:
+                if slot == "cache" or not hasattr(layer, slot):
+                    continue
+                value = getattr(layer, slot)
+                try:
+                    marshal.dumps(value)
+                except ValueError:
+                    continue
+                state[slot] = value
+
+        self.lock.acquire()
+        try:
+            saved = self.load()
+            if saved.get("key") == self.key:
+                for other, geometry in saved["layers"].items():
+                    self.layers.setdefault(other, geometry)
+            self.layers[name] = (items, isinstance(layer, MetaLayer), state)
+            self.save()
+        finally:
+            self.lock.release()
+
+    ###########################################################################
+    ##
+    ## @brief the stand-in for the layer of a LazyLayer
+    ##
+    ## @param lazy  Config::LazyLayer
+    ##
+    ## @return a LayerGeometry or MetaLayerGeometry, or None if the geometry
+    ##         of the layer isn't known
+    ##
+    ###########################################################################
+
+    def restore (self, lazy):
+        geometry = self.layers.get(lazy.name)
+        if geometry is None or geometry[0] != self.items.get(lazy.name):
+            return None
+        items, meta, state = geometry
+        if meta:
+            layer = MetaLayerGeometry.__new__(MetaLayerGeometry)
+        else:
+            layer = LayerGeometry.__new__(LayerGeometry)
+        for slot, value in state.items():
+            try:
+                setattr(layer, slot, value)
+            except AttributeError:
+                pass
+        layer.cache = lazy.cache
+        layer.lazy = lazy
+        return layer
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
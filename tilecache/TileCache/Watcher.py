@@ -0,0 +1,191 @@
+# BSD Licensed, Copyright (c) 2006-2010 TileCache Contributors
+
+"""
+Watches the configs of a Service for changes from a background thread, so
+that requests never have to look at the config sources themselves. File
+configs are watched with inotify (their directory, as editors replace files
+by renaming), or checked every 'interval' seconds where it isn't available;
+PG configs wake the watcher up through their LISTEN/NOTIFY connection, and
+Url configs are fetched every 'interval' seconds with a conditional GET.
+The layers of a changed config are published by Service.checkchange, which
+swaps them into the layer index in one go.
+"""
+
+import os, sys, time, errno, select, threading, traceback
+from TileCache import Inotify
+
+FILE_EVENTS = Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO | Inotify.IN_ATTRIB
+
+class Watcher (object):
+    __slots__ = ("service", "interval", "thread", "stopped", "notify", "files",
+                 "polled")
+
+    ###########################################################################
+    ##
+    ## @brief a watcher of the configs of a service
+    ##
+    ## @param service   the Service whose configs are watched
+    ## @param interval  seconds between checks of the configs which can't
+    ##                  tell when they change (Url, File without inotify)
+    ##
+    ###########################################################################
+
+    def __init__ (self, service, interval = 30):
+        self.service = service
+        self.interval = float(interval)
+        self.thread = None
+        self.stopped = threading.Event()
+        self.notify = None
+        self.files = {}
+        self.polled = []
+
+    ###########################################################################
+    ##
+    ## @brief start watching, in a daemon thread
+    ##
+    ## @details
+    ##  The files are watched before this returns, so that no change made
+    ##  after it is missed.
+    ##
+    ###########################################################################
+
+    def start (self):
+        self.polled = self.watchFiles()
+        self.polled.extend([conf for conf in self.service.configs
+                            if conf.isUrl() or conf.isPG()])
+        thread = threading.Thread(target = self.run, name = "TileCache config watcher")
+        thread.setDaemon(True)
+        self.thread = thread
+        thread.start()
+
+    ###########################################################################
+    ##
+    ## @brief stop watching, and wait for the thread to finish
+    ##
+    ###########################################################################
+
+    def stop (self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    ###########################################################################
+    ##
+    ## @brief watch the directories of the file configs with inotify
+    ##
+    ## @return list of the file configs which have to be checked every
+    ##         interval instead
+    ##
+    ###########################################################################
+
+    def watchFiles (self):
+        polled = []
+        directories = {}
+        for conf in self.service.configs:
+            if not conf.isFile() or conf.resource is None:
+                continue
+            if self.notify is None and Inotify.available:
+                try:
+                    self.notify = Inotify.Inotify()
+                except OSError:
+                    pass
+            if self.notify is None:
+                polled.append(conf)
+                continue
+            directory, name = os.path.split(os.path.realpath(conf.resource))
+            try:
+                if not directories.has_key(directory):
+                    directories[directory] = self.notify.watch(directory, FILE_EVENTS)
+            except OSError, E:
+                sys.stderr.write("Could not watch %s for changes, checking it every %s seconds instead: %s\n" % (directory, self.interval, E))
+                polled.append(conf)
+                continue
+            self.files[(directories[directory], name)] = conf
+        return polled
+
+    ###########################################################################
+    ##
+    ## @brief wait for a change notice from inotify or a PG config
+    ##
+    ## @param timeout  seconds to wait at most
+    ##
+    ## @return list of the configs which may have changed
+    ##
+    ###########################################################################
+
+    def wait (self, timeout):
+        sources = {}
+        for conf in self.service.configs:
+            if conf.isPG():
+                try:
+                    sources[conf.fileno()] = conf
+                except Exception:
+                    pass
+        if self.notify is not None:
+            sources[self.notify.fd] = None
+        if not sources:
+            self.stopped.wait(timeout)
+            return []
+
+        try:
+            readable = select.select(sources.keys(), [], [], timeout)[0]
+        except select.error, E:
+            if E.args[0] == errno.EINTR:
+                return []
+            raise
+
+        changed = []
+        for fd in readable:
+            if sources[fd] is not None:
+                changed.append(sources[fd])
+                continue
+            for wd, mask, cookie, name in self.notify.read(0):
+                if wd == -1:
+
+                    ##### the event queue overflowed, any file may have changed #####
+
+                    changed.extend(self.files.values())
+                elif self.files.has_key((wd, name)):
+                    changed.append(self.files[(wd, name)])
+        return changed
+
+    ###########################################################################
+    ##
+    ## @brief the loop of the watcher thread
+    ##
+    ###########################################################################
+
+    def run (self):
+        try:
+
+            ##### the files may have changed since they were loaded #####
+
+            changed = self.files.values()
+            nextpoll = time.time() + self.interval
+            while not self.stopped.isSet():
+                if time.time() >= nextpoll:
+                    changed.extend(self.polled)
+                    nextpoll = time.time() + self.interval
+                unique = []
+                for conf in changed:
+                    if conf not in unique:
+                        unique.append(conf)
+
+                ##### configs another thread was checking are checked again #####
+                ##### in the next round, so that their change isn't lost     #####
+
+                busy = []
+                if unique:
+                    try:
+                        self.service.checkchange(unique, busy)
+                    except Exception, E:
+                        sys.stderr.write("Checking the configs for changes failed: %s\n%s" % (E, traceback.format_exc()))
+
+                ##### wake up every second at least, to notice stop() #####
+
+                changed = busy + self.wait(min(1.0, max(0, nextpoll - time.time())))
+        finally:
+            if self.notify is not None:
+                self.notify.close()
+                self.notify = None
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+# BSD Licensed, Copyright (c) 2006-2010 TileCache Contributors
+
+"""
+Benchmark for Cache.lock under contention.
+
+Models a burst of requests for one uncached metatile: one process takes the
+metatile lock and holds it for a while (standing in for the render), while
+several other processes block in Cache.lock. Once the render is done and the
+lock released, each waiter takes the lock in turn, finds its tile and unlocks
+straight away, as MetaLayer.render does on a cache hit. The time from the
+render finishing to each waiter getting the lock is recorded, and p50/p99 are
+reported for each wait strategy:
+
+ * poll    -- the old behaviour, a fixed 250ms sleep between attempts
+ * backoff -- Cache.waitForUnlock, exponential backoff with jitter
+ * disk    -- Disk.waitForUnlock, inotify on the lock directory
+
+Usage: bench_lock.py [waiters] [rounds] [hold_ms]
+"""
+
+import os, sys, time, shutil, tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from TileCache.Cache import Cache
+from TileCache.Caches.Disk import Disk
+from TileCache.Layer import Layer, Tile
+
+class PollingDisk (Disk):
+    def waitForUnlock (self, tile, timeout, attempt):
+        time.sleep(0.25)
+
+class BackoffDisk (Disk):
+    def waitForUnlock (self, tile, timeout, attempt):
+        Cache.waitForUnlock(self, tile, timeout, attempt)
+
+strategies = [ ("poll", PollingDisk), ("backoff", BackoffDisk), ("disk", Disk) ]
+
+def waiter (cache_class, base, start, released, results):
+    cache = cache_class(base, timeout = 120)
+    tile = Tile(Layer("bench"), 0, 0, 0)
+    while start.get():
+        cache.lock(tile)
+        results.put(time.time() - released.value)
+        cache.unlock(tile)
+
+def percentile (values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def run (cache_class, waiters, rounds, hold):
+    base = tempfile.mkdtemp(prefix = "tilecache_bench_lock")
+    cache = cache_class(base, timeout = 120)
+    tile = Tile(Layer("bench"), 0, 0, 0)
+    start = multiprocessing.Queue()
+    released = multiprocessing.Value('d', 0.0)
+    results = multiprocessing.Queue()
+    procs = [ multiprocessing.Process(target = waiter,
+                  args = (cache_class, base, start, released, results))
+              for i in range(waiters) ]
+    for proc in procs: proc.start()
+    waits = []
+    for i in range(rounds):
+        cache.lock(tile)
+        for proc in procs: start.put(True)
+        time.sleep(hold)
+        released.value = time.time()
+        cache.unlock(tile)
+        for proc in procs: waits.append(results.get())
+    for proc in procs: start.put(False)
+    for proc in procs: proc.join()
+    shutil.rmtree(base, True)
+    return waits
+
+def main ():
+    waiters = len(sys.argv) > 1 and int(sys.argv[1]) or 8
+    rounds = len(sys.argv) > 2 and int(sys.argv[2]) or 20
+    hold = (len(sys.argv) > 3 and float(sys.argv[3]) or 100) / 1000.0
+    print "%d waiters, %d rounds, render holds the lock %.0fms" % (waiters, rounds, hold * 1000)
+    for name, cache_class in strategies:
+        waits = run(cache_class, waiters, rounds, hold)
+        print "%-8s p50: %7.2fms  p99: %7.2fms" % (
+            name, percentile(waits, 50) * 1000, percentile(waits, 99) * 1000)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+# BSD Licensed, Copyright (c) 2006-2010 TileCache Contributors
+
+"""
+Benchmark for MBTiles cache hits.
+
+Builds (or reuses) an .mbtiles file of the requested size, filled with
+random tiles, then measures random cache hits per second with a new
+connection per lookup (the old behaviour) and with the pooled, read-only,
+memory mapped connection the MBTiles cache now keeps.
+
+With 'seed' as the first argument, it instead measures seeding throughput:
+metatiles of 5x5 tiles are locked, written in one go and unlocked the way
+MetaLayer.render does, into an MBTiles database and into a Disk cache. A
+share of the tiles are identical 'blank' tiles, which the MBTiles cache only
+stores once.
+
+Usage: bench_mbtiles.py [size_mb] [lookups] [path]
+       bench_mbtiles.py seed [metatiles] [blank_percent] [path]
+"""
+
+import os, sys, time, random, shutil, sqlite3, tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from TileCache.Caches.MBTiles import MBTiles
+from TileCache.Caches.Disk import Disk
+from TileCache.Layer import Layer, Tile
+
+TILE_BYTES = 16 * 1024
+
+class ConnectPerGet (MBTiles):
+    def get (self, tile):
+        db = sqlite3.connect(self.getPath(tile.layer))
+        c = db.cursor()
+        c.execute("select tile_data from tiles where tile_column=? and tile_row=? and zoom_level=?", (tile.x, tile.y, tile.z))
+        res = c.fetchone()
+        if res:
+            tile.data = str(res[0])
+            return tile.data
+        return None
+
+def build (path, tiles, z):
+    if os.path.exists(path):
+        return
+    print "building %s ..." % path
+    db = sqlite3.connect(path)
+    db.execute("create table tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)")
+    db.execute("create unique index tile_index on tiles (zoom_level, tile_column, tile_row)")
+    side = 2 ** z
+    for i in range(tiles):
+        db.execute("insert into tiles values (?, ?, ?, ?)",
+                   (z, i % side, i / side, buffer(os.urandom(TILE_BYTES))))
+        if i % 1000 == 0:
+            db.commit()
+    db.commit()
+    db.close()
+
+def run (cache, layer, tiles, z, lookups):
+    side = 2 ** z
+    coords = [ random.randrange(tiles) for i in range(lookups) ]
+    start = time.time()
+    for i in coords:
+        if not cache.get(Tile(layer, i % side, i / side, z)):
+            raise Exception("missing tile %s" % i)
+    return lookups / (time.time() - start)
+
+def seed (cache, layer, metatiles, blank):
+    blank_tile = os.urandom(TILE_BYTES / 8)
+    side = 1
+    while (side / 5) ** 2 < metatiles:
+        side *= 2
+    z = side.bit_length() - 1
+    start = time.time()
+    for i in range(metatiles):
+        x, y = i % (side / 5) * 5, i / (side / 5) * 5
+        metatile = Tile(layer, x, y, z)
+        cache.lock(metatile)
+        try:
+            subtiles = []
+            for j in range(25):
+                if random.randrange(100) < blank:
+                    data = blank_tile
+                else:
+                    data = os.urandom(TILE_BYTES / 8)
+                subtiles.append((Tile(layer, x + j % 5, y + j / 5, z), data))
+            cache.set_multi(subtiles)
+        finally:
+            cache.unlock(metatile)
+    return metatiles * 25 / (time.time() - start)
+
+def main_seed ():
+    metatiles = len(sys.argv) > 2 and int(sys.argv[2]) or 2000
+    blank = len(sys.argv) > 3 and int(sys.argv[3]) or 30
+    base = tempfile.mkdtemp(prefix = "tilecache_bench_seed",
+                            dir = len(sys.argv) > 4 and sys.argv[4] or None)
+    layer = Layer("bench_seed")
+    print "%d metatiles of 25 tiles of %d bytes, %d%% blank" % (metatiles, TILE_BYTES / 8, blank)
+    try:
+        for name, cache in [ ("disk", Disk(os.path.join(base, "disk"))),
+                             ("mbtiles", MBTiles(base, "mbtiles", readonly = "no")) ]:
+            print "%-16s %8.0f tiles/s" % (name, seed(cache, layer, metatiles, blank))
+    finally:
+        shutil.rmtree(base, True)
+
+def main ():
+    if len(sys.argv) > 1 and sys.argv[1] == "seed":
+        return main_seed()
+    size_mb = len(sys.argv) > 1 and int(sys.argv[1]) or 2048
+    lookups = len(sys.argv) > 2 and int(sys.argv[2]) or 20000
+    base = len(sys.argv) > 3 and sys.argv[3] or tempfile.gettempdir()
+    tiles = size_mb * 1024 * 1024 / TILE_BYTES
+    z = 1
+    while 4 ** z < tiles:
+        z += 1
+    layer = Layer("bench_%dmb" % size_mb)
+    cache = MBTiles(base, "mbtiles")
+    build(cache.getPath(layer), tiles, z)
+    print "%s: %d tiles of %d bytes, %d random lookups" % (cache.getPath(layer), tiles, TILE_BYTES, lookups)
+    for name, cache in [ ("connect per get", ConnectPerGet(base, "mbtiles")),
+                         ("pooled", MBTiles(base, "mbtiles")) ]:
+        # one pass to warm the OS page cache, one to measure
+        run(cache, layer, tiles, z, lookups)
+        print "%-16s %8.0f hits/s" % (name, run(cache, layer, tiles, z, lookups))
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,6 @@
 from TileCache import Service, cgiHandler, cfgfiles
 
 if __name__ == '__main__':
-    svc = Service.load(*cfgfiles)
+    svc = Service.load(cfgfiles, snapshots = True)
     cgiHandler(svc)
 